@@ -26,7 +26,8 @@ Env vars:
 - SQUARE_ENV: "production" | "sandbox" (default: production)
 - SQUARE_BASE_URL: override base URL (optional)
 - SQUARE_VERSION: Square-Version header (default: 2025-10-16)  # from blueprint
-- SQUARE_LOCATION_ID: location for inventory (default: ATHC6TCDTCHWN)  # from blueprint
+- SQUARE_LOCATION_ID: location for inventory (default: ATHC6TCDTCHWN)  # from blueprint;
+  comma-separated for several locations (stock_count is then their sum)
 - PG_DSN: Postgres connection string (optional; falls back to SGR_DATABASE_URL, SPR_DATABASE_URL, DATABASE_URL)
 
 Optional env vars for table names:
@@ -38,29 +39,44 @@ Usage:
   python3 scripts/catalog_sync.py
   python3 scripts/catalog_sync.py --max-pages 10
   python3 scripts/catalog_sync.py --state-path /tmp/catalog_state.json
+  python3 scripts/catalog_sync.py --targets scripts/catalog_sync_targets.json
+  python3 scripts/catalog_sync.py --serve /run/catalog-sync.sock
+  python3 scripts/catalog_sync.py --item-id ITEM_ID --daemon-socket /run/catalog-sync.sock
 """
 
 from __future__ import annotations
 
 import argparse
+import atexit
+import contextlib
 import datetime as dt
+import gzip
+import hashlib
 import json
 import os
+import queue
 import re
+import signal
+import socket
+import socketserver
+import statistics
 import sys
+import threading
 import time
 import traceback
 import subprocess
-from dataclasses import dataclass
-from typing import Any, Dict, List, Optional, Tuple
+import unicodedata
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields, replace
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Optional, Tuple
 
-import requests
-
-try:
-    import psycopg  # type: ignore
-except Exception as e:  # pragma: no cover
-    psycopg = None  # type: ignore
-    _PSYCOPG_IMPORT_ERROR = e
+# requests and psycopg are imported on first use (SquareClient, _ensure_psycopg): together they are
+# most of the start-up time, and an --item-id run handed to a --serve daemon needs neither.
+psycopg: Any = None
+_Jsonb: Any = None
+_PSYCOPG_IMPORT_ERROR: Optional[BaseException] = None
 
 
 IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
@@ -150,23 +166,594 @@ def _atomic_write_json(path: str, payload: Dict[str, Any]) -> None:
     os.replace(tmp, path)
 
 
+def _atomic_write_bytes(path: str, data: bytes) -> None:
+    tmp = f"{path}.tmp"
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _append_jsonl(path: str, entries: List[Dict[str, Any]]) -> None:
+    if not entries:
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, sort_keys=True, default=str))
+            f.write("\n")
+
+
+class StageProfiler:
+    """
+    --profile DIR: per-stage cProfile stats and tracemalloc peaks.
+
+    Stages nest (e.g. an SQL call inside a larger stage); only the innermost stage's
+    cProfile.Profile is enabled at any time, and the outer stage resumes when it exits.
+    tracemalloc peaks are measured relative to traced memory at stage entry. Only the thread
+    that created it is profiled (cProfile is per thread); stages of other threads pass through.
+    """
+
+    TOP_FUNCTIONS = 15
+    TOP_ALLOCATIONS = 10
+
+    def __init__(self, out_dir: str):
+        import cProfile
+        import tracemalloc
+
+        self.out_dir = out_dir
+        self._cprofile = cProfile
+        self._tracemalloc = tracemalloc
+        self._profiles: Dict[str, Any] = {}
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        # Stack of [name, profile, traced_at_entry, absolute_peak_so_far]
+        self._stack: List[List[Any]] = []
+        self._thread = threading.get_ident()
+        self.started_at = dt.datetime.now(dt.timezone.utc).isoformat()
+        os.makedirs(out_dir, exist_ok=True)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def report_path(self) -> str:
+        return os.path.join(self.out_dir, "profile_report.txt")
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if threading.get_ident() != self._thread:
+            yield
+            return
+        if any(frame[0] == name for frame in self._stack):
+            # Re-entrant stage (same name already active): account it to the outer call.
+            yield
+            return
+
+        tm = self._tracemalloc
+        current, peak = tm.get_traced_memory()
+        if self._stack:
+            parent = self._stack[-1]
+            parent[1].disable()
+            parent[3] = max(parent[3], peak)
+        tm.reset_peak()
+
+        prof = self._profiles.get(name)
+        if prof is None:
+            prof = self._profiles[name] = self._cprofile.Profile()
+        frame: List[Any] = [name, prof, current, current]
+        self._stack.append(frame)
+        t0 = time.perf_counter()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            elapsed = time.perf_counter() - t0
+            self._stack.pop()
+            _, peak = tm.get_traced_memory()
+            abs_peak = max(frame[3], peak)
+            self._record(name, elapsed, abs_peak - frame[2])
+            if self._stack:
+                parent = self._stack[-1]
+                parent[3] = max(parent[3], abs_peak)
+                parent[1].enable()
+
+    def _record(self, name: str, elapsed: float, peak_bytes: int) -> None:
+        st = self._stats.setdefault(name, {"calls": 0, "wall_s": 0.0, "peak_bytes": 0, "top_allocations": []})
+        st["calls"] += 1
+        st["wall_s"] += elapsed
+        if peak_bytes > st["peak_bytes"] or not st["top_allocations"]:
+            st["peak_bytes"] = max(st["peak_bytes"], peak_bytes)
+            # Snapshot only when this stage sets a new peak; snapshots are not cheap.
+            snap = self._tracemalloc.take_snapshot().filter_traces(
+                (
+                    self._tracemalloc.Filter(False, self._tracemalloc.__file__),
+                    self._tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                )
+            )
+            st["top_allocations"] = [str(s) for s in snap.statistics("lineno")[: self.TOP_ALLOCATIONS]]
+
+    def write_report(self) -> str:
+        import io
+        import pstats
+
+        lines = [
+            f"Catalog sync profile (started {self.started_at})",
+            "",
+            f"{'stage':<40} {'calls':>7} {'wall_s':>10} {'peak_mib':>10}",
+        ]
+        by_time = sorted(self._stats.items(), key=lambda kv: kv[1]["wall_s"], reverse=True)
+        for name, st in by_time:
+            lines.append(f"{name:<40} {st['calls']:>7} {st['wall_s']:>10.3f} {st['peak_bytes'] / 1048576:>10.2f}")
+
+        for name, st in by_time:
+            prof = self._profiles.get(name)
+            safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", name)
+            buf = io.StringIO()
+            if prof is not None:
+                prof.dump_stats(os.path.join(self.out_dir, f"{safe}.prof"))
+                try:
+                    pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(self.TOP_FUNCTIONS)
+                except TypeError:
+                    # No calls were recorded (e.g. the stage only wrapped C code).
+                    buf.write("  (no Python calls recorded)\n")
+            lines += ["", f"== {name} ({safe}.prof) ==", "Top functions by cumulative time:"]
+            lines += ["  " + ln for ln in buf.getvalue().strip("\n").splitlines() if ln.strip()]
+            lines.append("Top allocation sites (live at the stage's peak call):")
+            lines += ["  " + a for a in st["top_allocations"]] or ["  (none)"]
+
+        with open(self.report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return self.report_path
+
+
+# Set by main() when --profile is given.
+_PROFILER: Optional[StageProfiler] = None
+
+
+@contextlib.contextmanager
+def _stage(name: str) -> Iterator[None]:
+    prof = _PROFILER
+    events = _EVENTS
+    history = getattr(_TARGET, "history", None)
+    if prof is None and events is None and history is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    if events is not None:
+        events.enter(name)
+    try:
+        if prof is None:
+            yield
+        else:
+            with prof.stage(name):
+                yield
+    finally:
+        if events is not None:
+            events.exit(name, time.perf_counter() - t0)
+        if history is not None:
+            history.stage_seconds[name] = history.stage_seconds.get(name, 0.0) + time.perf_counter() - t0
+
+
+class EventStream:
+    """
+    --events FILE|-: NDJSON progress events, one object per line, flushed as they are written
+    ("-" writes to stderr so stdout keeps the final JSON summary). Each line has ts, elapsed_s
+    and event plus event-specific fields.
+
+    _stage feeds it from any thread: per-stage seconds accumulate per target (_TARGET.name, None
+    outside --targets) until that target's take_timings() (batch_end reports them), and a daemon
+    thread emits a heartbeat every HEARTBEAT_S naming the innermost stage each busy thread is in
+    and for how long, so a stuck Square call or DB lock is visible while it happens.
+    """
+
+    HEARTBEAT_S = 5.0
+
+    def __init__(self, path: str):
+        self.path = path
+        if path == "-":
+            self._f: Any = sys.stderr
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._f = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        # Thread id -> (target name, stack of (stage name, monotonic entry time)).
+        self._stacks: Dict[int, Tuple[Optional[str], List[Tuple[str, float]]]] = {}
+        # Target name -> stage name -> seconds.
+        self._timings: Dict[Optional[str], Dict[str, float]] = {}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name="catalog-sync-events", daemon=True)
+        self._thread.start()
+
+    def emit(self, event: str, **fields: Any) -> None:
+        line = {
+            "ts": dt.datetime.now(dt.timezone.utc).isoformat(),
+            "elapsed_s": round(time.monotonic() - self._started, 3),
+            "event": event,
+            **fields,
+        }
+        target = getattr(_TARGET, "name", None)
+        if target:
+            line.setdefault("target", target)
+        data = json.dumps(line, sort_keys=True, default=str)
+        with self._lock:
+            try:
+                self._f.write(data + "\n")
+                self._f.flush()
+            except Exception:
+                pass
+
+    def enter(self, name: str) -> None:
+        ident = threading.get_ident()
+        target = getattr(_TARGET, "name", None)
+        with self._lock:
+            self._stacks.setdefault(ident, (target, []))[1].append((name, time.monotonic()))
+
+    def exit(self, name: str, seconds: float) -> None:
+        ident = threading.get_ident()
+        with self._lock:
+            entry = self._stacks.get(ident)
+            if entry is None:
+                return
+            target, stack = entry
+            if stack and stack[-1][0] == name:
+                stack.pop()
+            if not stack:
+                del self._stacks[ident]
+            timings = self._timings.setdefault(target, {})
+            timings[name] = timings.get(name, 0.0) + seconds
+
+    def take_timings(self, all_targets: bool = False) -> Dict[str, float]:
+        """
+        Seconds per stage of the calling thread's target since its last call (nested stages are
+        included in their parents); all_targets sums and clears every target's.
+        """
+        with self._lock:
+            if all_targets:
+                taken = list(self._timings.values())
+                self._timings.clear()
+            else:
+                taken = [self._timings.pop(getattr(_TARGET, "name", None), {})]
+        out: Dict[str, float] = {}
+        for timings in taken:
+            for k, v in timings.items():
+                out[k] = out.get(k, 0.0) + v
+        return {k: round(v, 3) for k, v in out.items()}
+
+    def _heartbeat(self) -> None:
+        while not self._closed.wait(self.HEARTBEAT_S):
+            now = time.monotonic()
+            with self._lock:
+                current = [(target, stack[-1]) for target, stack in self._stacks.values() if stack]
+            if not current:
+                self.emit("heartbeat", stage=None, stage_s=None)
+            for target, (stage, entered) in current:
+                fields: Dict[str, Any] = {"target": target} if target else {}
+                self.emit("heartbeat", stage=stage, stage_s=round(now - entered, 3), **fields)
+
+    def close(self) -> None:
+        self._closed.set()
+        if self._f is not sys.stderr:
+            with self._lock:
+                with contextlib.suppress(Exception):
+                    self._f.close()
+
+
+# Set by main() when --events is given.
+_EVENTS: Optional[EventStream] = None
+
+
+def _emit(event: str, **fields: Any) -> None:
+    if _EVENTS is not None:
+        _EVENTS.emit(event, **fields)
+
+
+# Per thread: the run's RunHistory (see _dispatch) and, with --targets, the target's name and
+# its run summary (see _run_targets).
+_TARGET = threading.local()
+
+
+def _report(summary: Dict[str, Any]) -> None:
+    """
+    Print a run's JSON summary, or hand it to _run_targets (one of several targets) or to the
+    --serve daemon (which returns it to the client). The run's Postgres connection stats are
+    added as "pg".
+    """
+    pg: Optional[PgConnections] = getattr(_TARGET, "pg", None)
+    if pg is not None:
+        summary = {**summary, "pg": pg.stats()}
+    history = getattr(_TARGET, "history", None)
+    if history is not None:
+        history.summary = summary
+    if getattr(_TARGET, "name", None) or getattr(_TARGET, "capture", False):
+        _TARGET.summary = summary
+        return
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+class RunHistory:
+    """
+    run_log stage: one kind='run' row per run in CATALOG_SYNC_RUNS_TABLE (see _record_run), plus a
+    kind='batch' row per catalog batch. _stage adds seconds per stage (nested stages are included
+    in their parents) and _json_param the jsonb bytes sent to Postgres; Square request counts come
+    from SquareClient.stats and the row counts from the run's summary.
+    """
+
+    def __init__(self, mode: str):
+        self.run_id = uuid.uuid4().hex
+        self.mode = mode
+        self.started_at = dt.datetime.now(dt.timezone.utc)
+        self.started = time.monotonic()
+        self.stage_seconds: Dict[str, float] = {}
+        self.pg_bytes = 0
+        self.batches = 0
+        # Run history columns of the runs table once checked (see _ensure_run_columns).
+        self.columns: Optional[FrozenSet[str]] = None
+        self.summary: Optional[Dict[str, Any]] = None
+
+    def batch_rows(self) -> bool:
+        return self.columns is not None and "run_id" in self.columns
+
+
+class SqlTimings:
+    """
+    --sql-timings: time every SQL template execution and EXPLAIN the slow ones.
+
+    A statement slower than the threshold is re-run as EXPLAIN (ANALYZE, BUFFERS) on a
+    separate cursor inside a savepoint that is always rolled back, so the sampled plan
+    never changes data. Note that a re-run write sees the rows the original statement
+    already wrote (e.g. an upsert re-runs as all updates).
+    """
+
+    SAMPLES_PER_TEMPLATE = 3
+    SAVEPOINT = "catalog_sync_explain"
+    _EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+    def __init__(self, report_path: str, threshold_ms: float):
+        self.report_path = report_path
+        self.threshold_ms = threshold_ms
+        self.started_at = dt.datetime.now(dt.timezone.utc).isoformat()
+        # name -> {"sql", "count", "total_ms", "max_ms", "ok", "err", "samples": [...]}
+        self._by_name: Dict[str, Dict[str, Any]] = {}
+        # --targets workers record concurrently.
+        self._lock = threading.Lock()
+
+    def _entry(self, name: str, sql: str) -> Dict[str, Any]:
+        return self._by_name.setdefault(
+            name,
+            {"sql": sql, "count": 0, "total_ms": 0.0, "max_ms": 0.0, "ok": 0, "err": 0, "samples": []},
+        )
+
+    def record(self, name: str, sql: str, ms: float, ok: bool) -> None:
+        with self._lock:
+            e = self._entry(name, sql)
+            e["count"] += 1
+            e["total_ms"] += ms
+            e["max_ms"] = max(e["max_ms"], ms)
+            e["ok" if ok else "err"] += 1
+
+    def maybe_explain(self, cur: Any, name: str, sql: str, params: Any, ms: float) -> None:
+        if ms < self.threshold_ms:
+            return
+        if not sql.lstrip().upper().startswith(self._EXPLAINABLE):
+            return
+        with self._lock:
+            samples = self._entry(name, sql)["samples"]
+            if len(samples) >= self.SAMPLES_PER_TEMPLATE and ms <= min(x["ms"] for x in samples):
+                return
+
+        sample: Dict[str, Any] = {"ms": ms, "at": dt.datetime.now(dt.timezone.utc).isoformat(), "plan": [], "error": None}
+        conn = cur.connection
+        if getattr(conn, "autocommit", False):
+            # No surrounding transaction, so there is nothing to roll the re-run back into.
+            sample["error"] = "skipped: autocommit connection"
+        else:
+            try:
+                with conn.cursor() as ecur:
+                    ecur.execute(f"SAVEPOINT {self.SAVEPOINT}")
+                    try:
+                        ecur.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params)
+                        sample["plan"] = [str(r[0]) for r in (ecur.fetchall() or [])]
+                    except Exception as e:
+                        sample["error"] = str(e)
+                    finally:
+                        ecur.execute(f"ROLLBACK TO SAVEPOINT {self.SAVEPOINT}")
+                        ecur.execute(f"RELEASE SAVEPOINT {self.SAVEPOINT}")
+            except Exception as e:
+                # Diagnostics must never fail the batch on their own.
+                sample["error"] = sample["error"] or str(e)
+
+        with self._lock:
+            samples.append(sample)
+            samples.sort(key=lambda x: x["ms"], reverse=True)
+            del samples[self.SAMPLES_PER_TEMPLATE :]
+
+    def write_report(self) -> str:
+        with self._lock:
+            rows = sorted(self._by_name.items(), key=lambda kv: kv[1]["total_ms"], reverse=True)
+        lines = [
+            "### Catalog Sync SQL Timings Report",
+            "",
+            f"- **Generated**: {dt.datetime.now(dt.timezone.utc).isoformat()}",
+            f"- **Run started**: {self.started_at}",
+            f"- **EXPLAIN threshold**: {self.threshold_ms:g}ms (up to {self.SAMPLES_PER_TEMPLATE} slowest samples per template)",
+            "",
+            "### Templates (by total time)",
+            "",
+            "| total ms | count | avg ms | max ms | ok/err | template | sql (normalized) |",
+            "|---:|---:|---:|---:|---:|---|---|",
+        ]
+        for name, e in rows:
+            avg = e["total_ms"] / e["count"] if e["count"] else 0.0
+            lines.append(
+                f"| {e['total_ms']:.0f} | {e['count']} | {avg:.1f} | {e['max_ms']:.0f} | {e['ok']}/{e['err']} "
+                f"| `{name}` | `{_truncate(' '.join(e['sql'].split()), 180)}` |"
+            )
+
+        lines += ["", "### Slow statement plans", ""]
+        any_samples = False
+        for name, e in rows:
+            for smp in e["samples"]:
+                any_samples = True
+                seq_scans = sorted(set(re.findall(r"Seq Scan on (\w+)", "\n".join(smp["plan"]))))
+                lines += [f"#### `{name}` — {smp['ms']:.0f}ms", "", f"- **At**: {smp['at']}"]
+                if seq_scans:
+                    lines.append(f"- **Seq scans**: {', '.join(f'`{t}`' for t in seq_scans)}")
+                if smp["error"]:
+                    lines.append(f"- **EXPLAIN error**: `{_truncate(smp['error'], 300)}`")
+                if smp["plan"]:
+                    lines += ["", "```", *smp["plan"], "```"]
+                lines.append("")
+        if not any_samples:
+            lines += [f"_No statement exceeded {self.threshold_ms:g}ms._", ""]
+
+        os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+        with open(self.report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        return self.report_path
+
+
+# Set by main() when --sql-timings is given.
+_SQL_TIMINGS: Optional[SqlTimings] = None
+
+
+JSON_CODECS = ("auto", "orjson", "msgspec", "json")
+
+
+@dataclass(frozen=True)
+class JsonCodec:
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Any], Any]
+
+
+def _stdlib_json_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _load_json_codec(name: str) -> JsonCodec:
+    """
+    Resolve --json-codec. "auto" picks the first installed of orjson, msgspec, stdlib json.
+    All codecs produce UTF-8 bytes, so payloads go to Postgres without an intermediate str.
+    """
+    for candidate in (("orjson", "msgspec", "json") if name == "auto" else (name,)):
+        if candidate == "orjson":
+            try:
+                import orjson  # type: ignore
+            except ImportError:
+                continue
+            return JsonCodec("orjson", orjson.dumps, orjson.loads)
+        if candidate == "msgspec":
+            try:
+                import msgspec  # type: ignore
+            except ImportError:
+                continue
+            return JsonCodec("msgspec", msgspec.json.Encoder().encode, msgspec.json.Decoder().decode)
+        if candidate == "json":
+            return JsonCodec("json", _stdlib_json_dumps, json.loads)
+    raise SystemExit(f"JSON codec {name!r} is not installed (pip install {name}) or use --json-codec auto")
+
+
+# Replaced by main() when --json-codec is given.
+_JSON_CODEC: JsonCodec = _load_json_codec("auto")
+
+
+def _json_loads(data: bytes) -> Any:
+    return _JSON_CODEC.loads(data)
+
+
+def _passthrough_bytes(data: bytes) -> bytes:
+    return data
+
+
+def _json_param(obj: Any) -> Any:
+    """
+    Serialize a jsonb SQL parameter (separate stage so --profile shows serialization cost).
+    The encoded bytes are wrapped in Jsonb with an identity dumps, so psycopg sends them as-is.
+    """
+    with _stage("json.dumps"):
+        data = _JSON_CODEC.dumps(obj)
+    history = getattr(_TARGET, "history", None)
+    if history is not None:
+        history.pg_bytes += len(data)
+    if _Jsonb is None:
+        return data.decode("utf-8")
+    return _Jsonb(data, dumps=_passthrough_bytes)
+
+
+def _execute(cur: Any, name: str, sql: str, params: Any = None) -> None:
+    """Run one named SQL template (names key the --profile stages and the --sql-timings report)."""
+    timings = _SQL_TIMINGS
+    ok = False
+    t0 = time.perf_counter()
+    with _stage(f"sql.{name}"):
+        try:
+            if params is None:
+                cur.execute(sql)
+            else:
+                cur.execute(sql, params)
+            ok = True
+        finally:
+            if timings is not None:
+                timings.record(name, sql, (time.perf_counter() - t0) * 1000.0, ok)
+    if timings is not None:
+        timings.maybe_explain(cur, name, sql, params, (time.perf_counter() - t0) * 1000.0)
+
+
 @dataclass(frozen=True)
 class Config:
     square_access_token: str
     square_base_url: str
     square_version: str
     square_location_id: str
+    square_location_ids: Tuple[str, ...]
     pg_dsn: str
     state_path: str
     products_table: str
     categories_table: str
     catalog_sync_runs_table: str
+    staff_picks_table: str
     dry_run: bool
+    plan: bool
     max_pages: int
     upsert_batch_pages: int
     timeout_s: int
     item_id: Optional[str]
     rebuild_albums_cache: bool
+    diff: bool
+    fast_path: bool
+    profile_dir: Optional[str]
+    sql_timings_path: Optional[str]
+    explain_threshold_ms: float
+    ensure_indexes: bool
+    analyze_min_rows: int
+    json_codec: str
+    dead_letter_path: str
+    alert_state_path: str
+    alert_window_s: float
+    alert_deadline_s: float
+    related_cache_size: int
+    time_budget_s: Optional[float]
+    refresh_tiers: bool
+    tier_state_path: str
+    category_state_path: str
+    tier_intervals: Tuple[Tuple[str, float], ...]
+    api_calls_per_minute: int
+    inventory_strategy: str
+    snapshot_dir: Optional[str]
+    stages: FrozenSet[str]
+    events_path: Optional[str]
+    targets_path: Optional[str]
+    run_batch_rows: bool
+    run_batch_retention_days: int
+    run_retention_days: int
+    item_category_max_age_s: float
+    daemon_socket: Optional[str]
+    serve_socket: Optional[str]
+    pg_pooler_dsn: Optional[str]
+    pg_pool_size: int
+    pg_recycle_batches: int
+    pg_recycle_s: float
 
 
 def _get_env(name: str) -> Optional[str]:
@@ -250,16 +837,57 @@ def _send_make_alert_email(
     """
     Best-effort webhook to the existing Make alerts pipeline.
     It is responsible for sending Slack + email. We include the alert code in multiple places.
+    When main() has set up an AlertDispatcher the alert is queued (deduplicated, sent in the
+    background); otherwise it is delivered inline.
     """
-    webhook_url = _get_env("MAKE_ALERTS_WEBHOOK_URL")
+    target = getattr(_TARGET, "name", None)
+    if target:
+        title = f"{title} [{target}]"
+        context = {**context, "target": target}
+    if _ALERTS is not None:
+        _ALERTS.submit(
+            alert_code=alert_code, title=title, error=error, context=context, stack=stack, severity=severity
+        )
+        return
+
+    webhook_url = _make_alert_webhook_url()
     if not webhook_url:
         return
+    _deliver_make_alert(
+        webhook_url,
+        alert_code=alert_code,
+        title=title,
+        error=error,
+        context=context,
+        stack=stack,
+        severity=severity,
+        timeout_s=15.0,
+    )
+
+
+def _make_alert_webhook_url() -> Optional[str]:
+    webhook_url = _get_env("MAKE_ALERTS_WEBHOOK_URL")
+    if not webhook_url:
+        return None
 
     enabled = _truthy_env("ALERT_ENABLED", default=False) or _truthy_env("SLACK_ALERT_ENABLED", default=False)
     # If it's configured at all, allow it in local runs; but still keep an opt-in switch.
     if not enabled and (os.environ.get("NODE_ENV") != "production"):
-        return
+        return None
+    return webhook_url
 
+
+def _deliver_make_alert(
+    webhook_url: str,
+    *,
+    alert_code: str,
+    title: str,
+    error: str,
+    context: Dict[str, Any],
+    stack: Optional[str],
+    severity: str,
+    timeout_s: float,
+) -> bool:
     now = dt.datetime.now(dt.timezone.utc).isoformat()
     safe_context = dict(context or {})
     safe_context["alertCode"] = alert_code
@@ -298,27 +926,247 @@ def _send_make_alert_email(
     }
 
     try:
-        requests.post(webhook_url, json=payload, timeout=15).raise_for_status()
+        import requests
+
+        requests.post(webhook_url, json=payload, timeout=timeout_s).raise_for_status()
+        return True
     except Exception:
         # Never fail the sync because alerts couldn't be sent.
-        return
+        return False
+
+
+class AlertDispatcher:
+    """
+    Background sender for _send_make_alert_email.
+
+    submit() never blocks on the network: alerts go on a bounded queue drained by a daemon
+    thread, and close() (also registered with atexit) gives the queue at most deadline_s to
+    drain before the process exits. Alerts that do not fit in the queue or the deadline are dropped.
+
+    Per alert_code (and target, with --targets), repeats within window_s of the last sent alert
+    are suppressed and counted in state_path, which persists across runs (cron ticks). The next
+    alert for that code that goes out carries the folded count: "(N occurrences since ...)". When
+    none comes, close() sends the count once the window has passed, from the last suppressed alert.
+    """
+
+    QUEUE_SIZE = 16
+
+    def __init__(self, state_path: str, window_s: float, deadline_s: float):
+        self.state_path = state_path
+        self.window_s = window_s
+        self.deadline_s = deadline_s
+        try:
+            self._state: Dict[str, Any] = _load_json_file(state_path)
+        except Exception:
+            self._state = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._thread: Optional[threading.Thread] = None
+        self._deadline: Optional[float] = None
+        self._closed = False
+        self.queued = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.failed = 0
+        atexit.register(self.close)
+
+    def submit(
+        self,
+        *,
+        alert_code: str,
+        title: str,
+        error: str,
+        context: Dict[str, Any],
+        stack: Optional[str],
+        severity: str,
+    ) -> None:
+        webhook_url = _make_alert_webhook_url()
+        if self._closed or not webhook_url:
+            return
+        now = time.time()
+        now_iso = dt.datetime.now(dt.timezone.utc).isoformat()
+        target = getattr(_TARGET, "name", None)
+        key = f"{target}:{alert_code}" if target else alert_code
+        with self._lock:
+            entry = self._state.get(key)
+            if not isinstance(entry, dict):
+                entry = {}
+            last_sent = entry.get("last_sent_ts")
+            if isinstance(last_sent, (int, float)) and now - last_sent < self.window_s:
+                entry["suppressed"] = int(entry.get("suppressed") or 0) + 1
+                entry.setdefault("first_suppressed_at", now_iso)
+                # What close() sends if no later alert carries the count.
+                entry["last_alert"] = {
+                    "alert_code": alert_code,
+                    "title": title,
+                    "error": _truncate(str(error), 2000),
+                    "context": json.loads(json.dumps(context or {}, default=str)),
+                    "severity": severity,
+                }
+                self._state[key] = entry
+                self._dirty = True
+                self.suppressed += 1
+                return
+            occurrences = int(entry.get("suppressed") or 0) + 1
+            since = entry.get("first_suppressed_at")
+            self._state[key] = {"last_sent_ts": now, "last_sent_at": now_iso}
+            self._dirty = True
+
+        if occurrences > 1:
+            title = f"{title} ({occurrences} occurrences since {since})"
+            context = dict(context or {})
+            context["occurrences"] = occurrences
+            context["firstOccurrenceAt"] = since
+        self._enqueue(
+            {
+                "webhook_url": webhook_url,
+                "alert_code": alert_code,
+                "title": title,
+                "error": error,
+                "context": context,
+                "stack": stack,
+                "severity": severity,
+            }
+        )
+
+    def _enqueue(self, item: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.queued += 1
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="catalog-sync-alerts", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            timeout_s = 15.0
+            if self._deadline is not None:
+                timeout_s = min(timeout_s, self._deadline - time.monotonic())
+                if timeout_s <= 0:
+                    self.dropped += 1
+                    continue
+            webhook_url = item.pop("webhook_url")
+            if not _deliver_make_alert(webhook_url, timeout_s=timeout_s, **item):
+                self.failed += 1
+
+    def _flush_suppressed(self) -> None:
+        """Send the folded count of every code whose window passed with repeats still unreported."""
+        webhook_url = _make_alert_webhook_url()
+        if not webhook_url:
+            return
+        now = time.time()
+        items: List[Dict[str, Any]] = []
+        with self._lock:
+            for key, entry in list(self._state.items()):
+                if not isinstance(entry, dict) or not entry.get("suppressed"):
+                    continue
+                last_sent = entry.get("last_sent_ts")
+                if isinstance(last_sent, (int, float)) and now - last_sent < self.window_s:
+                    continue
+                last = entry.get("last_alert") or {}
+                occurrences = int(entry["suppressed"])
+                since = entry.get("first_suppressed_at")
+                title = last.get("title") or f"Catalog sync alert {key}"
+                context = {**(last.get("context") or {}), "occurrences": occurrences, "firstOccurrenceAt": since}
+                items.append(
+                    {
+                        "webhook_url": webhook_url,
+                        "alert_code": last.get("alert_code") or key.rsplit(":", 1)[-1],
+                        "title": f"{title} ({occurrences} occurrences since {since})",
+                        "error": last.get("error") or "",
+                        "context": context,
+                        "stack": None,
+                        "severity": last.get("severity") or "warning",
+                    }
+                )
+                self._state[key] = {"last_sent_ts": now, "last_sent_at": dt.datetime.now(dt.timezone.utc).isoformat()}
+                self._dirty = True
+        for item in items:
+            self._enqueue(item)
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._flush_suppressed()
+        self._closed = True
+        self._deadline = time.monotonic() + self.deadline_s
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=self.deadline_s)
+            except queue.Full:
+                pass
+            self._thread.join(max(0.0, self._deadline - time.monotonic()))
+        self._save_state()
+
+    def _save_state(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            # Entries past their window with nothing suppressed carry no information.
+            cutoff = time.time() - self.window_s
+            state = {
+                code: entry
+                for code, entry in self._state.items()
+                if isinstance(entry, dict)
+                and (entry.get("suppressed") or (entry.get("last_sent_ts") or 0) >= cutoff)
+            }
+            self._dirty = False
+        try:
+            _atomic_write_json(self.state_path, state)
+        except Exception:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queued": self.queued,
+            "suppressed": self.suppressed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+
+# Set by main(); when None, alerts are delivered inline.
+_ALERTS: Optional[AlertDispatcher] = None
+
+
+# One albums_cache rebuild at a time: --targets workers finish concurrently, and each rebuild is a
+# TRUNCATE + INSERT of the whole table.
+_ALBUMS_CACHE_LOCK = threading.Lock()
 
 
 def _rebuild_albums_cache(cfg: Config) -> Dict[str, Any]:
     """
     Runs the existing Node script to rebuild albums_cache.
     Returns a small structured result for logging/JSON output.
+
+    The script reads the database of this run's DSN (it takes SGR_DATABASE_URL first, see
+    api/db.js) and always the `products` table, so a run that writes another products table
+    skips the rebuild.
     """
+    if cfg.products_table != "products":
+        return {"attempted": False, "ok": True, "reason": f"products_table is {cfg.products_table}"}
     cmd = ["node", os.path.join("scripts", "populate-albums-cache.mjs")]
+    env = dict(os.environ)
+    if cfg.pg_dsn:
+        env.update({k: cfg.pg_dsn for k in ("SGR_DATABASE_URL", "SPR_DATABASE_URL", "DATABASE_URL")})
     try:
-        proc = subprocess.run(
-            cmd,
-            cwd=_repo_root(),
-            text=True,
-            capture_output=True,
-            timeout=60 * 15,  # 15 minutes
-            check=False,
-        )
+        with _ALBUMS_CACHE_LOCK:
+            proc = subprocess.run(
+                cmd,
+                cwd=_repo_root(),
+                env=env,
+                text=True,
+                capture_output=True,
+                timeout=60 * 15,  # 15 minutes
+                check=False,
+            )
         out = (proc.stdout or "") + ("\n" + proc.stderr if proc.stderr else "")
         return {
             "attempted": True,
@@ -341,7 +1189,18 @@ def load_config(argv: Optional[List[str]] = None) -> Config:
     p = argparse.ArgumentParser(description="Square catalog -> Postgres sync (Make blueprint replica)")
     p.add_argument("--state-path", default=os.path.join("scripts", "catalog_sync_state.json"))
     p.add_argument("--dry-run", action="store_true", help="Do not write to Postgres or state file")
-    p.add_argument("--max-pages", type=int, default=1, help="How many catalog pages to fetch this run")
+    p.add_argument(
+        "--plan",
+        action="store_true",
+        help="Fetch the pages the next run would sync and report what it would insert, update, leave unchanged "
+        "or could delete, plus inventory/image changes and bytes, without writing anything.",
+    )
+    p.add_argument(
+        "--max-pages",
+        type=int,
+        default=None,
+        help="How many catalog pages to fetch this run (default: 1, or no limit with --time-budget)",
+    )
     p.add_argument(
         "--upsert-batch-pages",
         type=int,
@@ -354,79 +1213,526 @@ def load_config(argv: Optional[List[str]] = None) -> Config:
         default=None,
         help="Sync a single Square ITEM by id (does not read/write cursor state).",
     )
+    p.add_argument(
+        "--item-category-max-age-m",
+        type=float,
+        default=60.0,
+        help="--item-id: use the categories table (or the daemon's copy) when it was synced within this many "
+        "minutes instead of crawling every category; 0 always crawls (default: 60).",
+    )
+    p.add_argument(
+        "--daemon-socket",
+        metavar="PATH",
+        default=_get_env("CATALOG_SYNC_SOCKET"),
+        help="--item-id: hand the run to a --serve daemon listening on this unix socket, or run it here when "
+        "none answers (default: CATALOG_SYNC_SOCKET).",
+    )
+    p.add_argument(
+        "--serve",
+        metavar="PATH",
+        default=None,
+        help="Run as a daemon on this unix socket, syncing the --item-id runs clients send with warm imports, "
+        "Postgres connection, category index and Square session.",
+    )
     p.add_argument(
         "--rebuild-albums-cache",
         action="store_true",
         help="After a successful sync, run node scripts/populate-albums-cache.mjs to refresh albums_cache.",
     )
+    p.add_argument(
+        "--no-diff",
+        action="store_true",
+        help="Upsert every fetched variation instead of only new/changed ones (ignores sync_fingerprint).",
+    )
+    p.add_argument(
+        "--no-fast-path",
+        action="store_true",
+        help="Crawl even when Square reports no catalog changes since the last completed pass.",
+    )
+    p.add_argument(
+        "--profile",
+        metavar="DIR",
+        default=None,
+        help="Write per-stage cProfile stats, tracemalloc peaks and profile_report.txt to DIR.",
+    )
+    p.add_argument(
+        "--sql-timings",
+        metavar="PATH",
+        nargs="?",
+        const=os.path.join("scripts", "CATALOG_SYNC_SQL_TIMINGS.md"),
+        default=None,
+        help="Time every SQL statement and write a markdown report (default path: scripts/CATALOG_SYNC_SQL_TIMINGS.md).",
+    )
+    p.add_argument(
+        "--explain-threshold-ms",
+        type=float,
+        default=250.0,
+        help="With --sql-timings, EXPLAIN (ANALYZE, BUFFERS) statements slower than this (default: 250).",
+    )
+    p.add_argument(
+        "--skip-indexes",
+        action="store_true",
+        help="Do not check/create the products indexes the sync relies on.",
+    )
+    p.add_argument(
+        "--analyze-min-rows",
+        type=int,
+        default=5000,
+        help="Run ANALYZE on the products table when a run inserts/updates at least this many rows (0 disables).",
+    )
+    p.add_argument(
+        "--dead-letter",
+        metavar="PATH",
+        default=os.path.join("scripts", "catalog_sync_dead_letter.jsonl"),
+        help="JSONL file for catalog objects skipped after batch bisection (default: scripts/catalog_sync_dead_letter.jsonl).",
+    )
+    p.add_argument(
+        "--stages",
+        metavar="STAGE,...",
+        default=",".join(SYNC_STAGES),
+        help=f"Only run these stages (default: all of {','.join(SYNC_STAGES)}). Without products, the catalog "
+        "crawl is skipped and each selected stage repairs the whole table instead.",
+    )
+    p.add_argument(
+        "--targets",
+        metavar="FILE",
+        default=None,
+        help="Sync every target (account / location / tables) listed in this JSON file concurrently; "
+        "the other flags apply to all of them.",
+    )
+    p.add_argument(
+        "--events",
+        metavar="FILE|-",
+        default=None,
+        help="Append NDJSON progress events (batches, pages, retries, checkpoints, stage timings, heartbeats) "
+        "to FILE as they happen; - writes them to stderr.",
+    )
+    p.add_argument(
+        "--no-run-batch-rows",
+        action="store_true",
+        help="Record only the run row in CATALOG_SYNC_RUNS_TABLE, not one child row per catalog batch.",
+    )
+    p.add_argument(
+        "--run-batch-retention-days",
+        type=int,
+        default=RUN_BATCH_RETENTION_DAYS,
+        help="Roll batch rows older than this many days up into their run row and delete them "
+        f"(default: {RUN_BATCH_RETENTION_DAYS}; 0 keeps them).",
+    )
+    p.add_argument(
+        "--run-retention-days",
+        type=int,
+        default=RUN_RETENTION_DAYS,
+        help=f"Delete run rows older than this many days (default: {RUN_RETENTION_DAYS}; 0 keeps them).",
+    )
+    p.add_argument(
+        "--pg-pool-size",
+        type=int,
+        default=0,
+        help="Keep up to this many idle Postgres connections per DSN for reuse within the process: by other "
+        "--targets, the run history row and later daemon runs (default: 0, every connection is closed).",
+    )
+    p.add_argument(
+        "--pg-recycle-batches",
+        type=int,
+        default=0,
+        help="Replace the catalog run's Postgres connection after this many batches (default: 0, never).",
+    )
+    p.add_argument(
+        "--pg-recycle-min",
+        type=float,
+        default=30.0,
+        help="Replace a Postgres connection between batches once it is this many minutes old (default: 30; 0 never).",
+    )
+    p.add_argument(
+        "--snapshot-dir",
+        metavar="DIR",
+        default=None,
+        help="After a successful sync, write a gzip/brotli catalog snapshot of the products table plus "
+        f"{SNAPSHOT_MANIFEST_NAME} to DIR (only when the content changed).",
+    )
+    p.add_argument(
+        "--alert-state",
+        metavar="PATH",
+        default=os.path.join("scripts", "catalog_sync_alert_state.json"),
+        help="Where per-alert_code dedupe state is kept between runs (default: scripts/catalog_sync_alert_state.json).",
+    )
+    p.add_argument(
+        "--alert-window-min",
+        type=float,
+        default=60.0,
+        help="Suppress repeats of an alert_code for this many minutes after it was sent (default: 60, 0 disables).",
+    )
+    p.add_argument(
+        "--alert-deadline-s",
+        type=float,
+        default=10.0,
+        help="At exit, wait at most this long for queued alerts to be sent (default: 10).",
+    )
+    p.add_argument(
+        "--time-budget",
+        metavar="SECONDS",
+        type=float,
+        default=None,
+        help="Only start a batch when it is predicted to finish within SECONDS of the run start; "
+        "the cursor is saved after every committed batch.",
+    )
+    p.add_argument(
+        "--refresh-tiers",
+        action="store_true",
+        help="Scheduler tick: refresh inventory for hot variations by tier (low stock, staff picks, recent, changed) "
+        "instead of paging the catalog.",
+    )
+    p.add_argument(
+        "--tier-intervals",
+        metavar="TIER=MIN,...",
+        default=None,
+        help="Override tier refresh intervals in minutes (default: "
+        + ",".join(f"{n}={m:g}" for n, m in REFRESH_TIER_INTERVALS_MIN)
+        + "; 0 = every tick).",
+    )
+    p.add_argument(
+        "--tier-state",
+        metavar="PATH",
+        default=os.path.join("scripts", "catalog_sync_tier_state.json"),
+        help="Where --refresh-tiers keeps per-tier last-run times and the API budget (default: scripts/catalog_sync_tier_state.json).",
+    )
+    p.add_argument(
+        "--category-state",
+        metavar="PATH",
+        default=os.path.join("scripts", "catalog_sync_category_state.json"),
+        help="Where the time of the last full category crawl is kept for --item-category-max-age-m "
+        "(default: scripts/catalog_sync_category_state.json).",
+    )
+    p.add_argument(
+        "--api-calls-per-minute",
+        type=int,
+        default=30,
+        help="Square API calls --refresh-tiers may make per minute, shared across ticks (default: 30).",
+    )
+    p.add_argument(
+        "--inventory-strategy",
+        choices=("auto", "ids", "snapshot"),
+        default="auto",
+        help="ids: counts per batch by variation id; snapshot: page through all counts at the location once "
+        "and zero rows missing from it; auto (default): snapshot when the run covers most of the products table.",
+    )
+    p.add_argument(
+        "--related-cache-size",
+        type=int,
+        default=10000,
+        help="How many related IMAGE ids/versions to remember per run, so repeats are not re-sent (default: 10000).",
+    )
+    p.add_argument(
+        "--json-codec",
+        choices=JSON_CODECS,
+        default="auto",
+        help="JSON codec for Square responses and SQL jsonb payloads (default: auto = orjson, msgspec, then stdlib).",
+    )
     p.add_argument("--timeout-s", type=int, default=30, help="HTTP timeout seconds")
     args = p.parse_args(argv)
 
-    token = _get_env("SQUARE_ACCESS_TOKEN")
-    if not token:
+    # With --targets each target names its own token/DSN env vars (see _target_config).
+    token = _get_env("SQUARE_ACCESS_TOKEN") or ""
+    if not token and not args.targets:
         raise SystemExit("Missing env var: SQUARE_ACCESS_TOKEN")
 
-    pg_dsn = _resolve_pg_dsn()
-    if not pg_dsn:
+    pg_dsn = _resolve_pg_dsn() or ""
+    if not pg_dsn and not args.targets:
         raise SystemExit("Missing Postgres DSN (set PG_DSN or SGR_DATABASE_URL/SPR_DATABASE_URL/DATABASE_URL)")
 
+    time_budget_s = max(1.0, float(args.time_budget)) if args.time_budget is not None else None
+    if args.max_pages is not None:
+        max_pages = max(1, int(args.max_pages))
+    else:
+        # Without an explicit page cap, a time budget runs until it (or the cursor) is exhausted.
+        max_pages = 1 if time_budget_s is None else UNBOUNDED_PAGES
+
     products_table = _ident(_get_env("PRODUCTS_TABLE") or "products")
     categories_table = _ident(_get_env("CATEGORIES_TABLE") or "categories")
     runs_table = _ident(_get_env("CATALOG_SYNC_RUNS_TABLE") or "catalog_sync_runs")
+    staff_picks_table = _ident(_get_env("STAFF_PICKS_TABLE") or "staff_picks")
+
+    intervals = dict(REFRESH_TIER_INTERVALS_MIN)
+    for part in (args.tier_intervals or "").split(","):
+        if not part.strip():
+            continue
+        name, _, minutes = part.partition("=")
+        name = name.strip()
+        if name not in intervals:
+            raise SystemExit(f"Unknown tier in --tier-intervals: {name!r} (tiers: {', '.join(intervals)})")
+        try:
+            intervals[name] = max(0.0, float(minutes))
+        except ValueError:
+            raise SystemExit(f"Invalid interval for tier {name!r}: {minutes!r}")
+
+    stages = frozenset(s.strip() for s in (args.stages or "").split(",") if s.strip())
+    unknown = sorted(stages - set(SYNC_STAGES))
+    if unknown or not stages:
+        raise SystemExit(f"Invalid --stages {args.stages!r} (stages: {', '.join(SYNC_STAGES)})")
+    if args.plan and (args.item_id or args.refresh_tiers or "products" not in stages):
+        raise SystemExit("--plan only applies to catalog runs with the products stage")
+    if args.serve and (args.item_id or args.targets or args.plan or args.refresh_tiers):
+        raise SystemExit("--serve cannot be combined with --item-id, --targets, --plan or --refresh-tiers")
+
+    location_ids = tuple(
+        s.strip() for s in (_get_env("SQUARE_LOCATION_ID") or "ATHC6TCDTCHWN").split(",") if s.strip()
+    )
 
     return Config(
         square_access_token=token,
         square_base_url=_resolve_square_base_url(),
         square_version=_get_env("SQUARE_VERSION") or "2025-10-16",
-        square_location_id=_get_env("SQUARE_LOCATION_ID") or "ATHC6TCDTCHWN",
+        square_location_id=location_ids[0],
+        square_location_ids=location_ids,
         pg_dsn=pg_dsn,
         state_path=os.path.abspath(args.state_path),
         products_table=products_table,
         categories_table=categories_table,
         catalog_sync_runs_table=runs_table,
+        staff_picks_table=staff_picks_table,
         dry_run=bool(args.dry_run),
-        max_pages=max(1, int(args.max_pages)),
+        plan=bool(args.plan),
+        max_pages=max_pages,
         upsert_batch_pages=max(1, int(args.upsert_batch_pages)),
         timeout_s=max(5, int(args.timeout_s)),
         item_id=(args.item_id.strip() if isinstance(args.item_id, str) and args.item_id.strip() else None),
         rebuild_albums_cache=bool(args.rebuild_albums_cache),
+        diff=not bool(args.no_diff),
+        fast_path=not bool(args.no_fast_path),
+        profile_dir=os.path.abspath(args.profile) if args.profile else None,
+        sql_timings_path=os.path.abspath(args.sql_timings) if args.sql_timings else None,
+        explain_threshold_ms=max(0.0, float(args.explain_threshold_ms)),
+        ensure_indexes=not bool(args.skip_indexes),
+        analyze_min_rows=max(0, int(args.analyze_min_rows)),
+        json_codec=str(args.json_codec),
+        dead_letter_path=os.path.abspath(args.dead_letter),
+        alert_state_path=os.path.abspath(args.alert_state),
+        alert_window_s=max(0.0, float(args.alert_window_min)) * 60.0,
+        alert_deadline_s=max(0.0, float(args.alert_deadline_s)),
+        related_cache_size=max(1, int(args.related_cache_size)),
+        time_budget_s=time_budget_s,
+        refresh_tiers=bool(args.refresh_tiers),
+        tier_state_path=os.path.abspath(args.tier_state),
+        category_state_path=os.path.abspath(args.category_state),
+        tier_intervals=tuple((name, intervals[name]) for name, _ in REFRESH_TIER_INTERVALS_MIN),
+        api_calls_per_minute=max(1, int(args.api_calls_per_minute)),
+        inventory_strategy=str(args.inventory_strategy),
+        snapshot_dir=os.path.abspath(args.snapshot_dir) if args.snapshot_dir else None,
+        stages=stages,
+        events_path=(args.events if args.events in (None, "-") else os.path.abspath(args.events)),
+        targets_path=os.path.abspath(args.targets) if args.targets else None,
+        run_batch_rows=not args.no_run_batch_rows,
+        run_batch_retention_days=max(0, int(args.run_batch_retention_days)),
+        run_retention_days=max(0, int(args.run_retention_days)),
+        item_category_max_age_s=max(0.0, float(args.item_category_max_age_m)) * 60.0,
+        daemon_socket=os.path.abspath(args.daemon_socket) if args.daemon_socket else None,
+        serve_socket=os.path.abspath(args.serve) if args.serve else None,
+        pg_pooler_dsn=_get_env("PG_POOLER_DSN"),
+        pg_pool_size=max(0, int(args.pg_pool_size)),
+        pg_recycle_batches=max(0, int(args.pg_recycle_batches)),
+        pg_recycle_s=max(0.0, float(args.pg_recycle_min)) * 60.0,
     )
 
 
-class SquareClient:
-    def __init__(self, cfg: Config):
-        self.cfg = cfg
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
-                "Authorization": f"Bearer {cfg.square_access_token}",
-                "Content-Type": "application/json",
-                "Square-Version": cfg.square_version,
-            }
-        )
+class RateLimiter:
+    """
+    Spaces out calls to at most per_second, across threads. With --targets, every SquareClient
+    using the same access token shares one (Square rate-limits per token, not per location).
+    """
 
-    def _request_json(self, method: str, path: str, *, json_body: Optional[dict] = None) -> dict:
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+@dataclass(frozen=True)
+class CatalogPage:
+    """
+    One page of catalog search results. cursor is the token the page was fetched with and
+    next_cursor the one that resumes after it (None on the last page), so a job can checkpoint
+    next_cursor and later pass it back to SquareClient.iter_catalog_pages.
+    """
+
+    objects: List[dict]
+    related_objects: List[dict]
+    cursor: Optional[str]
+    next_cursor: Optional[str]
+
+    def records(self) -> List["VariationRecord"]:
+        return _project_catalog_objects(self.objects)
+
+    def images(self) -> List["ImageRecord"]:
+        return _project_image_objects(self.related_objects)
+
+
+def _next_cursor(payload: dict) -> Optional[str]:
+    cursor = payload.get("cursor")
+    return cursor if isinstance(cursor, str) and cursor.strip() else None
+
+
+class _PageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _PrefetchStopped(BaseException):
+    """
+    Raised in a prefetch thread whose consumer is gone; a BaseException so that the retry
+    loops' `except Exception` does not retry it.
+    """
+
+
+def _iter_cursor_pages(
+    fetch: Callable[[Optional[str]], dict],
+    cursor: Optional[str] = None,
+    *,
+    prefetch: int = 0,
+    stop: Optional[threading.Event] = None,
+) -> Iterator[Tuple[Optional[str], dict, Optional[str]]]:
+    """
+    Follow Square's pagination cursor from cursor, yielding (cursor, payload, next_cursor) per page.
+    Pages are fetched only when the consumer asks for them. With prefetch > 0 a background thread
+    fetches ahead, holding at most prefetch pages; it stops when the generator is closed (or
+    garbage-collected) and its errors are raised in the consumer. fetch then runs on that thread:
+    give it a client of its own (SquareClient.prefetch_client) whose stop event is passed here,
+    so closing the generator also cuts short a retry backoff in progress.
+    """
+    if prefetch <= 0:
+        while True:
+            payload = fetch(cursor)
+            next_cursor = _next_cursor(payload)
+            yield cursor, payload, next_cursor
+            if not next_cursor:
+                return
+            cursor = next_cursor
+
+    ready: "queue.Queue[Any]" = queue.Queue(maxsize=prefetch)
+    stop = stop or threading.Event()
+    # The producer's events carry the consumer's target name; nothing else of _TARGET (the run
+    # history, connections) is shared with it.
+    target_name = getattr(_TARGET, "name", None)
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(page_cursor: Optional[str]) -> None:
+        if target_name:
+            _TARGET.name = target_name
+        try:
+            while not stop.is_set():
+                payload = fetch(page_cursor)
+                next_cursor = _next_cursor(payload)
+                if not put((page_cursor, payload, next_cursor)) or not next_cursor:
+                    return
+                page_cursor = next_cursor
+        except BaseException as e:
+            put(_PageError(e))
+
+    producer = threading.Thread(target=produce, args=(cursor,), name="square-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = ready.get()
+            if isinstance(item, _PageError):
+                raise item.error
+            yield item
+            if not item[2]:
+                return
+    finally:
+        stop.set()
+        producer.join()
+
+
+class SquareClient:
+    def __init__(self, cfg: Config, limiter: Optional[RateLimiter] = None):
+        self.cfg = cfg
+        self.limiter = limiter
+        # Request attempts, retried attempts and body bytes (run history metrics).
+        self.stats = {"calls": 0, "retries": 0, "bytes_sent": 0, "bytes_received": 0}
+        # Set on prefetch clients: ends their retries once the consumer is gone.
+        self.stop: Optional[threading.Event] = None
+        import requests
+
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Authorization": f"Bearer {cfg.square_access_token}",
+                "Content-Type": "application/json",
+                "Square-Version": cfg.square_version,
+            }
+        )
+
+    def prefetch_client(self) -> "SquareClient":
+        """
+        A client for a prefetch thread: same config and rate limiter, its own HTTP session and
+        stats (requests.Session is not thread-safe), and a stop event (see _iter_cursor_pages).
+        Fold its stats back with merge_stats once the thread is done.
+        """
+        client = SquareClient(self.cfg, self.limiter)
+        client.stop = threading.Event()
+        return client
+
+    def merge_stats(self, other: "SquareClient") -> None:
+        for k, v in other.stats.items():
+            self.stats[k] = self.stats.get(k, 0) + v
+
+    def _backoff(self, seconds: float) -> None:
+        """Sleep before a retry; a prefetch client whose consumer stopped gives up instead."""
+        if self.stop is None:
+            time.sleep(seconds)
+        elif self.stop.wait(seconds):
+            raise _PrefetchStopped()
+
+    def _request_json(self, method: str, path: str, *, json_body: Optional[dict] = None) -> dict:
         url = f"{self.cfg.square_base_url}{path}"
         # Basic retry on rate limit / transient errors.
         last_err: Optional[Exception] = None
         for attempt in range(1, 6):
             try:
-                resp = self.session.request(
-                    method,
-                    url,
-                    json=json_body,
-                    timeout=self.cfg.timeout_s,
-                )
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                data = _JSON_CODEC.dumps(json_body) if json_body is not None else None
+                self.stats["calls"] += 1
+                self.stats["bytes_sent"] += len(data or b"")
+                resp = self.session.request(method, url, data=data, timeout=self.cfg.timeout_s)
+                self.stats["bytes_received"] += len(resp.content or b"")
                 if resp.status_code in (429, 500, 502, 503, 504):
                     # exponential-ish backoff with cap
                     delay = min(10.0, 0.75 * (2 ** (attempt - 1)))
-                    time.sleep(delay)
+                    _emit(
+                        "square_retry",
+                        method=method,
+                        path=path,
+                        attempt=attempt,
+                        status=resp.status_code,
+                        delay_s=delay,
+                    )
+                    self.stats["retries"] += 1
+                    self._backoff(delay)
                     continue
                 resp.raise_for_status()
-                return resp.json()
+                return _json_loads(resp.content)
             except Exception as e:
                 last_err = e
-                time.sleep(min(5.0, 0.25 * attempt))
+                _emit("square_retry", method=method, path=path, attempt=attempt, error=_truncate(str(e), 300))
+                self.stats["retries"] += 1
+                self._backoff(min(5.0, 0.25 * attempt))
         raise RuntimeError(f"Square request failed after retries: {method} {path}: {last_err}") from last_err
 
     def catalog_search_items(self, *, cursor: Optional[str]) -> dict:
@@ -437,7 +1743,8 @@ class SquareClient:
         }
         if cursor:
             body["cursor"] = cursor
-        return self._request_json("POST", "/v2/catalog/search", json_body=body)
+        with _stage("fetch.catalog_search"):
+            return self._request_json("POST", "/v2/catalog/search", json_body=body)
 
     def catalog_list_categories(self, *, cursor: Optional[str]) -> dict:
         # List endpoint uses query string; easiest is to pass via params.
@@ -447,48 +1754,195 @@ class SquareClient:
             params["cursor"] = cursor
 
         last_err: Optional[Exception] = None
-        for attempt in range(1, 6):
-            try:
-                resp = self.session.get(url, params=params, timeout=self.cfg.timeout_s)
-                if resp.status_code in (429, 500, 502, 503, 504):
-                    delay = min(10.0, 0.75 * (2 ** (attempt - 1)))
-                    time.sleep(delay)
-                    continue
-                resp.raise_for_status()
-                return resp.json()
-            except Exception as e:
-                last_err = e
-                time.sleep(min(5.0, 0.25 * attempt))
+        with _stage("fetch.categories"):
+            for attempt in range(1, 6):
+                try:
+                    if self.limiter is not None:
+                        self.limiter.acquire()
+                    self.stats["calls"] += 1
+                    resp = self.session.get(url, params=params, timeout=self.cfg.timeout_s)
+                    self.stats["bytes_received"] += len(resp.content or b"")
+                    if resp.status_code in (429, 500, 502, 503, 504):
+                        delay = min(10.0, 0.75 * (2 ** (attempt - 1)))
+                        _emit(
+                            "square_retry",
+                            method="GET",
+                            path="/v2/catalog/list",
+                            attempt=attempt,
+                            status=resp.status_code,
+                            delay_s=delay,
+                        )
+                        self.stats["retries"] += 1
+                        self._backoff(delay)
+                        continue
+                    resp.raise_for_status()
+                    return _json_loads(resp.content)
+                except Exception as e:
+                    last_err = e
+                    _emit(
+                        "square_retry",
+                        method="GET",
+                        path="/v2/catalog/list",
+                        attempt=attempt,
+                        error=_truncate(str(e), 300),
+                    )
+                    self.stats["retries"] += 1
+                    self._backoff(min(5.0, 0.25 * attempt))
         raise RuntimeError(f"Square request failed after retries: GET /v2/catalog/list: {last_err}") from last_err
 
+    def catalog_changed_since(self, begin_time: str) -> bool:
+        """True when any catalog object the sync reads was created, updated or deleted after begin_time."""
+        body: Dict[str, Any] = {
+            "object_types": list(CATALOG_WATCHED_TYPES),
+            "begin_time": begin_time,
+            "include_deleted_objects": True,
+            "limit": 1,
+        }
+        with _stage("fetch.catalog_probe"):
+            return bool(self._request_json("POST", "/v2/catalog/search", json_body=body).get("objects"))
+
+    def catalog_search_images(self, *, cursor: Optional[str]) -> dict:
+        body: Dict[str, Any] = {"object_types": ["IMAGE"], "limit": 1000}
+        if cursor:
+            body["cursor"] = cursor
+        with _stage("fetch.images"):
+            return self._request_json("POST", "/v2/catalog/search", json_body=body)
+
     def _request_json_get(self, path: str, *, params: Optional[dict] = None) -> dict:
         url = f"{self.cfg.square_base_url}{path}"
         last_err: Optional[Exception] = None
         for attempt in range(1, 6):
             try:
+                if self.limiter is not None:
+                    self.limiter.acquire()
+                self.stats["calls"] += 1
                 resp = self.session.get(url, params=params, timeout=self.cfg.timeout_s)
+                self.stats["bytes_received"] += len(resp.content or b"")
                 if resp.status_code in (429, 500, 502, 503, 504):
                     delay = min(10.0, 0.75 * (2 ** (attempt - 1)))
-                    time.sleep(delay)
+                    _emit(
+                        "square_retry",
+                        method="GET",
+                        path=path,
+                        attempt=attempt,
+                        status=resp.status_code,
+                        delay_s=delay,
+                    )
+                    self.stats["retries"] += 1
+                    self._backoff(delay)
                     continue
                 resp.raise_for_status()
-                return resp.json()
+                return _json_loads(resp.content)
             except Exception as e:
                 last_err = e
-                time.sleep(min(5.0, 0.25 * attempt))
+                _emit("square_retry", method="GET", path=path, attempt=attempt, error=_truncate(str(e), 300))
+                self.stats["retries"] += 1
+                self._backoff(min(5.0, 0.25 * attempt))
         raise RuntimeError(f"Square request failed after retries: GET {path}: {last_err}") from last_err
 
     def catalog_get_object(self, object_id: str, *, include_related_objects: bool = True) -> dict:
         params = {"include_related_objects": "true" if include_related_objects else "false"}
-        return self._request_json_get(f"/v2/catalog/object/{object_id}", params=params)
-
-    def batch_inventory_counts(self, *, catalog_object_ids: List[str]) -> dict:
-        body = {
-            "catalog_object_ids": catalog_object_ids,
-            "location_ids": [self.cfg.square_location_id],
+        with _stage("fetch.catalog_object"):
+            return self._request_json_get(f"/v2/catalog/object/{object_id}", params=params)
+
+    def catalog_batch_retrieve(self, object_ids: List[str], *, include_related_objects: bool = True) -> dict:
+        body = {"object_ids": object_ids, "include_related_objects": include_related_objects}
+        with _stage("fetch.catalog_batch"):
+            return self._request_json("POST", "/v2/catalog/batch-retrieve", json_body=body)
+
+    def batch_inventory_counts(
+        self, *, catalog_object_ids: Optional[List[str]] = None, cursor: Optional[str] = None
+    ) -> dict:
+        # Without catalog_object_ids, Square pages through every count at the locations.
+        # All configured locations go into the same call.
+        body: Dict[str, Any] = {
+            "location_ids": list(self.cfg.square_location_ids),
             "states": ["IN_STOCK"],
         }
-        return self._request_json("POST", "/v2/inventory/counts/batch-retrieve", json_body=body)
+        if catalog_object_ids is not None:
+            body["catalog_object_ids"] = catalog_object_ids
+        if cursor:
+            body["cursor"] = cursor
+        with _stage("fetch.inventory_counts"):
+            return self._request_json("POST", "/v2/inventory/counts/batch-retrieve", json_body=body)
+
+    # Lazy iterators for jobs that read the catalog without the sync (exports, audits, reports).
+    # Each yields as pages arrive; only the current page (plus up to prefetch pages) is held.
+
+    def iter_catalog_pages(self, cursor: Optional[str] = None, *, prefetch: int = 0) -> Iterator[CatalogPage]:
+        """ITEM search pages (100 items each, with related objects) starting at cursor."""
+        client = self.prefetch_client() if prefetch > 0 else self
+        pages = _iter_cursor_pages(
+            lambda c: client.catalog_search_items(cursor=c), cursor, prefetch=prefetch, stop=client.stop
+        )
+        try:
+            for page_cursor, payload, next_cursor in pages:
+                yield CatalogPage(
+                    objects=payload.get("objects") or [],
+                    related_objects=payload.get("related_objects") or [],
+                    cursor=page_cursor,
+                    next_cursor=next_cursor,
+                )
+        finally:
+            if client is not self:
+                pages.close()
+                self.merge_stats(client)
+                client.session.close()
+
+    def iter_catalog_items(self, cursor: Optional[str] = None, *, prefetch: int = 0) -> Iterator[dict]:
+        """Raw ITEM objects. To resume mid-crawl, checkpoint CatalogPage.next_cursor instead."""
+        for page in self.iter_catalog_pages(cursor, prefetch=prefetch):
+            yield from page.objects
+
+    def iter_variation_records(
+        self, cursor: Optional[str] = None, *, prefetch: int = 0
+    ) -> Iterator["VariationRecord"]:
+        """Compact per-variation records (see _project_catalog_objects); raw objects are dropped per page."""
+        for page in self.iter_catalog_pages(cursor, prefetch=prefetch):
+            yield from page.records()
+
+    def iter_variation_rows(
+        self,
+        cursor: Optional[str] = None,
+        *,
+        categories: Optional["CategoryIndex"] = None,
+        prefetch: int = 0,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Flattened product rows as the sync writes them (see _project_variation_rows), with
+        image_url from each page's related IMAGE objects and, given a CategoryIndex, category
+        names and paths resolved.
+        """
+        for page in self.iter_catalog_pages(cursor, prefetch=prefetch):
+            yield from _project_variation_rows(page.records(), categories, page.images())
+
+    def iter_categories(self, cursor: Optional[str] = None) -> Iterator[dict]:
+        """Raw CATEGORY objects."""
+        for _, payload, _ in _iter_cursor_pages(lambda c: self.catalog_list_categories(cursor=c), cursor):
+            yield from payload.get("objects") or []
+
+    def iter_images(self, cursor: Optional[str] = None) -> Iterator[dict]:
+        """Raw IMAGE objects (1000 per page)."""
+        for _, payload, _ in _iter_cursor_pages(lambda c: self.catalog_search_images(cursor=c), cursor):
+            yield from payload.get("objects") or []
+
+    def iter_inventory_counts(self, variation_ids: Optional[List[str]] = None) -> Iterator[dict]:
+        """
+        IN_STOCK counts at the configured location(s): for the given variation ids (in chunks of
+        INVENTORY_IDS_PER_CALL), or every count when variation_ids is None. Follows the cursor in
+        both cases; with several locations one chunk can span more than one page.
+        """
+        chunks: List[Optional[List[str]]] = [None]
+        if variation_ids is not None:
+            step = INVENTORY_IDS_PER_CALL
+            chunks = [variation_ids[i : i + step] for i in range(0, len(variation_ids), step)]
+        for chunk in chunks:
+
+            def fetch(cursor: Optional[str], ids: Optional[List[str]] = chunk) -> dict:
+                return self.batch_inventory_counts(catalog_object_ids=ids, cursor=cursor)
+
+            for _, payload, _ in _iter_cursor_pages(fetch):
+                yield from payload.get("counts") or []
 
 
 def _is_retryable_db_error(err: Exception) -> bool:
@@ -521,9 +1975,23 @@ def _is_retryable_db_error(err: Exception) -> bool:
     return any(s in msg for s in retry_substrings)
 
 
+def _is_bisectable_db_error(err: Exception) -> bool:
+    """
+    Errors caused by what is in the batch rather than by the connection: data exceptions
+    (class 22, e.g. a bad ::bigint cast on price) and program limits (class 54). Splitting the
+    batch isolates the offending object, so these are bisected instead of retried as-is.
+    A statement timeout (57014) is not: it depends on load as much as on the rows, and a
+    dead-lettered object is skipped by the cursor, so it is retried (then raised) instead.
+    """
+    code = getattr(err, "sqlstate", None) or getattr(err, "pgcode", None)
+    if not isinstance(code, str):
+        return False
+    return code[:2] in ("22", "54")
+
+
 def _connect_pg(cfg: Config):
-    # Keep options minimal; Neon DSNs typically include sslmode=require already.
-    return psycopg.connect(cfg.pg_dsn, autocommit=False, connect_timeout=20)  # type: ignore
+    """A new connection (see PgConnections.open); Neon DSNs typically include sslmode=require already."""
+    return _pg_connections(cfg).open()
 
 
 def _safe_rollback(conn: Any) -> None:
@@ -541,99 +2009,256 @@ def _safe_close(conn: Any) -> None:
         pass
 
 
+# --pg-pool-size: DSN -> idle connections (with their creation time), shared by every thread.
+_PG_POOL: Dict[str, List[Tuple[Any, float]]] = {}
+_PG_POOL_LOCK = threading.Lock()
+
+
+class PgConnections:
+    """
+    The run's Postgres connections (_TARGET.pg, set by _dispatch). open() adds PG_CONNECT_OPTIONS
+    and times every connect: the run's first as its connect latency, later ones as reconnects.
+    Before each catalog batch, ready() replaces a connection that served --pg-recycle-batches
+    batches or is --pg-recycle-min minutes old, and pre-pings (SELECT 1) any other that was not
+    opened a moment ago, so a connection dropped while the sync waited on Square is replaced
+    before the batch instead of failing it. With --pg-pool-size, release() keeps healthy connections
+    for the next acquire() of the same DSN in this process.
+    """
+
+    def __init__(self, cfg: Config):
+        self.cfg = cfg
+        self.connect_ms: List[float] = []
+        self.reconnect_ms: List[float] = []
+        self.pings = 0
+        self.ping_failures = 0
+        self.recycled = 0
+        self.pool_hits = 0
+        # id(conn) -> (monotonic creation time, batches served)
+        self._conns: Dict[int, Tuple[float, int]] = {}
+        # With keep_last, release() holds the connection (and its creation time) for the next
+        # acquire() instead of pooling or closing it, until close().
+        self.keep_last = False
+        self._kept: Optional[Tuple[Any, float]] = None
+
+    def open(self, dsn: Optional[str] = None, **options: Any) -> Any:
+        _ensure_psycopg()
+        from psycopg.conninfo import conninfo_to_dict  # type: ignore
+
+        dsn = dsn or self.cfg.pg_dsn
+        in_dsn = conninfo_to_dict(dsn)
+        options = {**{k: v for k, v in PG_CONNECT_OPTIONS.items() if k not in in_dsn}, **options}
+        started = time.monotonic()
+        conn = psycopg.connect(dsn, autocommit=False, **options)
+        ms = round((time.monotonic() - started) * 1000.0, 1)
+        if self.connect_ms or self.pool_hits:
+            self.reconnect_ms.append(ms)
+            _emit("pg_reconnect", ms=ms)
+        else:
+            self.connect_ms.append(ms)
+        self._conns[id(conn)] = (time.monotonic(), 0)
+        return conn
+
+    def acquire(self) -> Any:
+        """The held connection (keep_last) or an idle pooled one that passes the pre-ping, else a new one."""
+        if self._kept is not None:
+            conn, born = self._kept
+            self._kept = None
+            if time.monotonic() - born < PG_FRESH_S or self.ping(conn):
+                self._conns[id(conn)] = (born, 0)
+                return conn
+            _safe_close(conn)
+        while self.cfg.pg_pool_size:
+            with _PG_POOL_LOCK:
+                idle = _PG_POOL.get(self.cfg.pg_dsn)
+                if not idle:
+                    break
+                conn, born = idle.pop()
+            if self._expired(born) or not self.ping(conn):
+                _safe_close(conn)
+                continue
+            self.pool_hits += 1
+            self._conns[id(conn)] = (born, 0)
+            return conn
+        return self.open()
+
+    def release(self, conn: Any) -> None:
+        """
+        Held for the next acquire() (keep_last), else back to the pool (--pg-pool-size), when
+        healthy and not due for recycling; otherwise closed.
+        """
+        born, _ = self._conns.pop(id(conn), (None, 0))
+        if born is None or self._expired(born) or not self._idle(conn):
+            _safe_close(conn)
+        elif self.keep_last:
+            previous, self._kept = self._kept, (conn, born)
+            if previous is not None:
+                self._pool(*previous)
+        else:
+            self._pool(conn, born)
+
+    def _pool(self, conn: Any, born: float) -> None:
+        if self.cfg.pg_pool_size:
+            with _PG_POOL_LOCK:
+                idle = _PG_POOL.setdefault(self.cfg.pg_dsn, [])
+                if len(idle) < self.cfg.pg_pool_size:
+                    idle.append((conn, born))
+                    return
+        _safe_close(conn)
+
+    def ready(self, conn: Any) -> Any:
+        """Before a batch: the connection to run it on (conn, or its replacement)."""
+        born, batches = self._conns.get(id(conn), (time.monotonic(), 0))
+        due = self._expired(born) or (self.cfg.pg_recycle_batches and batches >= self.cfg.pg_recycle_batches)
+        if batches and due:
+            self.recycled += 1
+            _emit("pg_recycle", batches=batches, age_s=round(time.monotonic() - born, 1))
+            conn = self.reconnect(conn)
+        elif time.monotonic() - born >= PG_FRESH_S and not self.ping(conn):
+            conn = self.reconnect(conn)
+        born, batches = self._conns.get(id(conn), (time.monotonic(), 0))
+        self._conns[id(conn)] = (born, batches + 1)
+        return conn
+
+    def close(self) -> None:
+        """Stop holding: the held connection goes to the pool or is closed."""
+        self.keep_last = False
+        if self._kept is not None:
+            conn, born = self._kept
+            self._kept = None
+            self._pool(conn, born)
+
+    def reconnect(self, conn: Any) -> Any:
+        self._conns.pop(id(conn), None)
+        _safe_close(conn)
+        return self.open()
+
+    def ping(self, conn: Any) -> bool:
+        self.pings += 1
+        try:
+            with conn.cursor() as cur:
+                _execute(cur, "pg_ping", "SELECT 1")
+            conn.rollback()
+            return True
+        except Exception as e:
+            self.ping_failures += 1
+            _emit("pg_ping_failed", error=_truncate(str(e), 300))
+            return False
+
+    def _expired(self, born: float) -> bool:
+        return bool(self.cfg.pg_recycle_s) and time.monotonic() - born >= self.cfg.pg_recycle_s
+
+    @staticmethod
+    def _idle(conn: Any) -> bool:
+        if conn.closed or getattr(conn, "broken", False):
+            return False
+        try:
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        def latency(ms: List[float]) -> Dict[str, Any]:
+            if not ms:
+                return {"count": 0}
+            return {"count": len(ms), "avg_ms": round(sum(ms) / len(ms), 1), "max_ms": max(ms)}
+
+        return {
+            "connect": latency(self.connect_ms),
+            "reconnect": latency(self.reconnect_ms),
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "recycled": self.recycled,
+            "pool_hits": self.pool_hits,
+            "pool_size": self.cfg.pg_pool_size,
+        }
+
+
+@atexit.register
+def _close_pg_pool() -> None:
+    with _PG_POOL_LOCK:
+        for idle in _PG_POOL.values():
+            for conn, _ in idle:
+                _safe_close(conn)
+        _PG_POOL.clear()
+
+
+def _pg_connections(cfg: Config) -> PgConnections:
+    """The run's PgConnections (a throwaway one outside _dispatch or for another database)."""
+    pg: Optional[PgConnections] = getattr(_TARGET, "pg", None)
+    return pg if pg is not None and pg.cfg.pg_dsn == cfg.pg_dsn else PgConnections(cfg)
+
+
+@contextlib.contextmanager
+def _savepoint(conn: Any, name: str) -> Iterator[None]:
+    """
+    Run a block inside SAVEPOINT name. On error, roll back to the savepoint (so the
+    surrounding transaction stays usable) and re-raise; on success, release it.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f"SAVEPOINT {_ident(name)}")
+    try:
+        yield
+    except Exception:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        except Exception:
+            pass
+        raise
+    with conn.cursor() as cur:
+        cur.execute(f"RELEASE SAVEPOINT {name}")
+
+
 UPSERT_PRODUCTS_SQL_TEMPLATE = """
 WITH payload AS (
   SELECT (%s)::jsonb AS j
 ),
-items AS (
-  SELECT i.*
+rows AS (
+  -- One element per ITEM_VARIATION, already projected client-side (see _project_variation_rows).
+  SELECT
+    r.square_variation_id,
+    r.square_item_id,
+    r.name,
+    r.variation_name,
+    r.description,
+    NULLIF(r.price_cents, '')::bigint AS price_cents,
+    r.category,
+    r.reporting_category,
+    r.all_categories,
+    r.square_image_id,
+    r.image_url,
+    0::int                            AS stock_count,
+    r.updated_at,
+    r.created_at,
+    now()                             AS synced_at,
+    r.category_path,
+    r.sync_fingerprint,
+    r.search_text,
+    -- Weighted for ts_rank: title > variation > categories > description.
+    setweight(to_tsvector('simple', coalesce(r.name, '')), 'A')
+      || setweight(to_tsvector('simple', coalesce(r.variation_name, '')), 'B')
+      || setweight(to_tsvector('simple', coalesce(array_to_string(r.category_path || r.all_categories, ' '), '')), 'C')
+      || setweight(to_tsvector('english', coalesce(r.description, '')), 'D') AS search_vector
   FROM payload p
-  CROSS JOIN LATERAL jsonb_array_elements(p.j) AS obj
-  CROSS JOIN LATERAL jsonb_to_record(obj) AS i(
-    type text,
-    id text,
-    image_id text,
-    is_deleted boolean,
+  CROSS JOIN LATERAL jsonb_to_recordset(p.j) AS r(
+    square_variation_id text,
+    square_item_id text,
+    name text,
+    variation_name text,
+    description text,
+    price_cents text,
+    category text,
+    reporting_category text,
+    all_categories text[],
+    square_image_id text,
+    image_url text,
     updated_at timestamptz,
     created_at timestamptz,
-    version bigint,
-    item_data jsonb
+    category_path text[],
+    sync_fingerprint text,
+    search_text text
   )
-  WHERE i.type = 'ITEM'
-),
-variations AS (
-  SELECT
-    it.id AS square_item_id,
-    -- Square frequently stores item images in item_data.image_ids (array) rather than top-level image_id.
-    COALESCE(
-      it.image_id,
-      NULLIF(it.item_data->'image_ids'->>0, '')
-    ) AS square_image_id,
-    it.is_deleted,
-    it.updated_at,
-    it.created_at,
-    it.item_data,
-    v.value AS variation_obj
-  FROM items it
-  CROSS JOIN LATERAL jsonb_array_elements(it.item_data->'variations') v(value)
-),
-rows AS (
-  SELECT
-    (variation_obj->>'id')::text                                          AS square_variation_id,
-    square_item_id                                                        AS square_item_id,
-    (item_data->>'name')::text                                            AS name,
-    (variation_obj->'item_variation_data'->>'name')::text                 AS variation_name,
-    NULLIF(
-      COALESCE(
-        item_data->>'description_plaintext',
-        item_data->>'description',
-        item_data->>'description_html'
-      ),
-      ''
-    )::text                                                               AS description,
-    NULLIF(variation_obj->'item_variation_data'->'price_money'->>'amount','')::bigint
-                                                                          AS price_cents,
-    COALESCE(
-      NULLIF(item_data->>'category_id', ''),
-      NULLIF(item_data->'reporting_category'->>'id', ''),
-      NULLIF(item_data->'categories'->0->>'id', '')
-    )                                                                     AS category,
-    COALESCE(
-      NULLIF(item_data->'reporting_category'->>'id', ''),
-      NULLIF(item_data->>'category_id', ''),
-      NULLIF(item_data->'categories'->0->>'id', '')
-    )                                                                     AS reporting_category,
-    COALESCE(
-      -- Preferred: Square supports multiple categories on item_data.categories[]
-      (
-        SELECT array_agg(NULLIF(c->>'id','')::text)
-        FROM jsonb_array_elements(item_data->'categories') AS c
-        WHERE NULLIF(c->>'id','') IS NOT NULL
-      )::text[],
-      -- Fallback: at least keep the reporting category so denormalization runs and we don't wipe existing data.
-      CASE
-        WHEN COALESCE(
-          NULLIF(item_data->'reporting_category'->>'id', ''),
-          NULLIF(item_data->>'category_id', ''),
-          NULLIF(item_data->'categories'->0->>'id', '')
-        ) IS NOT NULL
-        THEN ARRAY[
-          COALESCE(
-            NULLIF(item_data->'reporting_category'->>'id', ''),
-            NULLIF(item_data->>'category_id', ''),
-            NULLIF(item_data->'categories'->0->>'id', '')
-          )::text
-        ]::text[]
-        ELSE NULL::text[]
-      END
-    )                                                                     AS all_categories,
-    square_image_id                                                       AS square_image_id,
-    0::int                                                                AS stock_count,
-    updated_at                                                            AS updated_at,
-    created_at                                                            AS created_at,
-    now()                                                                 AS synced_at
-  FROM variations
-  WHERE variation_obj->>'type' = 'ITEM_VARIATION'
 ),
 upsert AS (
   INSERT INTO {products_table} (
@@ -647,10 +2272,11 @@ upsert AS (
     reporting_category,
     all_categories,
     square_image_id,
+    image_url,
     stock_count,
     updated_at,
     created_at,
-    synced_at
+    synced_at{extra_columns}
   )
   SELECT
     square_variation_id,
@@ -663,10 +2289,11 @@ upsert AS (
     reporting_category,
     all_categories,
     square_image_id,
+    image_url,
     stock_count,
     updated_at,
     created_at,
-    synced_at
+    synced_at{extra_columns}
   FROM rows
   WHERE square_variation_id IS NOT NULL
   ON CONFLICT (square_variation_id) DO UPDATE
@@ -680,11 +2307,13 @@ upsert AS (
     reporting_category = COALESCE(EXCLUDED.reporting_category, {products_table}.reporting_category),
     all_categories  = COALESCE(EXCLUDED.all_categories, {products_table}.all_categories),
     square_image_id = EXCLUDED.square_image_id,
+    -- NULL when the IMAGE object was not among the page's related objects; keep what we have.
+    image_url       = COALESCE(EXCLUDED.image_url, {products_table}.image_url),
     -- Never clobber inventory counts during catalog upserts.
     -- Inventory is refreshed via /v2/inventory/counts/batch-retrieve.
     stock_count     = {products_table}.stock_count,
     updated_at      = EXCLUDED.updated_at,
-    synced_at       = EXCLUDED.synced_at
+    synced_at       = EXCLUDED.synced_at{extra_updates}
   RETURNING (xmax = 0) AS inserted
 )
 SELECT
@@ -695,6 +2324,46 @@ FROM upsert;
 """.strip()
 
 
+SELECT_FINGERPRINTS_SQL_TEMPLATE = """
+SELECT
+  square_variation_id,
+  {fingerprint_column},
+  stock_count,
+  image_url
+FROM {products_table}
+WHERE square_variation_id = ANY(%s);
+""".strip()
+
+
+SELECT_PRODUCT_COLUMNS_SQL = """
+SELECT column_name
+FROM information_schema.columns
+WHERE table_schema = current_schema()
+  AND table_name = %s;
+""".strip()
+
+
+# Columns the sync maintains on top of the original products schema:
+# name -> (type, ON CONFLICT update expression). They are added on first run
+# (_ensure_products_columns) and the upsert only writes the ones that exist.
+OPTIONAL_PRODUCT_COLUMNS: Dict[str, Tuple[str, str]] = {
+    # Hash of the projected columns; drives the diff (see _project_variation_rows).
+    "sync_fingerprint": ("text", "EXCLUDED.sync_fingerprint"),
+    # Category names from the root down to the reporting category, e.g. {New Vinyl,Rock,Punk/Ska}.
+    "category_path": ("text[]", "COALESCE(EXCLUDED.category_path, {products_table}.category_path)"),
+    # Normalized name / variation / category text for trigram (ILIKE, similarity) search.
+    "search_text": ("text", "EXCLUDED.search_text"),
+    # Weighted full-text vector; only recomputed when the text it is built from changed.
+    "search_vector": (
+        "tsvector",
+        "CASE WHEN {products_table}.search_vector IS NULL"
+        " OR {products_table}.search_text IS DISTINCT FROM EXCLUDED.search_text"
+        " OR {products_table}.description IS DISTINCT FROM EXCLUDED.description"
+        " THEN EXCLUDED.search_vector ELSE {products_table}.search_vector END",
+    ),
+}
+
+
 SELECT_RECENT_VARIATION_IDS_SQL_TEMPLATE = """
 SELECT square_variation_id
 FROM {products_table}
@@ -752,7 +2421,7 @@ SET
 
 UPDATE_INVENTORY_SQL_TEMPLATE = """
 WITH payload AS (
-  SELECT NULLIF((%s), '')::jsonb AS j
+  SELECT (%s)::jsonb AS j
 ),
 inventory_counts AS (
   SELECT
@@ -777,25 +2446,327 @@ WHERE p.square_variation_id = ic.square_variation_id;
 
 UPDATE_IMAGES_SQL_TEMPLATE = """
 WITH payload AS (
-  SELECT NULLIF((%s), '')::jsonb AS j
+  SELECT (%s)::jsonb AS j
 ),
 image_mapping AS (
   SELECT
-    obj->>'id'                 AS image_id,
-    obj->'image_data'->>'url'  AS actual_url
+    obj->>'id'   AS image_id,
+    obj->>'url'  AS actual_url
   FROM payload
   CROSS JOIN LATERAL jsonb_array_elements(j) AS obj
-  WHERE obj->>'type' = 'IMAGE'
 )
 UPDATE {products_table} p
 SET
   image_url = im.actual_url,
   synced_at = now()
 FROM image_mapping im
-WHERE p.square_image_id = im.image_id;
+WHERE p.square_image_id = im.image_id
+  AND p.image_url IS DISTINCT FROM im.actual_url;
+""".strip()
+
+
+UPDATE_INVENTORY_SNAPSHOT_SQL_TEMPLATE = """
+WITH payload AS (
+  SELECT (%s)::jsonb AS j
+),
+snapshot AS (
+  SELECT
+    (c->>'catalog_object_id')::text                          AS square_variation_id,
+    GREATEST(COALESCE(NULLIF(c->>'quantity','')::int, 0), 0) AS quantity,
+    NULLIF(c->>'calculated_at','')::timestamptz              AS updated_at
+  FROM payload
+  CROSS JOIN LATERAL jsonb_array_elements(j) AS c
+),
+target AS (
+  -- Every product row; variations missing from the location snapshot have nothing in stock.
+  SELECT p.square_variation_id, COALESCE(s.quantity, 0) AS quantity, s.updated_at
+  FROM {products_table} p
+  LEFT JOIN snapshot s ON s.square_variation_id = p.square_variation_id
+  WHERE p.square_variation_id IS NOT NULL
+)
+UPDATE {products_table} p
+SET
+  stock_count = t.quantity,
+  updated_at  = COALESCE(t.updated_at, p.updated_at),
+  synced_at   = now()
+FROM target t
+WHERE p.square_variation_id = t.square_variation_id
+  AND p.stock_count IS DISTINCT FROM t.quantity;
+""".strip()
+
+
+COUNT_PRODUCTS_SQL_TEMPLATE = """
+SELECT count(*), count(DISTINCT square_item_id)
+FROM {products_table}
+WHERE square_variation_id IS NOT NULL;
+""".strip()
+
+
+# The products_api_cache body that populateAlbumsCache (api/albumsCache.js) builds, read straight
+# from the products table: the same albums_cache selection (album categories, no DVDs/videogames,
+# out-of-stock items hidden during their first week), order and Product shape. Params:
+# SNAPSHOT_ALBUM_CATEGORIES, SNAPSHOT_EXCLUDED_CATEGORIES.
+SNAPSHOT_PRODUCTS_SQL_TEMPLATE = """
+SELECT
+  square_variation_id,
+  name,
+  description,
+  price_cents,
+  category,
+  all_categories,
+  stock_count,
+  image_url,
+  to_json(created_at) #>> '{{}}' AS created_at
+FROM {products_table}
+WHERE square_variation_id IS NOT NULL
+  AND (
+    category = ANY(%s::text[])
+    OR 'New Vinyl' = ANY(all_categories)
+    OR 'Used Vinyl' = ANY(all_categories)
+    OR category IS NULL
+  )
+  AND (category IS NULL OR category != ALL(%s::text[]))
+  AND NOT ('DVD' = ANY(all_categories) OR 'DVDs' = ANY(all_categories) OR 'DVD''s' = ANY(all_categories))
+  AND NOT ('Videogames' = ANY(all_categories))
+  AND (stock_count > 0 OR (stock_count = 0 AND created_at < now() - interval '7 days'))
+ORDER BY created_at DESC NULLS LAST, square_variation_id ASC;
+""".strip()
+
+
+# --stages categories (without products): re-resolve category names for the whole table.
+# cats: every known category id -> name and path; renames: old name -> new name, for all_categories
+# (which only holds names once rows are written with a CategoryIndex).
+UPDATE_CATEGORY_REFS_SQL_TEMPLATE = """
+WITH payload AS (
+  SELECT (%s)::jsonb AS j
+),
+cats AS (
+  SELECT c.id, c.name, c.path
+  FROM payload
+  CROSS JOIN LATERAL jsonb_to_recordset(j->'categories') AS c(id text, name text, path text[])
+),
+renames AS (
+  SELECT DISTINCT ON (r.old_name) r.old_name, r.new_name
+  FROM payload
+  CROSS JOIN LATERAL jsonb_to_recordset(j->'renames') AS r(old_name text, new_name text)
+),
+target AS (
+  SELECT
+    p.square_variation_id,
+    COALESCE(c.name, p.category) AS category,{path_select}
+    (
+      SELECT array_agg(COALESCE(rn.new_name, u.name) ORDER BY u.ord)
+      FROM unnest(p.all_categories) WITH ORDINALITY AS u(name, ord)
+      LEFT JOIN renames rn ON rn.old_name = u.name
+    ) AS all_categories
+  FROM {products_table} p
+  LEFT JOIN cats c ON c.id = p.reporting_category
+)
+UPDATE {products_table} p
+SET
+  category       = t.category,
+  all_categories = t.all_categories,{path_set}
+  synced_at      = now()
+FROM target t
+WHERE p.square_variation_id = t.square_variation_id
+  AND (
+    p.category IS DISTINCT FROM t.category
+    OR p.all_categories IS DISTINCT FROM t.all_categories{path_where}
+  );
+""".strip()
+
+
+# --plan (read-only counterparts): rows the images UPDATE would touch, rows the location
+# snapshot would change, variations of fetched items that Square no longer returns, and the
+# average stored row size for the bytes estimate.
+SELECT_IMAGE_CHANGES_SQL_TEMPLATE = """
+WITH payload AS (
+  SELECT (%s)::jsonb AS j
+),
+image_mapping AS (
+  SELECT
+    obj->>'id'   AS image_id,
+    obj->>'url'  AS actual_url
+  FROM payload
+  CROSS JOIN LATERAL jsonb_array_elements(j) AS obj
+)
+SELECT p.square_variation_id, im.actual_url
+FROM {products_table} p
+JOIN image_mapping im ON p.square_image_id = im.image_id
+WHERE p.image_url IS DISTINCT FROM im.actual_url;
+""".strip()
+
+
+COUNT_INVENTORY_SNAPSHOT_CHANGES_SQL_TEMPLATE = """
+WITH payload AS (
+  SELECT (%s)::jsonb AS j
+),
+snapshot AS (
+  SELECT
+    (c->>'catalog_object_id')::text                          AS square_variation_id,
+    GREATEST(COALESCE(NULLIF(c->>'quantity','')::int, 0), 0) AS quantity
+  FROM payload
+  CROSS JOIN LATERAL jsonb_array_elements(j) AS c
+)
+SELECT count(*)
+FROM {products_table} p
+LEFT JOIN snapshot s ON s.square_variation_id = p.square_variation_id
+WHERE p.square_variation_id IS NOT NULL
+  AND p.stock_count IS DISTINCT FROM COALESCE(s.quantity, 0);
+""".strip()
+
+
+COUNT_STALE_VARIATIONS_SQL_TEMPLATE = """
+SELECT count(*)
+FROM {products_table}
+WHERE square_item_id = ANY(%s)
+  AND NOT (square_variation_id = ANY(%s));
+""".strip()
+
+
+AVG_PRODUCT_ROW_BYTES_SQL_TEMPLATE = """
+SELECT COALESCE(avg(pg_column_size(p.*)), 0)::int
+FROM (SELECT * FROM {products_table} LIMIT 1000) p;
 """.strip()
 
 
+SELECT_CATEGORY_INDEX_SQL_TEMPLATE = """
+SELECT square_category_id, name, parent_square_category_id
+FROM {categories_table}
+WHERE COALESCE(is_deleted, false) = false;
+""".strip()
+
+
+# --refresh-tiers: variations per tier, each query returning square_variation_id, square_item_id, stock_count.
+# Tiers run in REFRESH_TIER_INTERVALS_MIN order, so the API budget goes to earlier tiers first.
+REFRESH_TIER_SQL_TEMPLATES: Dict[str, str] = {
+    # Few left: the rows most likely to oversell.
+    "low_stock": """
+SELECT square_variation_id, square_item_id, stock_count
+FROM {products_table}
+WHERE stock_count BETWEEN 1 AND %(low_stock)s
+ORDER BY stock_count, synced_at NULLS FIRST
+LIMIT %(limit)s;
+""".strip(),
+    "staff_picks": """
+SELECT DISTINCT ON (p.square_variation_id) p.square_variation_id, p.square_item_id, p.stock_count
+FROM {staff_picks_table} sp
+JOIN {products_table} p
+  ON p.square_variation_id = sp.square_variation_id
+  OR (sp.square_variation_id IS NULL AND p.square_item_id = sp.square_item_id)
+ORDER BY p.square_variation_id
+LIMIT %(limit)s;
+""".strip(),
+    "recent": """
+SELECT square_variation_id, square_item_id, stock_count
+FROM {products_table}
+WHERE created_at >= now() - %(recent_days)s * interval '1 day'
+ORDER BY created_at DESC
+LIMIT %(limit)s;
+""".strip(),
+    # updated_at also moves when Square recalculates inventory, so this includes recent stock movement.
+    "changed": """
+SELECT square_variation_id, square_item_id, stock_count
+FROM {products_table}
+WHERE updated_at >= now() - %(changed_hours)s * interval '1 hour'
+ORDER BY updated_at DESC
+LIMIT %(limit)s;
+""".strip(),
+}
+
+REFRESH_TIER_INTERVALS_MIN: Tuple[Tuple[str, float], ...] = (
+    ("low_stock", 2.0),
+    ("staff_picks", 5.0),
+    ("recent", 15.0),
+    ("changed", 30.0),
+)
+REFRESH_TIER_PARAMS = {"low_stock": 3, "recent_days": 30, "changed_hours": 48, "limit": 1000}
+
+# Square limits per request.
+INVENTORY_IDS_PER_CALL = 1000
+CATALOG_IDS_PER_CALL = 100
+CATALOG_ITEMS_PER_PAGE = 100
+
+# --stages: products drives the catalog crawl and the other stages run per batch; without it,
+# each selected stage runs its whole-table repair path instead (see _run_targeted_stages).
+SYNC_STAGES = ("categories", "products", "inventory", "images", "run_log")
+
+# No-op fast path: a catalog pass that finishes records its start time (minus the skew, for
+# clock differences with Square) as the watermark; while nothing of these types changed after
+# the watermark, runs skip the crawl and only refresh inventory.
+CATALOG_WATCHED_TYPES = ("ITEM", "ITEM_VARIATION", "CATEGORY", "IMAGE")
+CATALOG_WATERMARK_SKEW_S = 300
+
+# --targets defaults: targets synced at once, and Square calls per second per access token.
+TARGET_MAX_CONCURRENCY = 2
+TARGET_REQUESTS_PER_SECOND = 10.0
+TARGET_TABLE_KEYS = ("products_table", "categories_table", "catalog_sync_runs_table", "staff_picks_table")
+TARGET_NAME_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+
+# --serve / --daemon-socket: how long a client waits for the daemon, and the largest request line.
+DAEMON_CONNECT_TIMEOUT_S = 1.0
+DAEMON_REPLY_TIMEOUT_S = 300.0
+DAEMON_MAX_REQUEST_BYTES = 1 << 20
+# A warm connection idle for longer is pinged before reuse (Neon closes idle connections when
+# its compute scales to zero). PG_POOLER_DSN gets this long to connect before PG_DSN is used.
+WARM_PING_AFTER_S = 30.0
+PG_POOLER_CONNECT_TIMEOUT_S = 2
+
+# A connection opened less than PG_FRESH_S ago is not pre-pinged before a batch.
+PG_FRESH_S = 1.0
+
+# libpq options for every sync connection (a value set in the DSN wins). TCP keepalives (probe
+# after 30 s idle, every 10 s, give up after 3) keep a connection that waits on Square from being
+# dropped silently by NAT / load balancers, and turn a dead peer into an error within a minute.
+PG_CONNECT_OPTIONS: Dict[str, Any] = {
+    "connect_timeout": 20,
+    "keepalives": 1,
+    "keepalives_idle": 30,
+    "keepalives_interval": 10,
+    "keepalives_count": 3,
+}
+
+# --inventory-strategy auto: take a location snapshot when a run is expected to cover at least
+# this fraction of the products table.
+INVENTORY_SNAPSHOT_FRACTION = 0.5
+
+# --max-pages of a --time-budget run without an explicit --max-pages: the budget decides.
+UNBOUNDED_PAGES = 1_000_000
+
+# run_log: batch rows older than RUN_BATCH_RETENTION_DAYS are rolled up into their run row, and
+# run rows older than RUN_RETENTION_DAYS are deleted. `report`: a run is a regression when a
+# metric is RUN_REPORT_REGRESSION_PCT worse than the median of the runs before it.
+RUN_BATCH_RETENTION_DAYS = 14
+RUN_RETENTION_DAYS = 90
+RUN_REPORT_REGRESSION_PCT = 25.0
+
+# --snapshot-dir: manifest name, how many versions stay on disk (clients may still hold the
+# previous manifest), and compression levels (brotli 11 is too slow for the cron window).
+SNAPSHOT_MANIFEST_NAME = "catalog-manifest.json"
+SNAPSHOT_KEEP_VERSIONS = 3
+SNAPSHOT_GZIP_LEVEL = 9
+SNAPSHOT_BROTLI_QUALITY = 9
+# albumCategories / excludeCategories of populateAlbumsCache in api/albumsCache.js; keep in step.
+SNAPSHOT_ALBUM_CATEGORIES = (
+    "New Vinyl", "Used Vinyl", "33New", "33Used", "45",
+    "Rock", "Jazz", "Blues", "Country", "Folk", "Electronic", "Funk/Soul",
+    "Indie", "Industrial", "Metal", "Pop", "Punk/Ska", "Rap/Hip-Hop",
+    "Reggae", "Singer Songwriter", "Soundtracks", "Bluegrass",
+    "Compilations", "Other",
+)
+SNAPSHOT_EXCLUDED_CATEGORIES = (
+    "DVD's", "DVDs", "Videogames", "VHS", "CD's", "CDs", "Cassettes",
+    "Food", "Drinks", "Jewelry", "Equipment", "T-Shirts", "Tote Bag",
+    "Candles", "Animals (Minis)", "Spin Clean", "Sticker", "Action Figures",
+    "Funko Pop", "Adapters", "Buttons", "Coasters", "Coffee Mug", "Crates",
+    "Guitar picks", "Hats", "Patches", "Pin", "Poster", "Sleeves",
+    "Slip Mat", "Wallets", "Wristband", "Book", "Boombox", "Bowl",
+    "Box Set", "Incense", "Charms", "Sprouts", "Lava Lamps",
+    "Essential Oils", "Puzzle", "Record Store Day", "Miscellaneous",
+    "Reel To Reel", "Vinyl Styl", "ABL",
+)
+
+
 UPDATE_CATEGORY_NAMES_REPORTING_SQL_TEMPLATE = """
 UPDATE {products_table} p
 SET
@@ -854,139 +2825,283 @@ VALUES (%s, %s, %s);
 """.strip()
 
 
-def _ensure_psycopg() -> None:
-    if psycopg is None:  # pragma: no cover
-        raise SystemExit(
-            "Missing dependency: psycopg. Install with:\n"
-            "  pip install 'psycopg[binary]'\n"
-            f"Original import error: {_PSYCOPG_IMPORT_ERROR}"
-        )
+# Run history columns added to CATALOG_SYNC_RUNS_TABLE next to the original counters
+# (_ensure_run_columns); rows written before they existed keep kind NULL.
+OPTIONAL_RUN_COLUMNS: Dict[str, str] = {
+    "run_id": "text",
+    # 'run' (one per run, aggregated metrics) or 'batch' (one per catalog batch).
+    "kind": "text",
+    "batch_no": "int",
+    "mode": "text",
+    "status": "text",
+    "started_at": "timestamptz",
+    "finished_at": "timestamptz",
+    "metrics": "jsonb",
+}
 
 
-def _sync_one_page(
-    cfg: Config,
-    sq: SquareClient,
-    *,
-    cursor: Optional[str],
-    conn: Any,
-) -> Tuple[Optional[str], Dict[str, int], int, int, bool]:
-    """
-    Returns:
-      new_cursor, upsert_counts, inventory_updated_rows, images_updated_rows, category_denorm_ran
-    """
-    payload = sq.catalog_search_items(cursor=cursor)
-    objects = payload.get("objects") or []
-    related_objects = payload.get("related_objects") or []
-    new_cursor = payload.get("cursor")
+INSERT_RUN_HISTORY_SQL_TEMPLATE = """
+INSERT INTO {runs_table} (
+  inserted_count,
+  updated_count,
+  total_upserted,
+  run_id,
+  kind,
+  batch_no,
+  mode,
+  status,
+  started_at,
+  finished_at,
+  metrics
+)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+""".strip()
 
-    upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0}
-    inventory_updated = 0
-    images_updated = 0
-    category_denorm_ran = False
 
-    if cfg.dry_run:
-        return new_cursor, upsert_counts, inventory_updated, images_updated, category_denorm_ran
+# Batch rows past retention are deleted; their run row keeps how many there were and the
+# median / slowest batch time.
+PRUNE_RUNS_SQL_TEMPLATE = """
+DELETE FROM {runs_table}
+WHERE kind IN ('run', 'batch')
+  AND started_at < now() - make_interval(days => %s);
+""".strip()
 
-    # Upsert products (from objects)
-    upsert_sql = UPSERT_PRODUCTS_SQL_TEMPLATE.format(products_table=cfg.products_table)
-    with conn.cursor() as cur:
-        cur.execute(upsert_sql, (json.dumps(objects),))
-        row = cur.fetchone()
-        if row:
-            # psycopg returns a tuple; order matches SELECT
-            upsert_counts = {
-                "inserted_count": int(row[0] or 0),
-                "updated_count": int(row[1] or 0),
-                "total_upserted": int(row[2] or 0),
-            }
 
-    # Best-effort run log insert (catalog_sync_runs)
-    try:
-        run_sql = INSERT_RUN_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
-        with conn.cursor() as cur:
-            cur.execute(
-                run_sql,
-                (
-                    upsert_counts["inserted_count"],
-                    upsert_counts["updated_count"],
-                    upsert_counts["total_upserted"],
-                ),
-            )
-    except Exception:
-        # Table may not exist; keep going.
-        pass
+ROLLUP_RUN_BATCHES_SQL_TEMPLATE = """
+WITH old AS (
+  DELETE FROM {runs_table}
+  WHERE kind = 'batch'
+    AND started_at < now() - make_interval(days => %s)
+  RETURNING run_id, metrics
+),
+rollup AS (
+  SELECT
+    run_id,
+    count(*)                                                                   AS batches,
+    percentile_cont(0.5) WITHIN GROUP (ORDER BY (metrics->>'seconds')::float8) AS p50_s,
+    max((metrics->>'seconds')::float8)                                         AS max_s
+  FROM old
+  GROUP BY run_id
+)
+UPDATE {runs_table} r
+SET metrics = COALESCE(r.metrics, '{{}}'::jsonb) || jsonb_build_object(
+  'batch_rows_rolled_up', rollup.batches,
+  'batch_seconds_p50',    round(rollup.p50_s::numeric, 3),
+  'batch_seconds_max',    round(rollup.max_s::numeric, 3)
+)
+FROM rollup
+WHERE r.kind = 'run'
+  AND r.run_id = rollup.run_id;
+""".strip()
 
-    # Inventory counts refresh for recent variations
-    variation_ids = _extract_variation_ids_from_items(objects)
-    if not variation_ids:
-        # Fallback: mirror original blueprint behavior (last 1000 rows by synced_at)
-        try:
-            ids_sql = SELECT_RECENT_VARIATION_IDS_SQL_TEMPLATE.format(products_table=cfg.products_table)
-            with conn.cursor() as cur:
-                cur.execute(ids_sql)
-                variation_ids = [r[0] for r in (cur.fetchall() or []) if r and r[0]]
-        except Exception:
-            variation_ids = []
 
-    if variation_ids:
-        inventory_updated = _refresh_inventory_counts_for_variations(cfg, sq, conn, variation_ids)
+SELECT_RUN_HISTORY_SQL_TEMPLATE = """
+SELECT run_id, mode, status, started_at, inserted_count, updated_count, metrics
+FROM {runs_table}
+WHERE kind = 'run'
+  AND (%s::text IS NULL OR mode = %s)
+ORDER BY started_at DESC
+LIMIT %s;
+""".strip()
 
-    # Images refresh from related_objects
-    if related_objects:
-        img_sql = UPDATE_IMAGES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+
+SELECT_PRODUCTS_INDEXES_SQL = """
+SELECT c.relname, i.indisvalid, i.indisready
+FROM pg_index i
+JOIN pg_class c ON c.oid = i.indexrelid
+WHERE i.indrelid = to_regclass(%s);
+""".strip()
+
+
+def _products_index_specs(products_table: str) -> List[Tuple[str, str]]:
+    """
+    (index name, definition) for the indexes the sync's own statements rely on:
+    - square_image_id: UPDATE_IMAGES_SQL_TEMPLATE join (docs/catalog-sync-database.md)
+    - synced_at: SELECT_RECENT_VARIATION_IDS_SQL_TEMPLATE ORDER BY synced_at DESC LIMIT 1000
+    - square_item_id: per-item lookups (single-item sync, stale variation checks)
+    - all_categories (GIN): category filters on the text[] column
+    - category_path[1]: storefront filters on the top-level category
+    - search_vector (GIN): full-text search (search_vector @@ websearch_to_tsquery(...))
+    - search_text (GIN, gin_trgm_ops): substring / fuzzy search; needs the pg_trgm extension
+    """
+    t = products_table
+    return [
+        (f"idx_{t}_square_image_id", f"ON {t} (square_image_id) WHERE square_image_id IS NOT NULL"),
+        (f"idx_{t}_synced_at", f"ON {t} (synced_at DESC)"),
+        (f"idx_{t}_square_item_id", f"ON {t} (square_item_id)"),
+        (f"idx_{t}_all_categories", f"ON {t} USING gin (all_categories)"),
+        (f"idx_{t}_category_root", f"ON {t} ((category_path[1]))"),
+        (f"idx_{t}_search_vector", f"ON {t} USING gin (search_vector)"),
+        (f"idx_{t}_search_text_trgm", f"ON {t} USING gin (search_text gin_trgm_ops)"),
+    ]
+
+
+def _ensure_products_indexes(cfg: Config, conn: Any) -> Dict[str, str]:
+    """
+    Check the indexes from _products_index_specs and create missing ones with
+    CREATE INDEX CONCURRENTLY (no write lock on products). Invalid indexes, left behind by an
+    interrupted concurrent build, are dropped and rebuilt the same way.
+
+    CONCURRENTLY cannot run inside a transaction, so the connection is switched to
+    autocommit for the duration; it must be idle (nothing uncommitted) when called.
+
+    Returns {index name: status}; status is one of ok, created, rebuilt, or
+    "missing: <error>" / "invalid: <error>" when the DDL failed. Never raises.
+    """
+    status: Dict[str, str] = {}
+    specs = _products_index_specs(cfg.products_table)
+    try:
+        conn.autocommit = True
+    except Exception as e:
+        return {name: f"unchecked: {e}" for name, _ in specs}
+
+    try:
         with conn.cursor() as cur:
-            cur.execute(img_sql, (json.dumps(related_objects),))
-            images_updated = cur.rowcount or 0
+            _execute(cur, "select_products_indexes", SELECT_PRODUCTS_INDEXES_SQL, (cfg.products_table,))
+            existing = {r[0]: bool(r[1]) and bool(r[2]) for r in (cur.fetchall() or [])}
 
-    # Best-effort category denormalization (two variants: reporting_category, fallback to category)
+            for name, definition in specs:
+                if existing.get(name):
+                    status[name] = "ok"
+                    continue
+                invalid = name in existing
+                try:
+                    if "gin_trgm_ops" in definition:
+                        _execute(cur, "create_extension", "CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                    if invalid:
+                        _execute(cur, "drop_invalid_index", f"DROP INDEX CONCURRENTLY IF EXISTS {_ident(name)}")
+                    _execute(cur, "create_index", f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_ident(name)} {definition}")
+                    status[name] = "rebuilt" if invalid else "created"
+                except Exception as e:
+                    status[name] = f"{'invalid' if invalid else 'missing'}: {_truncate(str(e), 300)}"
+    except Exception as e:
+        for name, _ in specs:
+            status.setdefault(name, f"unchecked: {_truncate(str(e), 300)}")
+    finally:
+        try:
+            conn.autocommit = False
+        except Exception:
+            pass
+    return status
+
+
+def _analyze_products(cfg: Config, conn: Any) -> bool:
+    """Refresh planner statistics after a large load. Best-effort."""
     try:
-        cat_sql = UPDATE_CATEGORY_NAMES_REPORTING_SQL_TEMPLATE.format(
-            products_table=cfg.products_table,
-            categories_table=cfg.categories_table,
-        )
         with conn.cursor() as cur:
-            cur.execute(cat_sql)
-        category_denorm_ran = True
+            _execute(cur, "analyze_products", f"ANALYZE {cfg.products_table}")
+        conn.commit()
+        return True
     except Exception:
+        _safe_rollback(conn)
+        return False
+
+
+def _ensure_psycopg() -> None:
+    global psycopg, _Jsonb, _PSYCOPG_IMPORT_ERROR
+    if psycopg is None and _PSYCOPG_IMPORT_ERROR is None:
         try:
-            cat_sql = UPDATE_CATEGORY_NAMES_FALLBACK_SQL_TEMPLATE.format(
-                products_table=cfg.products_table,
-                categories_table=cfg.categories_table,
-            )
-            with conn.cursor() as cur:
-                cur.execute(cat_sql)
-            category_denorm_ran = True
-        except Exception:
-            category_denorm_ran = False
+            import psycopg as _psycopg  # type: ignore
+            from psycopg.types.json import Jsonb  # type: ignore
+        except Exception as e:  # pragma: no cover
+            _PSYCOPG_IMPORT_ERROR = e
+        else:
+            psycopg, _Jsonb = _psycopg, Jsonb
+    if psycopg is None:  # pragma: no cover
+        raise SystemExit(
+            "Missing dependency: psycopg. Install with:\n"
+            "  pip install 'psycopg[binary]'\n"
+            f"Original import error: {_PSYCOPG_IMPORT_ERROR}"
+        )
 
+
+def _sync_one_page(
+    cfg: Config,
+    sq: SquareClient,
+    *,
+    cursor: Optional[str],
+    conn: Any,
+) -> Tuple[Optional[str], Dict[str, int], int, int, bool]:
+    """
+    Returns:
+      new_cursor, upsert_counts, inventory_updated_rows, images_updated_rows, category_denorm_ran
+    """
+    objects, related_objects, new_cursor = _fetch_catalog_page(sq, cursor=cursor)
+    upsert_counts, inventory_updated, images_updated, category_denorm_ran = _apply_catalog_batch(
+        cfg,
+        sq,
+        records=_project_catalog_objects(objects),
+        images=_project_image_objects(related_objects),
+        conn=conn,
+    )
     return new_cursor, upsert_counts, inventory_updated, images_updated, category_denorm_ran
 
 
 def _fetch_catalog_page(sq: SquareClient, *, cursor: Optional[str]) -> Tuple[List[dict], List[dict], Optional[str]]:
-    payload = sq.catalog_search_items(cursor=cursor)
-    objects = payload.get("objects") or []
-    related_objects = payload.get("related_objects") or []
-    new_cursor = payload.get("cursor")
-    new_cursor = new_cursor if isinstance(new_cursor, str) and new_cursor.strip() else None
-    return objects, related_objects, new_cursor
+    page = next(sq.iter_catalog_pages(cursor))
+    return page.objects, page.related_objects, page.next_cursor
+
+
+def _fetch_catalog_batch(
+    sq: SquareClient, *, cursor: Optional[str], max_pages: int, batch_no: int = 0, position: int = 0
+) -> Tuple[List[VariationRecord], List[ImageRecord], int, Optional[str]]:
+    """
+    Fetch up to max_pages catalog pages from cursor. Pages are projected as soon as they arrive;
+    only the compact records are kept. Every page repeats shared IMAGE objects; one per id is
+    kept (last wins). Returns (records, images, pages fetched, next cursor).
+    """
+    records: List[VariationRecord] = []
+    images_by_id: Dict[str, ImageRecord] = {}
+    pages = 0
+    for page in sq.iter_catalog_pages(cursor):
+        page_records = page.records()
+        records.extend(page_records)
+        _emit(
+            "page",
+            batch=batch_no,
+            page=pages + 1,
+            position=position + pages + 1,
+            objects=len(page.objects),
+            variations=len(page_records),
+            last=not page.next_cursor,
+        )
+        for im in page.images():
+            images_by_id.pop(im.image_id, None)
+            images_by_id[im.image_id] = im
+        del page_records
+        pages += 1
+        cursor = page.next_cursor
+        if not cursor or pages >= max_pages:
+            break
+    return records, list(images_by_id.values()), pages, cursor
 
 
 def _apply_catalog_batch(
     cfg: Config,
     sq: SquareClient,
     *,
-    objects: List[dict],
-    related_objects: List[dict],
+    records: List[VariationRecord],
+    images: List[ImageRecord],
     conn: Any,
+    columns: FrozenSet[str] = frozenset(),
+    categories: Optional[CategoryIndex] = None,
+    image_cache: Optional[RelatedObjectCache] = None,
+    inventory_snapshot: Optional[Dict[str, dict]] = None,
 ) -> Tuple[Dict[str, int], int, int, bool]:
     """
-    Apply one DB batch for the given catalog objects/related_objects.
+    Apply one DB batch for the given variation records and images (see _project_catalog_objects).
+    With an inventory_snapshot, stock comes from it instead of per-batch Square calls.
+    columns: optional products columns that exist (see _ensure_products_columns).
+    With sync_fingerprint present and cfg.diff, only new or changed variations are upserted,
+    and inventory writes are limited to rows whose stock differs.
+    Rows in the batch get image_url from the upsert; the images UPDATE only covers other rows
+    sharing an image, and with an image_cache only images new or changed in this run are sent.
+    With a CategoryIndex, category names/paths are resolved client-side and the per-row SQL
+    denormalization is skipped.
+    Steps not in cfg.stages (products, run_log, inventory, images, categories) are skipped.
     Returns: upsert_counts, inventory_updated_rows, images_updated_rows, category_denorm_ran
     """
-    # Reuse the existing logic by temporarily calling the same SQL pieces as _sync_one_page,
-    # but without re-fetching from Square.
-
-    upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0}
+    upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0, "unchanged_count": 0}
     inventory_updated = 0
     images_updated = 0
     category_denorm_ran = False
@@ -994,64 +3109,97 @@ def _apply_catalog_batch(
     if cfg.dry_run:
         return upsert_counts, inventory_updated, images_updated, category_denorm_ran
 
-    # Upsert products
-    upsert_sql = UPSERT_PRODUCTS_SQL_TEMPLATE.format(products_table=cfg.products_table)
-    with conn.cursor() as cur:
-        cur.execute(upsert_sql, (json.dumps(objects),))
-        row = cur.fetchone()
-        if row:
-            upsert_counts = {
-                "inserted_count": int(row[0] or 0),
-                "updated_count": int(row[1] or 0),
-                "total_upserted": int(row[2] or 0),
-            }
+    rows = _project_variation_rows(records, categories, images)
 
-    # Best-effort run log insert
-    try:
-        run_sql = INSERT_RUN_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+    # Diff against what Postgres already has so unchanged variations skip every write below.
+    known: Optional[Dict[str, KnownRow]] = None
+    if "sync_fingerprint" in columns and cfg.diff and rows:
+        known = _load_known_rows(cfg, conn, [r["square_variation_id"] for r in rows])
+    changed_rows = rows if known is None else _changed_rows(rows, known)
+    upsert_counts["unchanged_count"] = len(rows) - len(changed_rows)
+
+    # Upsert products
+    if changed_rows and "products" in cfg.stages:
+        upsert_sql = _upsert_products_sql(cfg, columns=columns)
         with conn.cursor() as cur:
-            cur.execute(
-                run_sql,
-                (
-                    upsert_counts["inserted_count"],
-                    upsert_counts["updated_count"],
-                    upsert_counts["total_upserted"],
-                ),
-            )
-    except Exception:
-        pass
+            _execute(cur, "upsert_products", upsert_sql, (_json_param(changed_rows),))
+            row = cur.fetchone()
+            if row:
+                upsert_counts.update(
+                    {
+                        "inserted_count": int(row[0] or 0),
+                        "updated_count": int(row[1] or 0),
+                        "total_upserted": int(row[2] or 0),
+                    }
+                )
+
+    # Best-effort run log insert (savepoint so a missing runs table does not abort the batch).
+    # With the run history columns the catalog loop writes a kind='batch' row instead.
+    history: Optional[RunHistory] = getattr(_TARGET, "history", None)
+    if "run_log" in cfg.stages and not (history is not None and history.batch_rows()):
+        try:
+            run_sql = INSERT_RUN_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+            with _savepoint(conn, "catalog_sync_run_log"), conn.cursor() as cur:
+                _execute(
+                    cur,
+                    "insert_run",
+                    run_sql,
+                    (
+                        upsert_counts["inserted_count"],
+                        upsert_counts["updated_count"],
+                        upsert_counts["total_upserted"],
+                    ),
+                )
+        except Exception:
+            pass
 
     # Inventory refresh for variations included in this batch.
     # This keeps stock_count accurate across the full catalog sync (not just last 1000 rows).
-    variation_ids = _extract_variation_ids_from_items(objects)
-    if not variation_ids:
+    variation_ids = [r["square_variation_id"] for r in rows]
+    if not variation_ids and "inventory" in cfg.stages:
         # Fallback: mirror original blueprint behavior (last 1000 rows by synced_at)
         try:
             ids_sql = SELECT_RECENT_VARIATION_IDS_SQL_TEMPLATE.format(products_table=cfg.products_table)
-            with conn.cursor() as cur:
-                cur.execute(ids_sql)
+            with _savepoint(conn, "catalog_sync_recent_ids"), conn.cursor() as cur:
+                _execute(cur, "select_recent_variation_ids", ids_sql)
                 variation_ids = [r[0] for r in (cur.fetchall() or []) if r and r[0]]
         except Exception:
             variation_ids = []
 
-    if variation_ids:
-        inventory_updated = _refresh_inventory_counts_for_variations(cfg, sq, conn, variation_ids)
+    if variation_ids and "inventory" in cfg.stages:
+        known_stock: Optional[Dict[str, int]] = None
+        if known is not None:
+            # Rows inserted by this batch start at stock_count 0 (the upsert never writes stock).
+            known_stock = {
+                r["square_variation_id"]: (known[r["square_variation_id"]].stock_count if r["square_variation_id"] in known else 0)
+                for r in rows
+            }
+        inventory_updated = _refresh_inventory_counts_for_variations(
+            cfg, sq, conn, variation_ids, known_stock=known_stock, snapshot=inventory_snapshot
+        )
 
-    # Images refresh from related_objects
-    if related_objects:
+    # Images refresh from related IMAGE objects (for rows outside this batch that share them)
+    fresh_images = images if image_cache is None else image_cache.fresh(images)
+    if fresh_images and "images" in cfg.stages:
         img_sql = UPDATE_IMAGES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+        payload = [{"id": im.image_id, "url": im.url} for im in fresh_images]
         with conn.cursor() as cur:
-            cur.execute(img_sql, (json.dumps(related_objects),))
+            _execute(cur, "update_images", img_sql, (_json_param(payload),))
             images_updated = cur.rowcount or 0
 
-    # Category denormalization
+    # Category denormalization (already done at flatten time when the category index is available)
+    if categories is not None:
+        return upsert_counts, inventory_updated, images_updated, True
+    if "categories" not in cfg.stages:
+        return upsert_counts, inventory_updated, images_updated, category_denorm_ran
+
     try:
         cat_sql = UPDATE_CATEGORY_NAMES_REPORTING_SQL_TEMPLATE.format(
             products_table=cfg.products_table,
             categories_table=cfg.categories_table,
         )
-        with conn.cursor() as cur:
-            cur.execute(cat_sql)
+        with _savepoint(conn, "catalog_sync_category_denorm"), conn.cursor() as cur:
+            _execute(cur, "update_category_names_reporting", cat_sql)
         category_denorm_ran = True
     except Exception:
         try:
@@ -1059,8 +3207,8 @@ def _apply_catalog_batch(
                 products_table=cfg.products_table,
                 categories_table=cfg.categories_table,
             )
-            with conn.cursor() as cur:
-                cur.execute(cat_sql)
+            with _savepoint(conn, "catalog_sync_category_denorm"), conn.cursor() as cur:
+                _execute(cur, "update_category_names_fallback", cat_sql)
             category_denorm_ran = True
         except Exception:
             category_denorm_ran = False
@@ -1068,208 +3216,1875 @@ def _apply_catalog_batch(
     return upsert_counts, inventory_updated, images_updated, category_denorm_ran
 
 
-def _sync_categories(cfg: Config, sq: SquareClient, conn: Any) -> int:
+@dataclass
+class PlanTotals:
+    """--plan counters for one batch (and, summed, for the run)."""
+
+    pages: int = 0
+    variations: int = 0
+    insert: int = 0
+    update: int = 0
+    unchanged: int = 0
+    delete_candidates: int = 0
+    inventory_rows: int = 0
+    image_rows: int = 0
+    payload_bytes: int = 0
+    est_tuple_bytes: int = 0
+
+    def add(self, other: "PlanTotals") -> None:
+        for f in fields(self):
+            setattr(self, f.name, getattr(self, f.name) + getattr(other, f.name))
+
+
+def _plan_catalog_batch(
+    cfg: Config,
+    sq: SquareClient,
+    *,
+    records: List[VariationRecord],
+    images: List[ImageRecord],
+    conn: Any,
+    columns: FrozenSet[str],
+    categories: Optional[CategoryIndex],
+    image_cache: RelatedObjectCache,
+    image_urls: Dict[str, Optional[str]],
+    inventory_snapshot: Optional[Dict[str, dict]],
+    avg_row_bytes: int,
+) -> PlanTotals:
     """
-    Pull all categories from Square and upsert into categories table.
-    Returns number of objects processed (not DB rowcount, which can be -1 depending on driver).
+    Read-only mirror of _apply_catalog_batch: classify the batch's rows the way the sync would
+    and count what each stage would write, without writing. image_urls carries the image_url
+    values earlier planned batches would have written (variation id -> url), so a row fixed by
+    one batch's images UPDATE is not counted again by a later batch.
+    columns: products columns that exist; without sync_fingerprint (added by the first sync)
+    every existing row counts as an update.
+    """
+    plan = PlanTotals()
+    rows = _project_variation_rows(records, categories, images)
+    plan.variations = len(rows)
+    variation_ids = [r["square_variation_id"] for r in rows]
+
+    known = _load_known_rows(cfg, conn, variation_ids, fingerprints="sync_fingerprint" in columns)
+    for vid, url in image_urls.items():
+        if vid in known:
+            known[vid] = replace(known[vid], image_url=url)
+    changed = _changed_rows(rows, known) if cfg.diff else rows
+    plan.insert = sum(1 for r in changed if r["square_variation_id"] not in known)
+    plan.update = len(changed) - plan.insert
+    plan.unchanged = len(rows) - len(changed)
+    payloads: List[Any] = [changed] if changed else []
+
+    item_ids = sorted({r["square_item_id"] for r in rows if r.get("square_item_id")})
+    if item_ids:
+        sql = COUNT_STALE_VARIATIONS_SQL_TEMPLATE.format(products_table=cfg.products_table)
+        with conn.cursor() as cur:
+            _execute(cur, "count_stale_variations", sql, (item_ids, variation_ids))
+            plan.delete_candidates = int((cur.fetchone() or (0,))[0] or 0)
+
+    if variation_ids and "inventory" in cfg.stages:
+        # Rows the batch inserts start at stock_count 0; with a snapshot, existing rows already
+        # hold the snapshot count by the time batches run.
+        known_stock: Optional[Dict[str, int]] = None
+        if cfg.diff:
+            known_stock = {vid: (known[vid].stock_count if vid in known else 0) for vid in variation_ids}
+            if inventory_snapshot is not None:
+                for vid in known_stock:
+                    if vid in known:
+                        qty = (inventory_snapshot.get(vid) or {}).get("quantity")
+                        known_stock[vid] = int(qty or 0)
+        for i in range(0, len(variation_ids), INVENTORY_IDS_PER_CALL):
+            chunk = variation_ids[i : i + INVENTORY_IDS_PER_CALL]
+            if inventory_snapshot is not None:
+                counts = [inventory_snapshot[vid] for vid in chunk if vid in inventory_snapshot]
+            else:
+                counts = list(sq.iter_inventory_counts(chunk))
+            expanded = _expand_inventory_counts(cfg, chunk, counts, known_stock=known_stock)
+            plan.inventory_rows += len(expanded)
+            if expanded:
+                payloads.append(expanded)
+
+    fresh_images = image_cache.fresh(images)
+    if fresh_images and "images" in cfg.stages:
+        payload = [{"id": im.image_id, "url": im.url} for im in fresh_images]
+        sql = SELECT_IMAGE_CHANGES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+        with conn.cursor() as cur:
+            _execute(cur, "select_image_changes", sql, (_json_param(payload),))
+            hits = cur.fetchall() or []
+        # Rows in the batch get image_url from the upsert (already counted there).
+        in_batch = set(variation_ids)
+        touched = {vid: url for vid, url in hits if vid not in in_batch and image_urls.get(vid, "") != url}
+        plan.image_rows = len(touched)
+        image_urls.update(touched)
+        image_cache.mark(fresh_images)
+        payloads.append(payload)
+
+    plan.payload_bytes = sum(len(_JSON_CODEC.dumps(p)) for p in payloads)
+    # Every write is a new row version (MVCC); index entries are not included.
+    plan.est_tuple_bytes = avg_row_bytes * (plan.insert + plan.update + plan.inventory_rows + plan.image_rows)
+    for r in rows:
+        image_urls.pop(r["square_variation_id"], None)
+    return plan
+
+
+def _images_for_records(records: List[VariationRecord], images: List[ImageRecord]) -> List[ImageRecord]:
+    """Narrow images to the ones a subset of records points at."""
+    image_ids = {rec.square_image_id for rec in records or []}
+    return [im for im in images or [] if im.image_id in image_ids]
+
+
+def _dead_letter_entry(rec: VariationRecord, err: Exception) -> Dict[str, Any]:
+    return {
+        "dead_lettered_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+        "object_id": rec.square_variation_id,
+        "object_type": "ITEM_VARIATION",
+        "item_id": rec.square_item_id,
+        "version": rec.item_version,
+        "sqlstate": getattr(err, "sqlstate", None),
+        "error": str(err)[:2000],
+        "record": rec.as_dict(),
+    }
+
+
+def _bisect_catalog_batch(
+    cfg: Config,
+    sq: SquareClient,
+    *,
+    records: List[VariationRecord],
+    images: List[ImageRecord],
+    conn: Any,
+    columns: FrozenSet[str],
+    categories: Optional[CategoryIndex],
+    error: Exception,
+    dead_letters: List[Dict[str, Any]],
+    image_cache: Optional[RelatedObjectCache] = None,
+    inventory_snapshot: Optional[Dict[str, dict]] = None,
+) -> Tuple[Dict[str, int], int, int, bool]:
+    """
+    Re-apply a batch that failed with a bisectable error (see _is_bisectable_db_error) in halves,
+    each inside its own savepoint, recursing until the failing part is a single variation. Those
+    are appended to dead_letters and skipped; everything else is applied. The caller commits.
+    Errors that are not bisectable (e.g. a dropped connection or a statement timeout) propagate
+    unchanged. Without an inventory_snapshot the batch's counts are fetched from Square once here
+    and shared by the halves. Returns the combined result in the same shape as _apply_catalog_batch.
+    """
+    if inventory_snapshot is None and "inventory" in cfg.stages and records and not cfg.dry_run:
+        variation_ids = list(dict.fromkeys(rec.square_variation_id for rec in records))
+        counts = list(sq.iter_inventory_counts(variation_ids))
+        inventory_snapshot = {c["catalog_object_id"]: c for c in _expand_inventory_counts(cfg, variation_ids, counts)}
+
+    upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0, "unchanged_count": 0}
+    totals = [0, 0]
+    category_denorm_ran = False
+
+    def _split(part: List[VariationRecord], err: Exception) -> None:
+        if len(part) <= 1:
+            dead_letters.extend(_dead_letter_entry(o, err) for o in part)
+            return
+        mid = len(part) // 2
+        _try(part[:mid])
+        _try(part[mid:])
+
+    def _try(part: List[VariationRecord]) -> None:
+        nonlocal category_denorm_ran
+        try:
+            with _stage("bisect.apply"), _savepoint(conn, "catalog_sync_bisect"):
+                counts, inv_rows, img_rows, cat_denorm = _apply_catalog_batch(
+                    cfg,
+                    sq,
+                    records=part,
+                    images=_images_for_records(part, images),
+                    conn=conn,
+                    columns=columns,
+                    categories=categories,
+                    image_cache=image_cache,
+                    inventory_snapshot=inventory_snapshot,
+                )
+        except Exception as e:
+            if not _is_bisectable_db_error(e):
+                raise
+            _split(part, e)
+            return
+        for k in upsert_counts:
+            upsert_counts[k] += counts.get(k, 0)
+        totals[0] += inv_rows
+        totals[1] += img_rows
+        category_denorm_ran = category_denorm_ran or cat_denorm
+
+    _split(list(records or []), error)
+    return upsert_counts, totals[0], totals[1], category_denorm_ran
+
+
+class CategoryIndex:
+    """
+    In-memory Square category hierarchy: id -> name, parent chain and full path.
+    Built by _sync_categories from the CATEGORY objects it upserts.
+    """
+
+    def __init__(self) -> None:
+        self._names: Dict[str, Optional[str]] = {}
+        self._parents: Dict[str, Optional[str]] = {}
+        self._paths: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def ids(self) -> List[str]:
+        return list(self._names)
+
+    def add(self, obj: dict) -> None:
+        cid = _nonempty_str((obj or {}).get("id"))
+        if not cid or obj.get("type") != "CATEGORY":
+            return
+        data = obj.get("category_data") or {}
+        self.set(cid, data.get("name"), data.get("parent_id"))
+
+    def set(self, category_id: str, name: Optional[str], parent_id: Optional[str]) -> None:
+        self._names[category_id] = name
+        self._parents[category_id] = _nonempty_str(parent_id)
+        self._paths.clear()
+
+    def name(self, category_id: Optional[str]) -> Optional[str]:
+        return self._names.get(category_id) if category_id else None
+
+    def names(self, category_ids: Optional[List[str]]) -> List[str]:
+        """Names for the known ids, de-duplicated in input order (unknown ids are dropped)."""
+        out: List[str] = []
+        for cid in category_ids or []:
+            n = self.name(cid)
+            if n is not None and n not in out:
+                out.append(n)
+        return out
+
+    def parents(self, category_id: Optional[str]) -> List[str]:
+        """Ancestor ids, nearest first. Stops at unknown ids and at cycles."""
+        out: List[str] = []
+        seen = {category_id}
+        parent = self._parents.get(category_id) if category_id else None
+        while parent and parent not in seen and parent in self._names:
+            out.append(parent)
+            seen.add(parent)
+            parent = self._parents.get(parent)
+        return out
+
+    def path(self, category_id: Optional[str]) -> List[str]:
+        """Names from the top-level category down to category_id (empty if unknown)."""
+        if not category_id or category_id not in self._names:
+            return []
+        cached = self._paths.get(category_id)
+        if cached is None:
+            ids = list(reversed(self.parents(category_id))) + [category_id]
+            cached = self._paths[category_id] = [n for n in (self._names[i] for i in ids) if n]
+        return list(cached)
+
+
+def _load_category_index(cfg: Config, conn: Any) -> CategoryIndex:
+    """Build a CategoryIndex from the categories table (no Square calls; as fresh as the last sync)."""
+    index = CategoryIndex()
+    sql = SELECT_CATEGORY_INDEX_SQL_TEMPLATE.format(categories_table=cfg.categories_table)
+    with conn.cursor() as cur:
+        _execute(cur, "select_category_index", sql)
+        for cid, name, parent_id in cur.fetchall() or []:
+            if cid:
+                index.set(cid, name, parent_id)
+    return index
+
+
+def _sync_categories(
+    cfg: Config, sq: SquareClient, conn: Any, *, write: bool = True
+) -> Tuple[int, Optional[CategoryIndex]]:
+    """
+    Pull all categories from Square and upsert into categories table (only indexed with write=False).
+    Returns number of objects processed (not DB rowcount, which can be -1 depending on driver)
+    and the CategoryIndex built from them (None in dry-run).
     """
     if cfg.dry_run:
-        return 0
+        return 0, None
 
-    cursor: Optional[str] = None
     processed = 0
+    index = CategoryIndex()
     upsert_sql = UPSERT_CATEGORIES_SQL_TEMPLATE.format(categories_table=cfg.categories_table)
 
-    while True:
-        payload = sq.catalog_list_categories(cursor=cursor)
+    for _, payload, _ in _iter_cursor_pages(lambda c: sq.catalog_list_categories(cursor=c)):
         objects = payload.get("objects") or []
         if objects:
             processed += len(objects)
+            for obj in objects:
+                index.add(obj)
+            if write:
+                with conn.cursor() as cur:
+                    _execute(cur, "upsert_categories", upsert_sql, (_json_param(objects),))
+                conn.commit()
+
+    return processed, index
+
+
+class VariationRecord:
+    """
+    One ITEM_VARIATION reduced to the fields the sync writes (see _project_catalog_objects).
+    Category fields hold Square ids; names are resolved per batch in _project_variation_rows.
+    """
+
+    __slots__ = (
+        "square_variation_id",
+        "square_item_id",
+        "item_version",
+        "name",
+        "variation_name",
+        "description",
+        "price_cents",
+        "category",
+        "reporting_category",
+        "all_categories",
+        "square_image_id",
+        "updated_at",
+        "created_at",
+    )
+
+    def __init__(
+        self,
+        square_variation_id: str,
+        square_item_id: Optional[str],
+        item_version: Optional[int],
+        name: Optional[str],
+        variation_name: Optional[str],
+        description: Optional[str],
+        price_cents: Optional[str],
+        category: Optional[str],
+        reporting_category: Optional[str],
+        all_categories: Optional[Tuple[str, ...]],
+        square_image_id: Optional[str],
+        updated_at: Optional[str],
+        created_at: Optional[str],
+    ) -> None:
+        self.square_variation_id = square_variation_id
+        self.square_item_id = square_item_id
+        self.item_version = item_version
+        self.name = name
+        self.variation_name = variation_name
+        self.description = description
+        self.price_cents = price_cents
+        self.category = category
+        self.reporting_category = reporting_category
+        self.all_categories = all_categories
+        self.square_image_id = square_image_id
+        self.updated_at = updated_at
+        self.created_at = created_at
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+class ImageRecord:
+    """An IMAGE related object reduced to id, version and url."""
+
+    __slots__ = ("image_id", "version", "url")
+
+    def __init__(self, image_id: str, version: Optional[int], url: Optional[str]) -> None:
+        self.image_id = image_id
+        self.version = version
+        self.url = url
+
+
+def _project_catalog_objects(objects: List[dict]) -> List[VariationRecord]:
+    """
+    Reduce Square ITEM objects to one VariationRecord per ITEM_VARIATION, right after the fetch,
+    so batches do not keep the raw dicts (descriptions, custom attributes, ...) alive.
+    The fallbacks mirror what the upsert used to do in SQL:
+    - description: description_plaintext, then description, then description_html ('' => NULL)
+    - category: category_id, reporting_category.id, categories[0].id
+    - reporting_category: reporting_category.id, category_id, categories[0].id
+    - all_categories: categories[].id, falling back to [reporting_category]
+    - square_image_id: image_id, falling back to item_data.image_ids[0]
+    Price is kept as text; the ::bigint cast stays in SQL.
+    """
+    out: List[VariationRecord] = []
+    with _stage("project"):
+        for obj in objects or []:
+            if not isinstance(obj, dict) or obj.get("type") != "ITEM":
+                continue
+            item_data = obj.get("item_data") or {}
+
+            cat_objs = [c for c in (item_data.get("categories") or []) if isinstance(c, dict)]
+            cat_ids = tuple(c["id"] for c in cat_objs if _nonempty_str(c.get("id")))
+            first_cat = _nonempty_str(cat_objs[0].get("id")) if cat_objs else None
+            category_id = _nonempty_str(item_data.get("category_id"))
+            reporting_id = _nonempty_str((item_data.get("reporting_category") or {}).get("id"))
+            reporting_category = reporting_id or category_id or first_cat
+            category = category_id or reporting_id or first_cat
+            all_categories = cat_ids or ((reporting_category,) if reporting_category else None)
+
+            description = None
+            for key in ("description_plaintext", "description", "description_html"):
+                if item_data.get(key) is not None:
+                    description = item_data.get(key)
+                    break
+
+            image_id = obj.get("image_id")
+            if image_id is None:
+                image_ids = item_data.get("image_ids") or []
+                image_id = _nonempty_str(image_ids[0]) if image_ids else None
+
+            for v in item_data.get("variations") or []:
+                if not isinstance(v, dict) or v.get("type") != "ITEM_VARIATION":
+                    continue
+                vid = _nonempty_str(v.get("id"))
+                if not vid:
+                    continue
+                vdata = v.get("item_variation_data") or {}
+                amount = (vdata.get("price_money") or {}).get("amount")
+                out.append(
+                    VariationRecord(
+                        square_variation_id=vid,
+                        square_item_id=obj.get("id"),
+                        item_version=obj.get("version"),
+                        name=item_data.get("name"),
+                        variation_name=vdata.get("name"),
+                        description=description or None,
+                        price_cents=str(amount) if amount is not None else None,
+                        category=category,
+                        reporting_category=reporting_category,
+                        all_categories=all_categories,
+                        square_image_id=image_id,
+                        updated_at=obj.get("updated_at"),
+                        created_at=obj.get("created_at"),
+                    )
+                )
+    return out
+
+
+def _project_image_objects(related_objects: List[dict]) -> List[ImageRecord]:
+    out: List[ImageRecord] = []
+    for obj in related_objects or []:
+        if not isinstance(obj, dict) or obj.get("type") != "IMAGE":
+            continue
+        image_id = _nonempty_str(obj.get("id"))
+        if image_id:
+            out.append(ImageRecord(image_id, obj.get("version"), (obj.get("image_data") or {}).get("url")))
+    return out
+
+
+# Columns that feed sync_fingerprint, in a fixed order. Keep in sync with _project_variation_rows.
+_FINGERPRINT_COLUMNS = (
+    "square_variation_id",
+    "square_item_id",
+    "name",
+    "variation_name",
+    "description",
+    "price_cents",
+    "category",
+    "reporting_category",
+    "all_categories",
+    "square_image_id",
+    "updated_at",
+    "created_at",
+    "category_path",
+    "search_text",
+)
+
+
+def _nonempty_str(v: Any) -> Optional[str]:
+    return v if isinstance(v, str) and v != "" else None
+
+
+def _search_text(*parts: Any) -> Optional[str]:
+    """
+    Lower-cased, accent-free, punctuation-free text for trigram search: "Björk – Début (LP)"
+    -> "bjork debut lp". Parts may be strings or lists of strings; repeats are dropped.
+    """
+    words: List[str] = []
+    seen = set()
+    for part in parts:
+        for s in part if isinstance(part, (list, tuple)) else [part]:
+            if not isinstance(s, str) or not s or s in seen:
+                continue
+            seen.add(s)
+            s = "".join(ch for ch in unicodedata.normalize("NFKD", s) if not unicodedata.combining(ch))
+            words.extend(re.split(r"[\W_]+", s.casefold()))
+    return " ".join(w for w in words if w) or None
+
+
+def _row_fingerprint(row: Dict[str, Any]) -> str:
+    raw = json.dumps([row.get(c) for c in _FINGERPRINT_COLUMNS], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _project_variation_rows(
+    records: List[VariationRecord],
+    categories: Optional[CategoryIndex] = None,
+    images: Optional[List[ImageRecord]] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Turn VariationRecords into upsert rows with exactly the columns UPSERT_PRODUCTS_SQL_TEMPLATE
+    writes (plus sync_fingerprint and search_text; search_vector is built from these in SQL).
+    image_url comes from the batch's IMAGE objects (NULL when the image is not among them; the
+    upsert then keeps the stored url).
+    With a CategoryIndex, ids are resolved to names here the same way the SQL denormalization
+    does it (category <- name of reporting_category; all_categories <- names of known ids), and
+    category_path is filled in. reporting_category always keeps the id. search_text only takes
+    resolved names: without a CategoryIndex (or for unknown ids) it has no categories at all.
+    Duplicate variation ids keep the last occurrence (ON CONFLICT cannot touch a row twice).
+    """
+    urls = {im.image_id: im.url for im in images or []}
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for rec in records or []:
+        category = rec.category
+        all_categories = list(rec.all_categories) if rec.all_categories else None
+        category_path: Optional[List[str]] = None
+        category_names: List[str] = []
+        if categories is not None:
+            category = categories.name(rec.reporting_category) or category
+            category_names = categories.names(all_categories)
+            all_categories = category_names or all_categories
+            category_path = categories.path(rec.reporting_category) or None
+
+        row: Dict[str, Any] = {
+            "square_variation_id": rec.square_variation_id,
+            "square_item_id": rec.square_item_id,
+            "name": rec.name,
+            "variation_name": rec.variation_name,
+            "description": rec.description,
+            "price_cents": rec.price_cents,
+            "category": category,
+            "reporting_category": rec.reporting_category,
+            "all_categories": all_categories,
+            "square_image_id": rec.square_image_id,
+            "updated_at": rec.updated_at,
+            "created_at": rec.created_at,
+            "category_path": category_path,
+            "search_text": _search_text(rec.name, rec.variation_name, category_path, category_names),
+        }
+        row["sync_fingerprint"] = _row_fingerprint(row)
+        row["image_url"] = urls.get(rec.square_image_id) if rec.square_image_id else None
+        by_id.pop(rec.square_variation_id, None)
+        by_id[rec.square_variation_id] = row
+    return list(by_id.values())
+
+
+@dataclass(frozen=True)
+class KnownRow:
+    """What Postgres currently holds for one variation (see SELECT_FINGERPRINTS_SQL_TEMPLATE)."""
+
+    fingerprint: Optional[str]
+    stock_count: int
+    image_url: Optional[str]
+
+
+def _load_known_rows(
+    cfg: Config, conn: Any, variation_ids: List[str], *, fingerprints: bool = True
+) -> Dict[str, KnownRow]:
+    """fingerprints=False: the sync_fingerprint column does not exist yet (every fingerprint is None)."""
+    if not variation_ids:
+        return {}
+    sql = SELECT_FINGERPRINTS_SQL_TEMPLATE.format(
+        products_table=cfg.products_table,
+        fingerprint_column="sync_fingerprint" if fingerprints else "NULL::text",
+    )
+    with conn.cursor() as cur:
+        _execute(cur, "select_fingerprints", sql, (variation_ids,))
+        return {
+            r[0]: KnownRow(fingerprint=r[1], stock_count=int(r[2] or 0), image_url=r[3])
+            for r in (cur.fetchall() or [])
+        }
+
+
+def _changed_rows(rows: List[Dict[str, Any]], known: Dict[str, KnownRow]) -> List[Dict[str, Any]]:
+    """
+    Rows that are new, whose fingerprint differs, or whose resolved image_url differs from the
+    stored one (image_url is not part of the fingerprint; it can also be written by the images stage).
+    """
+    out: List[Dict[str, Any]] = []
+    for r in rows:
+        k = known.get(r["square_variation_id"])
+        if k is None or k.fingerprint != r["sync_fingerprint"]:
+            out.append(r)
+        elif r.get("image_url") is not None and r["image_url"] != k.image_url:
+            out.append(r)
+    return out
+
+
+class ApiBudget:
+    """
+    Token bucket for --api-calls-per-minute. Holds at most one minute of calls and refills
+    continuously; the level is persisted in the tier state so consecutive cron ticks share it.
+    """
+
+    def __init__(self, per_minute: int, tokens: Any = None, at: Any = None):
+        self.per_minute = per_minute
+        self.tokens = float(per_minute)
+        if isinstance(tokens, (int, float)) and isinstance(at, (int, float)):
+            refill = max(0.0, time.time() - at) * per_minute / 60.0
+            # An overdrawn bucket (charge) stays overdrawn until the refill covers it.
+            self.tokens = min(float(per_minute), tokens + refill)
+        self.calls = 0
+
+    def available(self) -> int:
+        return int(self.tokens)
+
+    def take(self, n: int) -> bool:
+        if n > self.tokens:
+            return False
+        self.tokens -= n
+        self.calls += n
+        return True
+
+    def charge(self, n: int) -> None:
+        """Calls already made beyond what was taken (extra cursor pages); may overdraw the bucket."""
+        self.tokens -= n
+        self.calls += n
+
+    def snapshot(self) -> Dict[str, float]:
+        return {"tokens": round(self.tokens, 3), "tokens_at": time.time()}
+
+
+class BatchPacer:
+    """
+    --time-budget: decides how many pages the next batch may take so it finishes inside the
+    budget, from an exponential moving average of recent per-page batch cost (fetch + apply,
+    including retries). The first batch takes a single page to get an estimate. The steps after
+    the last batch (ANALYZE, albums_cache rebuild, snapshot) only start when fits() says their
+    last measured duration still fits; skipped ones are listed in skipped.
+    """
+
+    EMA_ALPHA = 0.3
+    SAFETY = 1.25
+
+    def __init__(self, budget_s: Optional[float]):
+        self.budget_s = budget_s
+        self.started = time.monotonic()
+        self.per_page_s: Optional[float] = None
+        self.stopped = False
+        self.skipped: List[str] = []
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def pages_allowed(self, want: int) -> int:
+        """Pages the next batch may fetch (0 = stop the run here)."""
+        if self.budget_s is None:
+            return want
+        remaining = self.budget_s - self.elapsed()
+        if self.per_page_s is None:
+            allowed = 1 if remaining > 0 else 0
+        else:
+            allowed = int(remaining // (self.per_page_s * self.SAFETY))
+        allowed = max(0, min(want, allowed))
+        if allowed == 0:
+            self.stopped = True
+        return allowed
+
+    def fits(self, step: str, last_s: Any) -> bool:
+        """Whether step may start: budget left, and (once measured) its last duration fits in it."""
+        if self.budget_s is None:
+            return True
+        remaining = self.budget_s - self.elapsed()
+        if remaining > 0 and (not isinstance(last_s, (int, float)) or last_s * self.SAFETY <= remaining):
+            return True
+        self.skipped.append(step)
+        return False
+
+    def record(self, pages: int, seconds: float) -> None:
+        if pages <= 0:
+            return
+        sample = seconds / pages
+        if self.per_page_s is None:
+            self.per_page_s = sample
+        else:
+            self.per_page_s = self.EMA_ALPHA * sample + (1 - self.EMA_ALPHA) * self.per_page_s
+
+
+class RelatedObjectCache:
+    """
+    Bounded LRU of related object id -> version seen during this run.
+    fresh() keeps the objects that are new or whose version changed (de-duplicated by id,
+    last occurrence wins); mark() records them once the batch that used them has committed,
+    so a rolled-back batch forwards them again.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, int(max_entries))
+        self._versions: "OrderedDict[str, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fresh(self, images: List[ImageRecord]) -> List[ImageRecord]:
+        by_id: Dict[str, ImageRecord] = {}
+        for im in images or []:
+            by_id.pop(im.image_id, None)
+            by_id[im.image_id] = im
+        out: List[ImageRecord] = []
+        for image_id, im in by_id.items():
+            if image_id in self._versions and self._versions[image_id] == im.version:
+                self._versions.move_to_end(image_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+                out.append(im)
+        return out
+
+    def mark(self, images: List[ImageRecord]) -> None:
+        for im in images or []:
+            self._versions[im.image_id] = im.version
+            self._versions.move_to_end(im.image_id)
+        while len(self._versions) > self.max_entries:
+            self._versions.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._versions), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+def _upsert_products_sql(cfg: Config, *, columns: FrozenSet[str]) -> str:
+    extra = [c for c in OPTIONAL_PRODUCT_COLUMNS if c in columns]
+    return UPSERT_PRODUCTS_SQL_TEMPLATE.format(
+        products_table=cfg.products_table,
+        extra_columns="".join(f",\n    {c}" for c in extra),
+        extra_updates="".join(
+            f",\n    {c} = {OPTIONAL_PRODUCT_COLUMNS[c][1].format(products_table=cfg.products_table)}" for c in extra
+        ),
+    )
+
+
+def _ensure_products_columns(cfg: Config, conn: Any) -> FrozenSet[str]:
+    """
+    Add any missing OPTIONAL_PRODUCT_COLUMNS and return the ones that exist.
+    Once sync_fingerprint exists every upsert writes it, even with --no-diff, so a later diff run
+    never trusts a fingerprint that predates the row's current values.
+    """
+    present: FrozenSet[str] = frozenset()
+    try:
+        with conn.cursor() as cur:
+            _execute(cur, "select_product_columns", SELECT_PRODUCT_COLUMNS_SQL, (cfg.products_table,))
+            present = frozenset(r[0] for r in (cur.fetchall() or [])) & frozenset(OPTIONAL_PRODUCT_COLUMNS)
+            missing = [c for c in OPTIONAL_PRODUCT_COLUMNS if c not in present]
+            if missing:
+                alter = ", ".join(f"ADD COLUMN IF NOT EXISTS {c} {OPTIONAL_PRODUCT_COLUMNS[c][0]}" for c in missing)
+                _execute(cur, "add_product_columns", f"ALTER TABLE {cfg.products_table} {alter}")
+                present = frozenset(OPTIONAL_PRODUCT_COLUMNS)
+        conn.commit()
+    except Exception:
+        # No ALTER privilege (or similar): keep whatever already exists (no column => no diff / no path).
+        _safe_rollback(conn)
+    return present
+
+
+def _ensure_run_columns(cfg: Config, conn: Any) -> FrozenSet[str]:
+    """Add any missing OPTIONAL_RUN_COLUMNS to the runs table and return the ones that exist."""
+    present: FrozenSet[str] = frozenset()
+    try:
+        with conn.cursor() as cur:
+            _execute(cur, "select_run_columns", SELECT_PRODUCT_COLUMNS_SQL, (cfg.catalog_sync_runs_table,))
+            present = frozenset(r[0] for r in (cur.fetchall() or [])) & frozenset(OPTIONAL_RUN_COLUMNS)
+            missing = [c for c in OPTIONAL_RUN_COLUMNS if c not in present]
+            if missing:
+                alter = ", ".join(f"ADD COLUMN IF NOT EXISTS {c} {OPTIONAL_RUN_COLUMNS[c]}" for c in missing)
+                _execute(cur, "add_run_columns", f"ALTER TABLE {cfg.catalog_sync_runs_table} {alter}")
+                present = frozenset(OPTIONAL_RUN_COLUMNS)
+        conn.commit()
+    except Exception:
+        # Missing table or no ALTER privilege: per-batch counter rows only, as before.
+        _safe_rollback(conn)
+    return present
+
+
+def _prepare_run_history(cfg: Config, conn: Any) -> None:
+    """
+    On the run's first connection: check the runs table once, so batches know whether the legacy
+    counter row or a kind='batch' row is written (see RunHistory).
+    """
+    history: Optional[RunHistory] = getattr(_TARGET, "history", None)
+    if history is not None and history.columns is None:
+        warm: Optional[WarmState] = getattr(_TARGET, "warm", None)
+        if warm is not None:
+            key = (cfg.pg_dsn, "run_columns", cfg.catalog_sync_runs_table)
+            history.columns = warm.memo(key, lambda: _ensure_run_columns(cfg, conn))
+        else:
+            history.columns = _ensure_run_columns(cfg, conn)
+
+
+def _insert_run_batch(
+    cfg: Config,
+    conn: Any,
+    history: RunHistory,
+    *,
+    batch_no: int,
+    started_at: dt.datetime,
+    counts: Dict[str, int],
+    metrics: Dict[str, Any],
+) -> None:
+    """Best-effort kind='batch' row, in the batch's transaction (savepoint, like the legacy row)."""
+    try:
+        sql = INSERT_RUN_HISTORY_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+        with _savepoint(conn, "catalog_sync_run_log"), conn.cursor() as cur:
+            _execute(
+                cur,
+                "insert_run_batch",
+                sql,
+                (
+                    counts.get("inserted_count", 0),
+                    counts.get("updated_count", 0),
+                    counts.get("total_upserted", 0),
+                    history.run_id,
+                    "batch",
+                    batch_no,
+                    history.mode,
+                    "ok",
+                    started_at,
+                    dt.datetime.now(dt.timezone.utc),
+                    _json_param(metrics),
+                ),
+            )
+    except Exception:
+        pass
+
+
+def _record_run(
+    cfg: Config, sq: SquareClient, history: RunHistory, *, status: str, error: Optional[str] = None
+) -> None:
+    """
+    Insert the run's kind='run' row, roll up batch rows older than --run-batch-retention-days and
+    delete run rows older than --run-retention-days, in one transaction. Runs on the run's own
+    connection (the item's for --item-id runs, else the one the run released last, which _dispatch
+    has PgConnections hold for this). Best-effort: a failure is a run_history_error event only.
+    """
+    summary = history.summary or {}
+    products = summary.get("products") if isinstance(summary.get("products"), dict) else {}
+    metrics = {
+        "seconds": round(time.monotonic() - history.started, 3),
+        "pages": summary.get("pages_fetched"),
+        "batches": history.batches,
+        "unchanged": products.get("unchanged_count"),
+        "inventory_rows": summary.get("inventory_rows_updated"),
+        "image_rows": summary.get("image_rows_updated"),
+        "bisected_batches": summary.get("bisected_batches"),
+        "dead_lettered": summary.get("dead_lettered"),
+        "square": dict(sq.stats),
+        "pg_payload_bytes": history.pg_bytes,
+        "stages": {k: round(v, 3) for k, v in sorted(history.stage_seconds.items())},
+        "pg": summary.get("pg"),
+        "error": error,
+    }
+    warm: Optional[WarmState] = getattr(_TARGET, "warm", None)
+    pg = _pg_connections(cfg)
+    conn = None
+    try:
+        conn = warm.connection(cfg) if warm is not None else pg.acquire()
+        if history.columns is None:
+            history.columns = _ensure_run_columns(cfg, conn)
+        if not history.batch_rows():
+            return
+        sql = INSERT_RUN_HISTORY_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+        with conn.cursor() as cur:
+            _execute(
+                cur,
+                "insert_run_history",
+                sql,
+                (
+                    products.get("inserted_count", 0),
+                    products.get("updated_count", 0),
+                    products.get("total_upserted", 0),
+                    history.run_id,
+                    "run",
+                    None,
+                    summary.get("mode") or history.mode,
+                    status,
+                    history.started_at,
+                    dt.datetime.now(dt.timezone.utc),
+                    _json_param(metrics),
+                ),
+            )
+            if cfg.run_batch_retention_days:
+                rollup_sql = ROLLUP_RUN_BATCHES_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+                _execute(cur, "rollup_run_batches", rollup_sql, (cfg.run_batch_retention_days,))
+            if cfg.run_retention_days:
+                prune_sql = PRUNE_RUNS_SQL_TEMPLATE.format(runs_table=cfg.catalog_sync_runs_table)
+                _execute(cur, "prune_runs", prune_sql, (cfg.run_retention_days,))
+        conn.commit()
+    except Exception as e:
+        _emit("run_history_error", error=_truncate(str(e), 300))
+        if warm is not None and conn is not None:
+            _safe_rollback(conn)
+    finally:
+        if conn is not None and warm is None:
+            pg.release(conn)
+
+
+def _expand_inventory_counts(
+    cfg: Config,
+    variation_ids: List[str],
+    counts: List[dict],
+    *,
+    known_stock: Optional[Dict[str, int]] = None,
+) -> List[dict]:
+    """
+    Build a payload that explicitly includes all requested ids (missing => 0).
+    With several SQUARE_LOCATION_IDs a variation's counts are summed (latest calculated_at wins).
+    """
+    locations = set(cfg.square_location_ids)
+    qty_by_id: Dict[str, int] = {}
+    calc_by_id: Dict[str, Optional[str]] = {}
+    for c in counts:
+        if not isinstance(c, dict):
+            continue
+        vid = c.get("catalog_object_id")
+        if not isinstance(vid, str) or not vid.strip():
+            continue
+        if c.get("location_id") is not None and c.get("location_id") not in locations:
+            continue
+        qraw = c.get("quantity")
+        try:
+            qty = int(qraw) if qraw is not None and str(qraw).strip() != "" else 0
+        except Exception:
+            qty = 0
+        qty_by_id[vid] = qty_by_id.get(vid, 0) + max(0, qty)
+        calc = c.get("calculated_at")
+        calc = calc if isinstance(calc, str) and calc.strip() else None
+        if calc and (calc_by_id.get(vid) or "") < calc:
+            calc_by_id[vid] = calc
+
+    expanded: List[dict] = []
+    for vid in variation_ids:
+        if known_stock is not None and known_stock.get(vid) == qty_by_id.get(vid, 0):
+            continue
+        expanded.append(
+            {
+                "catalog_object_type": "ITEM_VARIATION",
+                "catalog_object_id": vid,
+                "location_id": cfg.square_location_id,
+                "quantity": str(qty_by_id.get(vid, 0)),
+                "calculated_at": calc_by_id.get(vid),
+            }
+        )
+
+    return expanded
+
+
+def _refresh_inventory_counts_for_variations(
+    cfg: Config,
+    sq: SquareClient,
+    conn: Any,
+    variation_ids: List[str],
+    *,
+    known_stock: Optional[Dict[str, int]] = None,
+    snapshot: Optional[Dict[str, dict]] = None,
+) -> int:
+    """
+    Refresh stock_count for the given Square variation ids.
+    Uses IN_STOCK counts; ids not present in the response are treated as 0 in-stock.
+    If known_stock is given (variation id -> current stock_count), ids whose count did not change are not written.
+    With a location snapshot (see _fetch_inventory_snapshot), counts come from it and Square is not called.
+    """
+    if cfg.dry_run:
+        return 0
+
+    if not variation_ids:
+        return 0
+
+    inv_sql = UPDATE_INVENTORY_SQL_TEMPLATE.format(products_table=cfg.products_table)
+    total_updated = 0
+
+    for i in range(0, len(variation_ids), INVENTORY_IDS_PER_CALL):
+        chunk = variation_ids[i : i + INVENTORY_IDS_PER_CALL]
+        if snapshot is not None:
+            counts = [snapshot[vid] for vid in chunk if vid in snapshot]
+        else:
+            counts = list(sq.iter_inventory_counts(chunk))
+
+        with _stage("inventory.expand"):
+            expanded = _expand_inventory_counts(cfg, chunk, counts, known_stock=known_stock)
+
+        if not expanded:
+            continue
+        with conn.cursor() as cur:
+            _execute(cur, "update_inventory", inv_sql, (_json_param(expanded), cfg.square_location_id))
+            total_updated += cur.rowcount or 0
+
+    return total_updated
+
+
+def _fetch_inventory_snapshot(cfg: Config, sq: SquareClient) -> Tuple[Dict[str, dict], int]:
+    """
+    Page through every IN_STOCK count at the SQUARE_LOCATION_ID location(s).
+    Returns (variation id -> count object, number of Square calls); with several locations the
+    object carries the summed quantity and the latest calculated_at.
+    """
+    counts: List[dict] = []
+    calls = 0
+    for _, payload, _ in _iter_cursor_pages(lambda c: sq.batch_inventory_counts(cursor=c)):
+        calls += 1
+        for c in payload.get("counts") or []:
+            if not isinstance(c, dict) or c.get("catalog_object_type") != "ITEM_VARIATION":
+                continue
+            if c.get("location_id") not in cfg.square_location_ids:
+                continue
+            counts.append(c)
+    variation_ids = list(dict.fromkeys(str(c.get("catalog_object_id") or "") for c in counts))
+    merged = _expand_inventory_counts(cfg, [v for v in variation_ids if v.strip()], counts)
+    return {c["catalog_object_id"]: c for c in merged}, calls
+
+
+def _apply_inventory_snapshot(cfg: Config, conn: Any, snapshot: Dict[str, dict]) -> int:
+    """One set-based UPDATE over the whole products table; rows missing from the snapshot go to 0."""
+    payload = [
+        {
+            "catalog_object_id": vid,
+            "quantity": c.get("quantity"),
+            "calculated_at": c.get("calculated_at"),
+        }
+        for vid, c in snapshot.items()
+    ]
+    sql = UPDATE_INVENTORY_SNAPSHOT_SQL_TEMPLATE.format(products_table=cfg.products_table)
+    with conn.cursor() as cur:
+        _execute(cur, "update_inventory_snapshot", sql, (_json_param(payload),))
+        return cur.rowcount or 0
+
+
+def _expected_pages(cfg: Config, state: Dict[str, Any], rows: int) -> Optional[int]:
+    """
+    Pages this run is expected to fetch after an inventory snapshot, None when unknown. With
+    --time-budget, the budget left after a snapshot at the last runs' seconds per page (kept in
+    the state file); unknown until a run has measured that. The snapshot takes as long as the
+    last one (crawl or fast path), or before any was measured, one page per INVENTORY_IDS_PER_CALL
+    of the table's rows at the same seconds per page.
+    """
+    if cfg.time_budget_s is None:
+        return cfg.max_pages
+    per_page_s = state.get("seconds_per_page")
+    if not isinstance(per_page_s, (int, float)) or per_page_s <= 0:
+        return None
+    snapshot_s = state.get("inventory_snapshot_s")
+    if not isinstance(snapshot_s, (int, float)):
+        snapshot_s = -(-rows // INVENTORY_IDS_PER_CALL) * per_page_s
+    left = cfg.time_budget_s - snapshot_s
+    return min(cfg.max_pages, max(0, int(left // (per_page_s * BatchPacer.SAFETY))))
+
+
+def _choose_inventory_strategy(cfg: Config, conn: Any, state: Dict[str, Any]) -> str:
+    """
+    "snapshot" when this run is expected to touch at least INVENTORY_SNAPSHOT_FRACTION of the
+    products table (pages * items per page * variations per item), else "ids" (also when the
+    run's page count cannot be estimated, see _expected_pages).
+    """
+    if cfg.inventory_strategy != "auto":
+        return cfg.inventory_strategy
+    sql = COUNT_PRODUCTS_SQL_TEMPLATE.format(products_table=cfg.products_table)
+    with conn.cursor() as cur:
+        _execute(cur, "count_products", sql)
+        row = cur.fetchone() or (0, 0)
+    conn.commit()
+    rows, items = int(row[0] or 0), int(row[1] or 0)
+    if rows == 0:
+        return "ids"
+    pages = _expected_pages(cfg, state, rows)
+    if not pages:
+        return "ids"
+    expected = pages * CATALOG_ITEMS_PER_PAGE * (rows / max(1, items))
+    return "snapshot" if expected >= INVENTORY_SNAPSHOT_FRACTION * rows else "ids"
+
+
+def _snapshot_product(row: Tuple[Any, ...]) -> Dict[str, Any]:
+    """One SNAPSHOT_PRODUCTS_SQL_TEMPLATE row -> the Product object /api/products returns."""
+    vid, name, description, price_cents, category, all_categories, stock_count, image_url, created_at = row
+    return {
+        "id": f"variation-{vid}",
+        "name": name or "",
+        "description": description or "",
+        "price": (price_cents or 0) / 100,
+        "category": category or "Uncategorized",
+        "categories": list(all_categories or []),
+        "stockCount": int(stock_count or 0),
+        "imageUrl": image_url or "",
+        "rating": 0,
+        "reviewCount": 0,
+        "soldCount": 0,
+        "lastSoldAt": None,
+        "lastStockedAt": None,
+        "lastAdjustmentAt": None,
+        "createdAt": created_at,
+    }
+
+
+def _write_catalog_snapshot(cfg: Config) -> Dict[str, Any]:
+    """
+    Write {"products": [...]} (the albums_cache selection of the products table, see
+    SNAPSHOT_PRODUCTS_SQL_TEMPLATE) to cfg.snapshot_dir as
+    catalog-<version>.json.gz and .json.br (brotli only when the module is installed), then
+    SNAPSHOT_MANIFEST_NAME with the version, ETag and file names. version is the start of the
+    sha256 of the uncompressed body, so nothing is written when the content is unchanged.
+    Every file is written to a temp name and renamed; the manifest goes last, so readers never
+    see a manifest pointing at a missing or partial file. Versions beyond SNAPSHOT_KEEP_VERSIONS
+    are deleted. Never raises.
+    """
+    if not cfg.snapshot_dir:
+        return {"ok": False, "error": "no --snapshot-dir"}
+    manifest_path = os.path.join(cfg.snapshot_dir, SNAPSHOT_MANIFEST_NAME)
+    conn = None
+    try:
+        with _stage("snapshot.query"):
+            conn = _pg_connections(cfg).acquire()
             with conn.cursor() as cur:
-                cur.execute(upsert_sql, (json.dumps(objects),))
-            conn.commit()
+                sql = SNAPSHOT_PRODUCTS_SQL_TEMPLATE.format(products_table=cfg.products_table)
+                params = (list(SNAPSHOT_ALBUM_CATEGORIES), list(SNAPSHOT_EXCLUDED_CATEGORIES))
+                _execute(cur, "select_snapshot_products", sql, params)
+                rows = cur.fetchall() or []
+            conn.rollback()
+        with _stage("snapshot.encode"):
+            body = _JSON_CODEC.dumps({"products": [_snapshot_product(r) for r in rows]})
+        sha256 = hashlib.sha256(body).hexdigest()
+        version = sha256[:16]
+        result: Dict[str, Any] = {
+            "ok": True,
+            "written": False,
+            "version": version,
+            "products": len(rows),
+            "bytes": len(body),
+        }
 
-        cursor = payload.get("cursor")
-        if not isinstance(cursor, str) or not cursor.strip():
-            break
+        previous = _load_json_file(manifest_path)
+        if previous.get("sha256") == sha256:
+            result["manifest"] = manifest_path
+            return result
 
-    return processed
+        files: Dict[str, Dict[str, Any]] = {}
+        with _stage("snapshot.compress"):
+            gz = gzip.compress(body, compresslevel=SNAPSHOT_GZIP_LEVEL, mtime=0)
+            files["gzip"] = {"file": f"catalog-{version}.json.gz", "bytes": len(gz)}
+            _atomic_write_bytes(os.path.join(cfg.snapshot_dir, files["gzip"]["file"]), gz)
+            try:
+                import brotli  # type: ignore
+            except ImportError:
+                brotli = None
+            if brotli is not None:
+                br = brotli.compress(body, quality=SNAPSHOT_BROTLI_QUALITY)
+                files["br"] = {"file": f"catalog-{version}.json.br", "bytes": len(br)}
+                _atomic_write_bytes(os.path.join(cfg.snapshot_dir, files["br"]["file"]), br)
+
+        history = [version] + [v for v in previous.get("history") or [] if v != version]
+        _atomic_write_json(
+            manifest_path,
+            {
+                "version": version,
+                "etag": f'"{version}"',
+                "sha256": sha256,
+                "bytes": len(body),
+                "products": len(rows),
+                "content_type": "application/json",
+                "generated_at": dt.datetime.now(dt.timezone.utc).isoformat(),
+                "files": files,
+                "history": history[:SNAPSHOT_KEEP_VERSIONS],
+            },
+        )
+        for old in history[SNAPSHOT_KEEP_VERSIONS:]:
+            for ext in ("gz", "br"):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(cfg.snapshot_dir, f"catalog-{old}.json.{ext}"))
+
+        result.update(written=True, manifest=manifest_path, files={k: v["bytes"] for k, v in files.items()})
+        return result
+    except Exception as e:
+        return {"ok": False, "error": _truncate(str(e), 500)}
+    finally:
+        if conn is not None:
+            _pg_connections(cfg).release(conn)
 
 
-def _extract_variation_ids_from_items(objects: List[dict]) -> List[str]:
+def main(argv: Optional[List[str]] = None) -> int:
+    global _ALERTS, _EVENTS, _JSON_CODEC, _PROFILER, _SQL_TIMINGS
+    raw_argv = sys.argv[1:] if argv is None else list(argv)
+    if raw_argv[:1] == ["report"]:
+        return _run_report(raw_argv[1:])
+    cfg = load_config(argv)
+    if cfg.item_id and cfg.daemon_socket and not cfg.targets_path:
+        rc = _forward_to_daemon(cfg, raw_argv)
+        if rc is not None:
+            return rc
+    if cfg.json_codec != "auto":
+        _JSON_CODEC = _load_json_codec(cfg.json_codec)
+    _ALERTS = AlertDispatcher(cfg.alert_state_path, cfg.alert_window_s, cfg.alert_deadline_s)
+    if cfg.profile_dir:
+        _PROFILER = StageProfiler(cfg.profile_dir)
+    if cfg.sql_timings_path:
+        _SQL_TIMINGS = SqlTimings(cfg.sql_timings_path, cfg.explain_threshold_ms)
+    if cfg.events_path:
+        _EVENTS = EventStream(cfg.events_path)
+    if cfg.targets_path and _PROFILER is not None:
+        raise SystemExit("--profile cannot be combined with --targets (stage profiles are per process)")
+    _emit("run_start", argv=sys.argv[1:] if argv is None else argv, dry_run=cfg.dry_run)
+    ok = False
+
+    try:
+        if cfg.targets_path:
+            rc = _run_targets(cfg, sys.argv[1:] if argv is None else list(argv))
+        elif cfg.serve_socket:
+            rc = _run_serve(cfg)
+        else:
+            rc = _dispatch(cfg, SquareClient(cfg))
+        ok = rc == 0
+        return rc
+    except BaseException as e:
+        _emit("run_error", error=_truncate(str(e), 500), error_type=type(e).__name__)
+        raise
+    finally:
+        if _PROFILER is not None:
+            _PROFILER.write_report()
+        if _SQL_TIMINGS is not None:
+            _SQL_TIMINGS.write_report()
+        _ALERTS.close()
+        if _EVENTS is not None:
+            _EVENTS.emit("run_end", ok=ok, stages=_EVENTS.take_timings(all_targets=True))
+            _EVENTS.close()
+
+
+def _run_metrics(row: Tuple[Any, ...]) -> Dict[str, Any]:
+    """One SELECT_RUN_HISTORY_SQL_TEMPLATE row -> the per-run numbers `report` compares."""
+    run_id, mode, status, started_at, inserted, updated, metrics = row
+    m = metrics if isinstance(metrics, dict) else {}
+    square = m.get("square") if isinstance(m.get("square"), dict) else {}
+    seconds = float(m.get("seconds") or 0)
+    pages = int(m.get("pages") or 0)
+    calls = int(square.get("calls") or 0)
+
+    def per_page(v: Any) -> Optional[float]:
+        return round(float(v) / pages, 4) if pages and v is not None else None
+
+    return {
+        "run_id": run_id,
+        "mode": mode,
+        "status": status,
+        "started_at": started_at.isoformat() if started_at else None,
+        "seconds": seconds,
+        "pages": pages,
+        "pages_per_min": round(pages * 60.0 / seconds, 2) if pages and seconds > 0 else None,
+        "seconds_per_page": per_page(seconds),
+        "square_calls": calls,
+        "square_calls_per_page": per_page(calls),
+        "retry_rate": round(int(square.get("retries") or 0) / calls, 4) if calls else None,
+        "rows_written": sum(int(v or 0) for v in (inserted, updated, m.get("inventory_rows"), m.get("image_rows"))),
+        "pg_bytes_per_page": per_page(m.get("pg_payload_bytes")),
+        "stage_seconds_per_page": {
+            k: per_page(v) for k, v in (m.get("stages") or {}).items() if isinstance(v, (int, float))
+        },
+    }
+
+
+def _run_report(argv: List[str]) -> int:
+    """
+    `report`: throughput trends over the last N runs recorded in CATALOG_SYNC_RUNS_TABLE, and the
+    newest run compared with the median of the successful runs before it. A metric more than
+    --regression-pct worse than that median is a regression (per page, so run sizes can differ).
+    """
+    p = argparse.ArgumentParser(prog="catalog_sync.py report", description=_run_report.__doc__)
+    p.add_argument("--last", type=int, default=20, help="Number of runs to read (default: 20)")
+    p.add_argument("--mode", default="catalog", help="Run mode to report on, or 'all' (default: catalog)")
+    p.add_argument(
+        "--regression-pct",
+        type=float,
+        default=RUN_REPORT_REGRESSION_PCT,
+        help=f"Flag metrics this much worse than the median (default: {RUN_REPORT_REGRESSION_PCT:g})",
+    )
+    p.add_argument("--json", action="store_true", help="Print JSON instead of markdown")
+    p.add_argument("--fail-on-regression", action="store_true", help="Exit 1 when the newest run regressed")
+    args = p.parse_args(argv)
+
+    # Same .env files as a sync run (load_config is not used here).
+    load_repo_dotenv()
+    pg_dsn = _resolve_pg_dsn()
+    if not pg_dsn:
+        raise SystemExit("Missing Postgres DSN (set PG_DSN or SGR_DATABASE_URL/SPR_DATABASE_URL/DATABASE_URL)")
+    runs_table = _ident(_get_env("CATALOG_SYNC_RUNS_TABLE") or "catalog_sync_runs")
+    _ensure_psycopg()
+    mode = None if args.mode == "all" else args.mode
+    sql = SELECT_RUN_HISTORY_SQL_TEMPLATE.format(runs_table=runs_table)
+    with psycopg.connect(pg_dsn, autocommit=True, connect_timeout=20) as conn:  # type: ignore
+        with conn.cursor() as cur:
+            _execute(cur, "select_run_history", sql, (mode, mode, max(1, args.last)))
+            runs = [_run_metrics(r) for r in cur.fetchall() or []]
+
+    # Higher is worse for every metric except pages_per_min.
+    checks = ["pages_per_min", "seconds_per_page", "square_calls_per_page", "retry_rate", "pg_bytes_per_page"]
+    latest = runs[0] if runs else None
+    previous = [r for r in runs[1:] if r["status"] == "ok"]
+    baseline: Dict[str, Optional[float]] = {}
+    regressions: List[Dict[str, Any]] = []
+
+    def compare(name: str, new: Optional[float], values: List[Optional[float]], higher_is_worse: bool) -> None:
+        values = [v for v in values if v is not None]
+        base = statistics.median(values) if values else None
+        baseline[name] = base
+        if new is None or not base:
+            return
+        change = (new - base) / base * 100.0
+        if (change if higher_is_worse else -change) > args.regression_pct:
+            regressions.append(
+                {"metric": name, "newest": new, "median": round(base, 4), "change_pct": round(change, 1)}
+            )
+
+    if latest is not None and previous:
+        for name in checks:
+            compare(name, latest[name], [r[name] for r in previous], name != "pages_per_min")
+        # Stages that take a visible share of the newest run's time.
+        total = latest["seconds_per_page"] or 0
+        for stage, new in sorted(latest["stage_seconds_per_page"].items()):
+            if new is not None and total and new >= 0.05 * total:
+                compare(f"stage:{stage}", new, [r["stage_seconds_per_page"].get(stage) for r in previous], True)
+
+    if args.json:
+        out = {
+            "runs_table": runs_table,
+            "mode": args.mode,
+            "runs": runs,
+            "baseline_runs": len(previous),
+            "baseline": baseline,
+            "regressions": regressions,
+            "regression_pct": args.regression_pct,
+        }
+        print(json.dumps(out, indent=2, sort_keys=True, default=str))
+    else:
+        lines = [
+            f"# Catalog sync runs ({runs_table}, mode {args.mode}, last {len(runs)})",
+            "",
+            "| started (UTC) | mode | status | seconds | pages | pages/min | Square calls | retry rate "
+            "| rows written |",
+            "|---|---|---|---:|---:|---:|---:|---:|---:|",
+        ]
+        for r in runs:
+            lines.append(
+                f"| {r['started_at']} | {r['mode']} | {r['status']} | {r['seconds']:.1f} | {r['pages']} "
+                f"| {r['pages_per_min'] if r['pages_per_min'] is not None else '-'} | {r['square_calls']} "
+                f"| {r['retry_rate'] if r['retry_rate'] is not None else '-'} | {r['rows_written']} |"
+            )
+        lines += ["", f"## Newest run vs median of {len(previous)} earlier successful run(s)", ""]
+        if latest is None or not previous:
+            lines.append("Not enough runs to compare.")
+        else:
+            lines += ["| metric | newest | median |", "|---|---:|---:|"]
+            for name in checks:
+                base = baseline.get(name)
+                lines.append(f"| {name} | {latest[name]} | {round(base, 4) if base is not None else '-'} |")
+            lines.append("")
+            if regressions:
+                lines.append(f"Regressions (more than {args.regression_pct:g}% worse):")
+                for g in regressions:
+                    lines.append(f"- {g['metric']}: {g['newest']} vs {g['median']} ({g['change_pct']:+.1f}%)")
+            else:
+                lines.append(f"No regressions (threshold {args.regression_pct:g}%).")
+        print("\n".join(lines))
+    return 1 if args.fail_on_regression and regressions else 0
+
+
+def _dispatch(cfg: Config, sq: SquareClient) -> int:
+    if getattr(_TARGET, "pg", None) is None:
+        # The run's connection manager. Outside --serve, an --item-id run also gets a one-off
+        # WarmState, so its run row reuses the item's connection.
+        one_off = bool(cfg.item_id and not cfg.dry_run and getattr(_TARGET, "warm", None) is None)
+        _TARGET.pg = PgConnections(cfg)
+        if one_off:
+            _TARGET.warm = WarmState()
+        try:
+            return _dispatch(cfg, sq)
+        finally:
+            if one_off:
+                _TARGET.warm.close()
+                _TARGET.warm = None
+            _TARGET.pg = None
+
+    run: Callable[[Config, SquareClient], int]
+    # Single-item mode: sync exactly one Square ITEM by id; do not read/write cursor state.
+    if cfg.item_id:
+        mode, run = "single_item", _run_single_item
+    elif cfg.refresh_tiers:
+        mode, run = "refresh_tiers", _run_refresh_tiers
+    elif "products" not in cfg.stages:
+        mode, run = "stages", _run_targeted_stages
+    elif cfg.plan:
+        return _run_plan(cfg, sq)
+    else:
+        mode, run = "catalog", _run_catalog_sync
+    if cfg.dry_run or "run_log" not in cfg.stages:
+        return run(cfg, sq)
+
+    # run_log: record the run (and its batches) in CATALOG_SYNC_RUNS_TABLE, whatever the outcome,
+    # on the connection the run released last (no extra connect, e.g. to a scaled-to-zero Neon).
+    history = RunHistory(mode)
+    _TARGET.history = history
+    pg = _pg_connections(cfg)
+    pg.keep_last = True
+    status, error = "error", None
+    try:
+        rc = run(cfg, sq)
+        status = "ok" if rc == 0 else "failed"
+        return rc
+    except BaseException as e:
+        error = _truncate(str(e), 500)
+        raise
+    finally:
+        _TARGET.history = None
+        try:
+            _record_run(cfg, sq, history, status=status, error=error)
+        finally:
+            pg.close()
+
+
+def _target_path(path: str, name: str) -> str:
+    """scripts/catalog_sync_state.json -> scripts/catalog_sync_state.<name>.json"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+def _target_config(argv: List[str], spec: Dict[str, Any]) -> Config:
+    """
+    Config for one --targets entry: the shared command line plus the entry's "args", with its own
+    token, DSN, locations and tables. State, tier state and dead-letter files get a .<name> suffix
+    (unless "state_path" is given) and --snapshot-dir a <name> subdirectory.
+    """
+    name = spec.get("name") if isinstance(spec, dict) else None
+    if not isinstance(name, str) or not TARGET_NAME_RE.match(name):
+        raise SystemExit(f"--targets: every target needs a name of letters, digits, - or _ (got {name!r})")
+    cfg = load_config(argv + [str(a) for a in spec.get("args") or []])
+    token_env = spec.get("access_token_env") or "SQUARE_ACCESS_TOKEN"
+    token = _get_env(token_env)
+    if not token:
+        raise SystemExit(f"--targets: target {name!r} needs env var {token_env}")
+    pg_dsn = _get_env(spec["pg_dsn_env"]) if spec.get("pg_dsn_env") else cfg.pg_dsn
+    if not pg_dsn:
+        raise SystemExit(f"--targets: target {name!r} has no Postgres DSN ({spec.get('pg_dsn_env') or 'PG_DSN'})")
+    locations = tuple(str(x) for x in spec.get("location_ids") or ()) or cfg.square_location_ids
+    state_path = os.path.abspath(spec["state_path"]) if spec.get("state_path") else _target_path(cfg.state_path, name)
+    return replace(
+        cfg,
+        square_access_token=token,
+        pg_dsn=pg_dsn,
+        square_location_id=locations[0],
+        square_location_ids=locations,
+        state_path=state_path,
+        tier_state_path=_target_path(cfg.tier_state_path, name),
+        category_state_path=_target_path(cfg.category_state_path, name),
+        dead_letter_path=_target_path(cfg.dead_letter_path, name),
+        snapshot_dir=os.path.join(cfg.snapshot_dir, name) if cfg.snapshot_dir else None,
+        targets_path=None,
+        **{k: _ident(str(spec[k])) for k in TARGET_TABLE_KEYS if spec.get(k)},
+    )
+
+
+def _run_targets(cfg: Config, argv: List[str]) -> int:
+    """
+    --targets FILE: run every target through the usual mode (catalog, --item-id, --refresh-tiers,
+    --stages) on a thread pool of max_concurrency workers. Each target has its own Config, state
+    files, Postgres connection and SquareClient; clients with the same access token share one
+    RateLimiter. A failing target does not stop the others. Summaries are reported per target.
+    """
+    spec = _load_json_file(cfg.targets_path or "")
+    entries = spec.get("targets") if isinstance(spec, dict) else None
+    if not entries:
+        raise SystemExit(f"--targets: no targets in {cfg.targets_path}")
+    configs: Dict[str, Config] = {}
+    for entry in entries:
+        target_cfg = _target_config(argv, entry)
+        if entry["name"] in configs:
+            raise SystemExit(f"--targets: duplicate target name {entry['name']!r}")
+        configs[entry["name"]] = target_cfg
+
+    max_concurrency = max(1, int(spec.get("max_concurrency") or TARGET_MAX_CONCURRENCY))
+    per_second = max(0.1, float(spec.get("requests_per_second") or TARGET_REQUESTS_PER_SECOND))
+    limiters: Dict[str, RateLimiter] = {}
+    for target_cfg in configs.values():
+        limiters.setdefault(target_cfg.square_access_token, RateLimiter(per_second))
+
+    def run_one(name: str, target_cfg: Config) -> Dict[str, Any]:
+        _TARGET.name = name
+        _TARGET.summary = None
+        started = time.monotonic()
+        result: Dict[str, Any] = {
+            "location_ids": list(target_cfg.square_location_ids),
+            "products_table": target_cfg.products_table,
+            "state_path": target_cfg.state_path,
+        }
+        try:
+            rc = _dispatch(target_cfg, SquareClient(target_cfg, limiters[target_cfg.square_access_token]))
+            result.update(ok=rc == 0, exit_code=rc)
+        except (Exception, SystemExit) as e:
+            result.update(ok=False, error=_truncate(str(e), 500), error_type=type(e).__name__)
+        finally:
+            result.update(summary=_TARGET.summary, elapsed_s=round(time.monotonic() - started, 3))
+            _TARGET.name = None
+            _TARGET.summary = None
+        _emit("target_end", target=name, ok=result["ok"], elapsed_s=result["elapsed_s"])
+        return result
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="catalog-sync-target") as pool:
+        futures = {name: pool.submit(run_one, name, target_cfg) for name, target_cfg in configs.items()}
+        results = {name: f.result() for name, f in futures.items()}
+
+    _report(
+        {
+            "mode": "targets",
+            "targets": results,
+            "targets_path": cfg.targets_path,
+            "max_concurrency": max_concurrency,
+            "requests_per_second": per_second,
+            "elapsed_s": round(time.monotonic() - started, 3),
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+            "sql_timings_report": _SQL_TIMINGS.report_path if _SQL_TIMINGS is not None else None,
+            "dry_run": cfg.dry_run,
+        }
+    )
+    return 0 if all(r["ok"] for r in results.values()) else 1
+
+
+class WarmState:
+    """
+    What --item-id runs keep between syncs: the Postgres connection (and the column checks made
+    on it), the category index and a SquareClient per access token (its HTTP session stays open).
+    A --serve daemon keeps one for its lifetime; a plain --item-id run uses a fresh one, so its
+    run row is written on the item's connection.
+    """
+
+    def __init__(self) -> None:
+        self.conn: Any = None
+        self.conn_key: Optional[Tuple[str, str]] = None
+        # "pooler" / "direct" for the connection in use; "reused" once a later run takes it over.
+        self.connected_via: Optional[str] = None
+        self.born = 0.0
+        self.last_used = 0.0
+        self._memo: Dict[Tuple[str, ...], Any] = {}
+        # (dsn, categories table) -> (monotonic time the index was current, index)
+        self.categories: Dict[Tuple[str, str], Tuple[float, CategoryIndex]] = {}
+        self._clients: Dict[Tuple[str, str, str, int], SquareClient] = {}
+
+    def client(self, cfg: Config) -> SquareClient:
+        key = (cfg.square_access_token, cfg.square_base_url, cfg.square_version, cfg.timeout_s)
+        sq = self._clients.get(key)
+        if sq is None:
+            sq = self._clients[key] = SquareClient(cfg)
+        # Stats are per run (run history metrics).
+        sq.stats = dict.fromkeys(sq.stats, 0)
+        return sq
+
+    def connection(self, cfg: Config) -> Any:
+        """
+        The warm connection (pinged when it sat idle, replaced once --pg-recycle-min old), or a new
+        one: PG_POOLER_DSN first, then PG_DSN.
+        """
+        pg = _pg_connections(cfg)
+        key = (cfg.pg_pooler_dsn or "", cfg.pg_dsn)
+        conn = self.conn
+        if conn is not None and self.conn_key == key and not conn.closed and not getattr(conn, "broken", False):
+            now = time.monotonic()
+            if cfg.pg_recycle_s and now - self.born >= cfg.pg_recycle_s:
+                pg.recycled += 1
+            elif now - self.last_used <= WARM_PING_AFTER_S or pg.ping(conn):
+                _safe_rollback(conn)
+                self.connected_via = "reused"
+                self.last_used = now
+                return conn
+        self.close()
+        conn = None
+        if cfg.pg_pooler_dsn:
+            try:
+                # Poolers in transaction mode cannot keep server-side prepared statements.
+                conn = pg.open(cfg.pg_pooler_dsn, connect_timeout=PG_POOLER_CONNECT_TIMEOUT_S, prepare_threshold=None)
+                self.connected_via = "pooler"
+            except Exception as e:
+                _emit("pg_pooler_unavailable", error=_truncate(str(e), 300))
+        if conn is None:
+            conn = pg.open()
+            self.connected_via = "direct"
+        self.conn, self.conn_key = conn, key
+        self.born = self.last_used = time.monotonic()
+        return conn
+
+    def memo(self, key: Tuple[str, ...], compute: Callable[[], Any]) -> Any:
+        """compute() once per key, e.g. (dsn, check, table) for the optional-column checks."""
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def reset(self) -> None:
+        """After a failed run: start the next one from a new connection and fresh checks."""
+        self.close()
+        self._memo.clear()
+
+    def close(self) -> None:
+        if self.conn is not None:
+            _safe_close(self.conn)
+        self.conn = None
+        self.conn_key = None
+
+
+def _mark_categories_crawled(cfg: Config) -> None:
     """
-    Extract ITEM_VARIATION ids from Square catalog ITEM objects.
-    Returns de-duplicated ids in stable order.
+    Record a full category crawl (categories_crawled_ts), which --item-id runs compare with
+    --item-category-max-age-m. It has its own file (--category-state) because item, daemon and
+    --stages runs write it: only catalog runs may rewrite the cursor state file.
     """
-    out: List[str] = []
-    seen = set()
-    for obj in objects or []:
-        try:
-            if (obj or {}).get("type") != "ITEM":
-                continue
-            item_data = (obj or {}).get("item_data") or {}
-            variations = item_data.get("variations") or []
-            for v in variations:
-                if not isinstance(v, dict):
-                    continue
-                if v.get("type") != "ITEM_VARIATION":
-                    continue
-                vid = v.get("id")
-                if not isinstance(vid, str) or not vid.strip():
-                    continue
-                if vid in seen:
-                    continue
-                seen.add(vid)
-                out.append(vid)
-        except Exception:
-            continue
-    return out
+    with contextlib.suppress(Exception):
+        _atomic_write_json(cfg.category_state_path, {"categories_crawled_ts": time.time()})
 
 
-def _refresh_inventory_counts_for_variations(cfg: Config, sq: SquareClient, conn: Any, variation_ids: List[str]) -> int:
+def _item_category_index(
+    cfg: Config, sq: SquareClient, conn: Any, warm: WarmState
+) -> Tuple[int, Optional[CategoryIndex], str]:
     """
-    Refresh stock_count for the given Square variation ids.
-    Uses IN_STOCK counts; ids not present in the response are treated as 0 in-stock.
+    Category index for an --item-id run, cheapest first: the daemon's copy, the categories table
+    when the last full crawl (_mark_categories_crawled) is within --item-category-max-age-m, else
+    the full crawl (_sync_categories). The table's synced_at cannot tell: item runs upsert their
+    own categories. Returns (categories upserted, index, source: "warm" / "table" / "crawl").
     """
-    if cfg.dry_run:
-        return 0
-
-    if not variation_ids:
-        return 0
+    key = (cfg.pg_dsn, cfg.categories_table)
+    max_age = cfg.item_category_max_age_s
+    if max_age > 0:
+        cached = warm.categories.get(key)
+        if cached is not None and time.monotonic() - cached[0] < max_age:
+            return 0, cached[1], "warm"
+        crawled_ts = _load_json_file(cfg.category_state_path).get("categories_crawled_ts")
+        age = time.time() - crawled_ts if isinstance(crawled_ts, (int, float)) else None
+        if age is not None and 0 <= age < max_age:
+            index = _load_category_index(cfg, conn)
+            warm.categories[key] = (time.monotonic() - age, index)
+            return 0, index, "table"
+    processed, index = _sync_categories(cfg, sq, conn)
+    if index is not None:
+        _mark_categories_crawled(cfg)
+        warm.categories[key] = (time.monotonic(), index)
+    return processed, index, "crawl"
+
+
+def _run_single_item(cfg: Config, sq: SquareClient) -> int:
+    # Set by _dispatch (or the --serve daemon) for every run that writes.
+    warm: Optional[WarmState] = getattr(_TARGET, "warm", None)
+    conn = None
+    columns: FrozenSet[str] = frozenset()
+    if warm is not None and not cfg.dry_run:
+        conn = warm.connection(cfg)
+        key = (cfg.pg_dsn, "products_columns", cfg.products_table)
+        columns = warm.memo(key, lambda: _ensure_products_columns(cfg, conn))
+        _prepare_run_history(cfg, conn)
 
-    inv_sql = UPDATE_INVENTORY_SQL_TEMPLATE.format(products_table=cfg.products_table)
-    total_updated = 0
+    categories_processed = 0
+    categories_source: Optional[str] = None
+    category_index: Optional[CategoryIndex] = None
+    upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0, "unchanged_count": 0}
+    inv_rows = 0
+    img_rows = 0
+    cat_denorm = False
+    albums_cache_result: Optional[Dict[str, Any]] = None
 
-    # Square supports up to 1000 catalog_object_ids per request.
-    CHUNK = 1000
-    for i in range(0, len(variation_ids), CHUNK):
-        chunk = variation_ids[i : i + CHUNK]
-        inv_payload = sq.batch_inventory_counts(catalog_object_ids=chunk)
-        counts = inv_payload.get("counts") or []
-
-        # Build a payload that explicitly includes all requested ids (missing => 0).
-        qty_by_id: Dict[str, int] = {}
-        calc_by_id: Dict[str, Optional[str]] = {}
-        for c in counts:
-            if not isinstance(c, dict):
-                continue
-            vid = c.get("catalog_object_id")
-            if not isinstance(vid, str) or not vid.strip():
-                continue
-            qraw = c.get("quantity")
+    try:
+        if warm is not None and conn is not None:
             try:
-                qty = int(qraw) if qraw is not None and str(qraw).strip() != "" else 0
+                categories_processed, category_index, categories_source = _item_category_index(cfg, sq, conn, warm)
             except Exception:
-                qty = 0
-            qty_by_id[vid] = max(0, qty)
-            calc = c.get("calculated_at")
-            calc_by_id[vid] = calc if isinstance(calc, str) and calc.strip() else None
-
-        expanded: List[dict] = []
-        for vid in chunk:
-            expanded.append(
-                {
-                    "catalog_object_type": "ITEM_VARIATION",
-                    "catalog_object_id": vid,
-                    "location_id": cfg.square_location_id,
-                    "quantity": str(qty_by_id.get(vid, 0)),
-                    "calculated_at": calc_by_id.get(vid),
-                }
-            )
-
-        with conn.cursor() as cur:
-            cur.execute(inv_sql, (json.dumps(expanded), cfg.square_location_id))
-            total_updated += cur.rowcount or 0
-
-    return total_updated
+                _safe_rollback(conn)
+                categories_processed = 0
 
+        payload = sq.catalog_get_object(cfg.item_id, include_related_objects=True)
+        obj = payload.get("object") or {}
+        related_objects = payload.get("related_objects") or []
+        records = _project_catalog_objects([obj] if obj else [])
+        images = _project_image_objects(related_objects)
+
+        # Without a crawl, the item's own categories (its related objects) still come in fresh.
+        item_categories = [o for o in related_objects if isinstance(o, dict) and o.get("type") == "CATEGORY"]
+        if category_index is not None and categories_source != "crawl" and item_categories:
+            for o in item_categories:
+                category_index.add(o)
+            upsert_sql = UPSERT_CATEGORIES_SQL_TEMPLATE.format(categories_table=cfg.categories_table)
+            with conn.cursor() as cur:
+                _execute(cur, "upsert_categories", upsert_sql, (_json_param(item_categories),))
+            categories_processed += len(item_categories)
+
+        upsert_counts, inv_rows, img_rows, cat_denorm = _apply_catalog_batch(
+            cfg,
+            sq,
+            records=records,
+            images=images,
+            conn=conn,
+            columns=columns,
+            categories=category_index,
+        )
 
-def main(argv: Optional[List[str]] = None) -> int:
-    cfg = load_config(argv)
-    sq = SquareClient(cfg)
+        if conn is not None:
+            conn.commit()
+    except Exception:
+        if conn is not None:
+            _safe_rollback(conn)
+        raise
 
-    # Single-item mode: sync exactly one Square ITEM by id; do not read/write cursor state.
-    if cfg.item_id:
-        if psycopg is None and not cfg.dry_run:
-            _ensure_psycopg()
+    if cfg.rebuild_albums_cache and (not cfg.dry_run):
+        albums_cache_result = _rebuild_albums_cache(cfg)
+        if albums_cache_result.get("attempted") and not albums_cache_result.get("ok"):
+            _send_make_alert_email(
+                alert_code="SYNC-ALBUMS-CACHE",
+                title="albums_cache rebuild failed (after single-item sync)",
+                error=str(albums_cache_result),
+                context={"stage": "sync.albums_cache", "itemId": cfg.item_id},
+                stack=None,
+                severity="warning",
+            )
 
-        conn = None
-        if not cfg.dry_run:
-            conn = _connect_pg(cfg)
+    _report(
+        {
+            "mode": "single_item",
+            "item_id": cfg.item_id,
+            "categories_processed": categories_processed,
+            "categories_source": categories_source,
+            "category_index_size": len(category_index) if category_index is not None else None,
+            "pg_connection": warm.connected_via if warm is not None and conn is not None else None,
+            "products": upsert_counts,
+            "inventory_rows_updated": inv_rows,
+            "image_rows_updated": img_rows,
+            "category_denorm_attempted": cat_denorm,
+            "albums_cache_rebuild": albums_cache_result,
+            "diff_enabled": cfg.diff and "sync_fingerprint" in columns,
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+            "profile_report": _PROFILER.report_path if _PROFILER is not None else None,
+            "sql_timings_report": _SQL_TIMINGS.report_path if _SQL_TIMINGS is not None else None,
+            "dry_run": cfg.dry_run,
+            "square_version": cfg.square_version,
+            "square_location_id": cfg.square_location_id,
+            "products_table": cfg.products_table,
+        }
+    )
+    return 0
 
-        categories_processed = 0
-        upsert_counts = {"inserted_count": 0, "updated_count": 0, "total_upserted": 0}
-        inv_rows = 0
-        img_rows = 0
-        cat_denorm = False
-        albums_cache_result: Optional[Dict[str, Any]] = None
 
+def _forward_to_daemon(cfg: Config, argv: List[str]) -> Optional[int]:
+    """
+    --daemon-socket: send this --item-id run to a --serve daemon, print its summary and return its
+    exit code. None when no daemon answers (no socket, or a stale one), so main runs the item here.
+    """
+    path = cfg.daemon_socket or ""
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    started = time.monotonic()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(DAEMON_CONNECT_TIMEOUT_S)
         try:
-            if not cfg.dry_run and conn is not None:
-                try:
-                    categories_processed = _sync_categories(cfg, sq, conn)
-                except Exception:
-                    categories_processed = 0
-
-            payload = sq.catalog_get_object(cfg.item_id, include_related_objects=True)
-            obj = payload.get("object") or {}
-            related = payload.get("related_objects") or []
-            objects = [obj] if obj else []
-
-            upsert_counts, inv_rows, img_rows, cat_denorm = _apply_catalog_batch(
-                cfg,
-                sq,
-                objects=objects,
-                related_objects=related,
-                conn=conn,
-            )
+            sock.connect(path)
+        except OSError:
+            return None
+        # Sent: from here on the daemon owns the run (no local retry that could apply it twice).
+        sock.settimeout(DAEMON_REPLY_TIMEOUT_S)
+        sock.sendall(json.dumps({"argv": argv}).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            line = f.readline()
+    if not line:
+        raise RuntimeError(f"catalog sync daemon at {path} closed the connection without a reply")
+    reply = json.loads(line)
+    summary = reply.get("summary")
+    if isinstance(summary, dict):
+        summary["daemon"] = {"socket": path, "round_trip_s": round(time.monotonic() - started, 3)}
+        _report(summary)
+    if reply.get("error"):
+        print(f"catalog sync daemon: {reply['error']}", file=sys.stderr)
+    return int(reply.get("exit_code") if reply.get("exit_code") is not None else 1)
+
+
+def _serve_request(line: bytes, warm: WarmState) -> Dict[str, Any]:
+    """One --serve request: {"argv": [...]} -> {"exit_code", "summary", "error", "elapsed_s"}."""
+    started = time.monotonic()
+    reply: Dict[str, Any] = {"exit_code": 1, "summary": None, "error": None}
+    item_id = None
+    _TARGET.warm, _TARGET.capture, _TARGET.summary = warm, True, None
+    try:
+        argv = [str(a) for a in (json.loads(line) or {}).get("argv") or []]
+        cfg = load_config(argv)
+        item_id = cfg.item_id
+        if not cfg.item_id or cfg.serve_socket or cfg.targets_path:
+            raise SystemExit("the daemon only runs --item-id syncs")
+        reply["exit_code"] = _dispatch(cfg, warm.client(cfg))
+    except SystemExit as e:
+        # argparse errors exit with code 2 and print their message on the daemon's stderr.
+        reply["exit_code"] = e.code if isinstance(e.code, int) else 1
+        reply["error"] = str(e.code) if not isinstance(e.code, int) else f"invalid arguments (exit {e.code})"
+    except Exception as e:
+        traceback.print_exc()
+        reply["error"] = f"{type(e).__name__}: {_truncate(str(e), 500)}"
+        warm.reset()
+    finally:
+        reply["summary"] = _TARGET.summary
+        _TARGET.warm, _TARGET.capture, _TARGET.summary = None, False, None
+    reply["elapsed_s"] = round(time.monotonic() - started, 3)
+    _emit("daemon_request", item_id=item_id, exit_code=reply["exit_code"], elapsed_s=reply["elapsed_s"])
+    return reply
 
-            if conn is not None:
-                conn.commit()
-        except Exception:
-            if conn is not None:
-                _safe_rollback(conn)
-            raise
-        finally:
-            if conn is not None:
-                _safe_close(conn)
 
-        if cfg.rebuild_albums_cache and (not cfg.dry_run):
-            albums_cache_result = _rebuild_albums_cache(cfg)
-            if albums_cache_result.get("attempted") and not albums_cache_result.get("ok"):
-                _send_make_alert_email(
-                    alert_code="SYNC-ALBUMS-CACHE",
-                    title="albums_cache rebuild failed (after single-item sync)",
-                    error=str(albums_cache_result),
-                    context={"stage": "sync.albums_cache", "itemId": cfg.item_id},
-                    stack=None,
-                    severity="warning",
-                )
+def _run_serve(cfg: Config) -> int:
+    """
+    --serve PATH: answer --item-id runs sent by clients with --daemon-socket PATH, one at a time.
+    Imports, the Postgres connection, optional-column checks, the category index and Square's
+    HTTP session stay warm between runs (see WarmState). Each run uses the client's arguments and
+    the daemon's environment; --events, --profile, --sql-timings and --json-codec come from the
+    daemon's own command line. SIGTERM or Ctrl-C stops it.
+    """
+    path = cfg.serve_socket or ""
+    if not hasattr(socket, "AF_UNIX"):
+        raise SystemExit("--serve needs unix domain sockets")
+    _ensure_psycopg()
+    if os.path.exists(path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)  # left behind by a daemon that did not shut down cleanly
+            else:
+                raise SystemExit(f"--serve: a daemon is already listening on {path}")
+
+    warm = WarmState()
+    counts = {"requests": 0, "failed": 0}
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self) -> None:
+            reply = _serve_request(self.rfile.readline(DAEMON_MAX_REQUEST_BYTES), warm)
+            counts["requests"] += 1
+            counts["failed"] += 1 if reply["exit_code"] else 0
+            self.wfile.write(json.dumps(reply, default=str).encode("utf-8") + b"\n")
+
+    def stop(signum: int, frame: Any) -> None:
+        raise KeyboardInterrupt
+
+    umask = os.umask(0o177)  # socket file readable and writable by this user only
+    try:
+        server = socketserver.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, stop)
+    started = time.monotonic()
+    _emit("serve_start", socket=path, pid=os.getpid())
+    print(f"catalog sync daemon listening on {path}", file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        warm.close()
+
+    _report(
+        {
+            "mode": "serve",
+            "socket": path,
+            **counts,
+            "uptime_s": round(time.monotonic() - started, 3),
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+        }
+    )
+    return 0
 
-        print(
-            json.dumps(
-                {
-                    "mode": "single_item",
-                    "item_id": cfg.item_id,
-                    "categories_processed": categories_processed,
-                    "products": upsert_counts,
-                    "inventory_rows_updated": inv_rows,
-                    "image_rows_updated": img_rows,
-                    "category_denorm_attempted": cat_denorm,
-                    "albums_cache_rebuild": albums_cache_result,
-                    "dry_run": cfg.dry_run,
-                    "square_version": cfg.square_version,
-                    "square_location_id": cfg.square_location_id,
-                    "products_table": cfg.products_table,
-                },
-                indent=2,
-                sort_keys=True,
-            )
-        )
-        return 0
 
+def _run_catalog_sync(cfg: Config, sq: SquareClient) -> int:
+    pacer = BatchPacer(cfg.time_budget_s)
+    history: Optional[RunHistory] = getattr(_TARGET, "history", None)
     state = _load_json_file(cfg.state_path)
     today = _utc_today_str()
+    # Seconds the post-batch steps took last time, for pacer.fits().
+    step_s = state.get("post_step_s") if isinstance(state.get("post_step_s"), dict) else {}
+    state["post_step_s"] = step_s
 
     # Mirror Make datastore keys
     last_reset = state.get("inventory_last_reset_date")
@@ -1289,6 +5104,22 @@ def main(argv: Optional[List[str]] = None) -> int:
         if not cfg.dry_run:
             _atomic_write_json(cfg.state_path, state)
 
+    # Pages since the cursor last started from the beginning (progress estimate for --events).
+    position = int(state.get("catalog_items_pages") or 0) if cursor else 0
+
+    # No pass in progress and Square reports no changes since the last completed one:
+    # nothing to crawl, so only the inventory stage runs.
+    watermark = state.get("catalog_watermark")
+    if cfg.fast_path and cfg.diff and cursor is None and isinstance(watermark, str) and watermark:
+        if not sq.catalog_changed_since(watermark):
+            _emit("fast_path", watermark=watermark)
+            return _run_targeted_stages(
+                replace(cfg, stages=cfg.stages & {"inventory"}), sq, unchanged_since=watermark, pacer=pacer, state=state
+            )
+    if cursor is None:
+        pass_started = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=CATALOG_WATERMARK_SKEW_S)
+        state["catalog_pass_started_at"] = pass_started.strftime("%Y-%m-%dT%H:%M:%SZ")
+
     if cfg.dry_run:
         print(f"[DRY RUN] Would read/write state at: {cfg.state_path}")
 
@@ -1296,90 +5127,267 @@ def main(argv: Optional[List[str]] = None) -> int:
         _ensure_psycopg()
 
     # Connect to Postgres (unless dry-run)
+    pg = _pg_connections(cfg)
     conn = None
+    columns: FrozenSet[str] = frozenset()
+    index_status: Optional[Dict[str, str]] = None
     if not cfg.dry_run:
-        conn = _connect_pg(cfg)
+        conn = pg.acquire()
+        columns = _ensure_products_columns(cfg, conn)
+        _prepare_run_history(cfg, conn)
+        if cfg.ensure_indexes:
+            index_status = _ensure_products_indexes(cfg, conn)
 
     pages = 0
     total_inserted = 0
     total_updated = 0
     total_upserted = 0
+    total_unchanged = 0
     total_inventory_updates = 0
     total_image_updates = 0
     any_category_denorm = False
     categories_processed = 0
+    category_index: Optional[CategoryIndex] = None
+    analyzed = False
+    bisected_batches = 0
+    dead_lettered: List[str] = []
+    image_cache = RelatedObjectCache(cfg.related_cache_size)
+    inventory_strategy = "ids"
+    inventory_snapshot: Optional[Dict[str, dict]] = None
+    snapshot_summary: Optional[Dict[str, int]] = None
     albums_cache_result: Optional[Dict[str, Any]] = None
+    batch_no = 0
+    est_total_pages: Optional[int] = None
 
     try:
+        if _EVENTS is not None and conn is not None:
+            with contextlib.suppress(Exception):
+                with conn.cursor() as cur:
+                    sql = COUNT_PRODUCTS_SQL_TEMPLATE.format(products_table=cfg.products_table)
+                    _execute(cur, "count_products", sql)
+                    items = int((cur.fetchone() or (0, 0))[1] or 0)
+                conn.commit()
+                est_total_pages = -(-items // CATALOG_ITEMS_PER_PAGE) if items else None
+        _emit(
+            "crawl_start",
+            resumed=bool(cursor),
+            position=position,
+            est_total_pages=est_total_pages,
+            max_pages=cfg.max_pages,
+            daily_reset=did_daily_reset,
+        )
+
         # Categories are required for category-name denormalization; sync them first.
-        if not cfg.dry_run and conn is not None:
+        if not cfg.dry_run and conn is not None and "categories" in cfg.stages:
             try:
-                categories_processed = _sync_categories(cfg, sq, conn)
+                categories_processed, category_index = _sync_categories(cfg, sq, conn)
+                _mark_categories_crawled(cfg)
             except Exception:
-                # Best-effort: if categories table doesn't exist or API call fails, keep going.
+                # Best-effort: if categories table doesn't exist or API call fails, keep going
+                # (category names then fall back to the SQL denormalization).
+                _safe_rollback(conn)
                 categories_processed = 0
+            _emit("categories", processed=categories_processed, indexed=category_index is not None)
+        elif conn is not None:
+            # Categories stage not selected: resolve names from what the last sync stored.
+            try:
+                category_index = _load_category_index(cfg, conn)
+                conn.commit()
+            except Exception:
+                _safe_rollback(conn)
+
+        # Large runs: one paginated location snapshot up front instead of a counts call per batch.
+        # Batches then take stock for new/changed rows from the snapshot. The pacer's clock is
+        # already running, so the snapshot counts against --time-budget.
+        if conn is not None and "inventory" in cfg.stages:
+            inventory_strategy = _choose_inventory_strategy(cfg, conn, state)
+        if inventory_strategy == "snapshot" and conn is not None:
+            snapshot_started = time.monotonic()
+            with _stage("inventory.snapshot"):
+                inventory_snapshot, snapshot_calls = _fetch_inventory_snapshot(cfg, sq)
+                snapshot_rows = _apply_inventory_snapshot(cfg, conn, inventory_snapshot)
+                conn.commit()
+            state["inventory_snapshot_s"] = round(time.monotonic() - snapshot_started, 3)
+            total_inventory_updates += snapshot_rows
+            snapshot_summary = {
+                "counts": len(inventory_snapshot),
+                "api_calls": snapshot_calls,
+                "rows_updated": snapshot_rows,
+            }
+            _emit("inventory_snapshot", **snapshot_summary)
 
         while pages < cfg.max_pages:
+            # With --time-budget, only start a batch that is predicted to finish in time.
+            batch_limit = pacer.pages_allowed(min(cfg.upsert_batch_pages, cfg.max_pages - pages))
+            if batch_limit == 0:
+                _emit("time_budget_stop", pages=pages, position=position, budget_s=cfg.time_budget_s)
+                break
+            batch_started = time.monotonic()
+            batch_started_at = dt.datetime.now(dt.timezone.utc)
+            batch_calls = sq.stats["calls"]
+            batch_no += 1
+            _emit("batch_start", batch=batch_no, pages_planned=batch_limit, position=position)
+
             # Fetch N pages first, then apply as a single DB upsert batch.
-            batch_objects: List[dict] = []
-            batch_related: List[dict] = []
-            batch_pages = 0
-            start_cursor = cursor
-
-            while batch_pages < cfg.upsert_batch_pages and pages + batch_pages < cfg.max_pages:
-                objs, rel, new_cursor = _fetch_catalog_page(sq, cursor=cursor)
-                batch_objects.extend(objs)
-                batch_related.extend(rel)
-                batch_pages += 1
-                cursor = new_cursor
-                if not cursor:
-                    break
+            batch_records, batch_images, batch_pages, cursor = _fetch_catalog_batch(
+                sq, cursor=cursor, max_pages=batch_limit, batch_no=batch_no, position=position
+            )
+
+            # The connection sat idle while the pages were fetched: check it (or recycle it) first.
+            if conn is not None:
+                conn = pg.ready(conn)
 
             batch_attempt = 0
+            bisect_error: Optional[Exception] = None
+            batch_dead_letters: List[Dict[str, Any]] = []
             while True:
                 batch_attempt += 1
                 try:
-                    counts, inv_rows, img_rows, cat_denorm = _apply_catalog_batch(
-                        cfg,
-                        sq,
-                        objects=batch_objects,
-                        related_objects=batch_related,
-                        conn=conn,
-                    )
+                    batch_dead_letters = []
+                    if bisect_error is None:
+                        counts, inv_rows, img_rows, cat_denorm = _apply_catalog_batch(
+                            cfg,
+                            sq,
+                            records=batch_records,
+                            images=batch_images,
+                            conn=conn,
+                            columns=columns,
+                            categories=category_index,
+                            image_cache=image_cache,
+                            inventory_snapshot=inventory_snapshot,
+                        )
+                    else:
+                        counts, inv_rows, img_rows, cat_denorm = _bisect_catalog_batch(
+                            cfg,
+                            sq,
+                            records=batch_records,
+                            images=batch_images,
+                            conn=conn,
+                            columns=columns,
+                            categories=category_index,
+                            error=bisect_error,
+                            dead_letters=batch_dead_letters,
+                            image_cache=image_cache,
+                            inventory_snapshot=inventory_snapshot,
+                        )
                     if conn is not None:
+                        if history is not None and history.batch_rows() and cfg.run_batch_rows:
+                            _insert_run_batch(
+                                cfg,
+                                conn,
+                                history,
+                                batch_no=batch_no,
+                                started_at=batch_started_at,
+                                counts=counts,
+                                metrics={
+                                    "pages": batch_pages,
+                                    "variations": len(batch_records),
+                                    "images": len(batch_images),
+                                    "unchanged": counts.get("unchanged_count", 0),
+                                    "inventory_rows": inv_rows,
+                                    "image_rows": img_rows,
+                                    "attempts": batch_attempt,
+                                    "bisected": bisect_error is not None,
+                                    "dead_lettered": len(batch_dead_letters),
+                                    "square_calls": sq.stats["calls"] - batch_calls,
+                                    "seconds": round(time.monotonic() - batch_started, 3),
+                                },
+                            )
                         conn.commit()
+                        image_cache.mark(batch_images)
+                        if history is not None:
+                            history.batches += 1
                     pages += batch_pages
                     break
                 except Exception as e:
                     if conn is not None:
                         _safe_rollback(conn)
+                    # Data errors are bisected (retrying the same rows would fail the same way); a
+                    # statement timeout is not bisectable and is retried below via its "timeout" message.
+                    if conn is not None and bisect_error is None and _is_bisectable_db_error(e):
+                        bisect_error = e
+                        bisected_batches += 1
+                        _emit("bisect", batch=batch_no, error=_truncate(str(e), 300))
+                        continue
                     if (not cfg.dry_run) and batch_attempt <= 3 and _is_retryable_db_error(e):
-                        _safe_close(conn)
-                        conn = _connect_pg(cfg)
+                        _emit("retry", batch=batch_no, attempt=batch_attempt, error=_truncate(str(e), 300))
+                        conn = pg.reconnect(conn)
                         time.sleep(0.5 * (2 ** (batch_attempt - 1)))
-                        # Re-apply same batch (do not advance cursor/state)
-                        cursor = start_cursor
+                        # Re-apply the records already fetched; the cursor after them is only saved once
+                        # the batch commits, so the pages are not fetched again.
                         continue
                     raise
 
+            if batch_dead_letters:
+                _append_jsonl(cfg.dead_letter_path, batch_dead_letters)
+                dead_lettered.extend(str(d.get("object_id")) for d in batch_dead_letters)
+                # Skipped objects must be retried by the next pass, so this one sets no watermark.
+                state.pop("catalog_pass_started_at", None)
+
             total_inserted += counts.get("inserted_count", 0)
             total_updated += counts.get("updated_count", 0)
             total_upserted += counts.get("total_upserted", 0)
+            total_unchanged += counts.get("unchanged_count", 0)
             total_inventory_updates += inv_rows
             total_image_updates += img_rows
             any_category_denorm = any_category_denorm or cat_denorm
 
+            batch_s = time.monotonic() - batch_started
+            pacer.record(batch_pages, batch_s)
+            if pacer.per_page_s:
+                state["seconds_per_page"] = round(pacer.per_page_s, 3)
+
             # Persist cursor only after the DB commit succeeds (prevents skipping pages).
+            position = position + batch_pages if cursor else 0
             if not cfg.dry_run:
                 if cursor:
                     state["catalog_items"] = {"id": cursor}
+                    state["catalog_items_pages"] = position
                 else:
                     state.pop("catalog_items", None)
+                    state.pop("catalog_items_pages", None)
+                    # Pass complete: everything changed before it started is in Postgres.
+                    if state.get("catalog_pass_started_at"):
+                        state["catalog_watermark"] = state.pop("catalog_pass_started_at")
                 _atomic_write_json(cfg.state_path, state)
+                _emit("checkpoint", batch=batch_no, cursor_saved=bool(cursor), position=position)
+
+            if _EVENTS is not None:
+                remaining = 0 if not cursor else (max(0, est_total_pages - position) if est_total_pages else None)
+                run_left = min(remaining, cfg.max_pages - pages) if remaining is not None else None
+                _EVENTS.emit(
+                    "batch_end",
+                    batch=batch_no,
+                    pages=batch_pages,
+                    pages_total=pages,
+                    variations=len(batch_records),
+                    images=len(batch_images),
+                    products=counts,
+                    inventory_rows_updated=inv_rows,
+                    image_rows_updated=img_rows,
+                    dead_lettered=len(batch_dead_letters),
+                    attempts=batch_attempt,
+                    seconds=round(batch_s, 3),
+                    pages_per_min=round(batch_pages * 60.0 / batch_s, 2) if batch_s > 0 else None,
+                    est_remaining_pages=remaining,
+                    eta_s=round(run_left * pacer.per_page_s, 1) if run_left is not None and pacer.per_page_s else None,
+                    stages=_EVENTS.take_timings(),
+                )
 
             # Stop if Square cursor is exhausted.
             if not cursor:
                 break
+
+        # A skipped ANALYZE stays pending (in the state file) until a run has the time for it.
+        wants_analyze = cfg.analyze_min_rows and (total_inserted + total_updated) >= cfg.analyze_min_rows
+        if conn is not None and (wants_analyze or state.get("analyze_pending")):
+            if pacer.fits("analyze", step_s.get("analyze")):
+                step_started = time.monotonic()
+                analyzed = _analyze_products(cfg, conn)
+                step_s["analyze"] = round(time.monotonic() - step_started, 3)
+                state.pop("analyze_pending", None)
+            else:
+                state["analyze_pending"] = True
     except Exception:
         if conn is not None:
             _safe_rollback(conn)
@@ -1408,10 +5416,25 @@ def main(argv: Optional[List[str]] = None) -> int:
         raise
     finally:
         if conn is not None:
-            _safe_close(conn)
+            pg.release(conn)
 
-    if cfg.rebuild_albums_cache and (not cfg.dry_run):
+    if dead_lettered:
+        _send_make_alert_email(
+            alert_code="SYNC-DEAD-LETTER",
+            title=f"Catalog sync skipped {len(dead_lettered)} object(s)",
+            error=f"Objects failed even when applied one at a time; see {cfg.dead_letter_path}",
+            context={"stage": "sync.bisect", "objectIds": dead_lettered[:50], "deadLetterPath": cfg.dead_letter_path},
+            stack=None,
+            severity="warning",
+        )
+
+    if cfg.rebuild_albums_cache and (not cfg.dry_run) and not pacer.fits("albums_cache", step_s.get("albums_cache")):
+        albums_cache_result = {"attempted": False, "ok": True, "reason": "time_budget"}
+    elif cfg.rebuild_albums_cache and (not cfg.dry_run):
+        step_started = time.monotonic()
         albums_cache_result = _rebuild_albums_cache(cfg)
+        if albums_cache_result.get("attempted"):
+            step_s["albums_cache"] = round(time.monotonic() - step_started, 3)
         if albums_cache_result.get("attempted") and not albums_cache_result.get("ok"):
             _send_make_alert_email(
                 alert_code="SYNC-ALBUMS-CACHE",
@@ -1422,33 +5445,519 @@ def main(argv: Optional[List[str]] = None) -> int:
                 severity="warning",
             )
 
-    print(
-        json.dumps(
-            {
-                "daily_reset": did_daily_reset,
-                "pages_fetched": pages,
-                "cursor_saved": bool(cursor) and not cfg.dry_run,
-                "categories_processed": categories_processed,
-                "products": {
-                    "inserted_count": total_inserted,
-                    "updated_count": total_updated,
-                    "total_upserted": total_upserted,
-                },
-                "inventory_rows_updated": total_inventory_updates,
-                "image_rows_updated": total_image_updates,
-                "category_denorm_attempted": any_category_denorm,
-                "albums_cache_rebuild": albums_cache_result,
-                "dry_run": cfg.dry_run,
-                "state_path": cfg.state_path,
-                "square_version": cfg.square_version,
-                "square_location_id": cfg.square_location_id,
-                "products_table": cfg.products_table,
+    snapshot_result: Optional[Dict[str, Any]] = None
+    if cfg.snapshot_dir and not cfg.dry_run and not pacer.fits("snapshot", step_s.get("snapshot")):
+        snapshot_result = {"ok": True, "written": False, "reason": "time_budget"}
+    elif cfg.snapshot_dir and not cfg.dry_run:
+        step_started = time.monotonic()
+        snapshot_result = _write_catalog_snapshot(cfg)
+        step_s["snapshot"] = round(time.monotonic() - step_started, 3)
+        if not snapshot_result.get("ok"):
+            _send_make_alert_email(
+                alert_code="SYNC-SNAPSHOT",
+                title="Catalog snapshot failed (after catalog sync)",
+                error=str(snapshot_result.get("error")),
+                context={"stage": "sync.snapshot", "pagesFetched": pages, "snapshotDir": cfg.snapshot_dir},
+                stack=None,
+                severity="warning",
+            )
+
+    if not cfg.dry_run and (step_s or state.get("analyze_pending")):
+        with contextlib.suppress(Exception):
+            _atomic_write_json(cfg.state_path, state)
+
+    _report(
+        {
+            "daily_reset": did_daily_reset,
+            "pages_fetched": pages,
+            "cursor_saved": bool(cursor) and not cfg.dry_run,
+            "categories_processed": categories_processed,
+            "category_index_size": len(category_index) if category_index is not None else None,
+            "products": {
+                "inserted_count": total_inserted,
+                "updated_count": total_updated,
+                "total_upserted": total_upserted,
+                "unchanged_count": total_unchanged,
             },
-            indent=2,
-            sort_keys=True,
+            "inventory_rows_updated": total_inventory_updates,
+            "inventory_strategy": inventory_strategy,
+            "inventory_snapshot": snapshot_summary,
+            "image_rows_updated": total_image_updates,
+            "category_denorm_attempted": any_category_denorm,
+            "albums_cache_rebuild": albums_cache_result,
+            "catalog_snapshot": snapshot_result,
+            "diff_enabled": cfg.diff and "sync_fingerprint" in columns,
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+            "indexes": index_status,
+            "analyzed": analyzed,
+            "bisected_batches": bisected_batches,
+            "related_cache": image_cache.stats(),
+            "time_budget_s": cfg.time_budget_s,
+            "stopped_by_time_budget": pacer.stopped,
+            "skipped_by_time_budget": pacer.skipped,
+            "elapsed_s": round(pacer.elapsed(), 3),
+            "dead_lettered": len(dead_lettered),
+            "dead_letter_path": cfg.dead_letter_path if dead_lettered else None,
+            "profile_report": _PROFILER.report_path if _PROFILER is not None else None,
+            "sql_timings_report": _SQL_TIMINGS.report_path if _SQL_TIMINGS is not None else None,
+            "dry_run": cfg.dry_run,
+            "state_path": cfg.state_path,
+            "square_version": cfg.square_version,
+            "square_location_id": cfg.square_location_id,
+            "products_table": cfg.products_table,
+        }
+    )
+
+    return 0
+
+
+def _run_plan(cfg: Config, sq: SquareClient) -> int:
+    """
+    --plan: fetch the pages the next catalog run would fetch (same cursor, --max-pages and
+    --upsert-batch-pages) and report per batch what it would write. Postgres is only read
+    (read-only transactions) and the state file is never written.
+    """
+    state = _load_json_file(cfg.state_path)
+    cursor = None
+    if state.get("inventory_last_reset_date") == _utc_today_str() and isinstance(state.get("catalog_items"), dict):
+        cursor = state["catalog_items"].get("id")
+    if not isinstance(cursor, str) or not cursor.strip():
+        cursor = None
+    start_cursor = cursor
+
+    _ensure_psycopg()
+    conn = _connect_pg(cfg)
+    conn.read_only = True
+    totals = PlanTotals()
+    batches: List[Dict[str, Any]] = []
+    inventory_strategy = "ids"
+    snapshot_rows: Optional[int] = None
+    try:
+        with conn.cursor() as cur:
+            _execute(cur, "select_product_columns", SELECT_PRODUCT_COLUMNS_SQL, (cfg.products_table,))
+            columns = frozenset(r[0] for r in (cur.fetchall() or []))
+            sql = AVG_PRODUCT_ROW_BYTES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+            _execute(cur, "avg_product_row_bytes", sql)
+            avg_row_bytes = int((cur.fetchone() or (0,))[0] or 0)
+        conn.commit()
+        missing = [c for c in OPTIONAL_PRODUCT_COLUMNS if c not in columns]
+
+        category_index: Optional[CategoryIndex] = None
+        if "categories" in cfg.stages:
+            _, category_index = _sync_categories(cfg, sq, conn, write=False)
+        if category_index is None:
+            category_index = _load_category_index(cfg, conn)
+        conn.commit()
+
+        inventory_snapshot: Optional[Dict[str, dict]] = None
+        if "inventory" in cfg.stages:
+            inventory_strategy = _choose_inventory_strategy(cfg, conn, state)
+        if inventory_strategy == "snapshot":
+            inventory_snapshot, _ = _fetch_inventory_snapshot(cfg, sq)
+            payload = [{"catalog_object_id": v, "quantity": c.get("quantity")} for v, c in inventory_snapshot.items()]
+            sql = COUNT_INVENTORY_SNAPSHOT_CHANGES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+            with conn.cursor() as cur:
+                _execute(cur, "count_inventory_snapshot_changes", sql, (_json_param(payload),))
+                snapshot_rows = int((cur.fetchone() or (0,))[0] or 0)
+            conn.commit()
+            totals.inventory_rows += snapshot_rows
+            totals.est_tuple_bytes += avg_row_bytes * snapshot_rows
+
+        image_cache = RelatedObjectCache(cfg.related_cache_size)
+        image_urls: Dict[str, Optional[str]] = {}
+        while totals.pages < cfg.max_pages:
+            batch_limit = min(cfg.upsert_batch_pages, cfg.max_pages - totals.pages)
+            records, images, batch_pages, cursor = _fetch_catalog_batch(
+                sq, cursor=cursor, max_pages=batch_limit, batch_no=len(batches) + 1
+            )
+            batch = _plan_catalog_batch(
+                cfg,
+                sq,
+                records=records,
+                images=images,
+                conn=conn,
+                columns=columns,
+                categories=category_index,
+                image_cache=image_cache,
+                image_urls=image_urls,
+                inventory_snapshot=inventory_snapshot,
+                avg_row_bytes=avg_row_bytes,
+            )
+            conn.commit()
+            batch.pages = batch_pages
+            totals.add(batch)
+            batches.append(vars(batch))
+            if not cursor:
+                break
+    finally:
+        _safe_rollback(conn)
+        _safe_close(conn)
+
+    _report(
+        {
+            "mode": "plan",
+            "start_cursor": start_cursor,
+            "end_of_catalog": not cursor,
+            "pages_fetched": totals.pages,
+            "diff": cfg.diff,
+            "stages": sorted(cfg.stages),
+            "columns_to_add": missing,
+            "inventory_strategy": inventory_strategy,
+            "inventory_snapshot_rows": snapshot_rows,
+            "avg_row_bytes": avg_row_bytes,
+            "totals": vars(totals),
+            "batches": batches,
+            "json_codec": _JSON_CODEC.name,
+        }
+    )
+    return 0
+
+
+def _run_refresh_tiers(cfg: Config, sq: SquareClient) -> int:
+    """
+    --refresh-tiers: one scheduler tick (run it from cron every minute or so).
+    Each tier whose interval has elapsed gets its variations' stock refreshed via
+    _refresh_inventory_counts_for_variations; staff picks are re-synced like --item-id (catalog
+    data + inventory), batched through catalog batch-retrieve. Square calls are charged to an
+    ApiBudget; a tier that does not fit is left due and runs on a later tick. Variations already
+    refreshed by an earlier tier in the same tick are skipped.
+    """
+    if psycopg is None:
+        _ensure_psycopg()
+
+    state = _load_json_file(cfg.tier_state_path)
+    last_run = state.get("last_run") if isinstance(state.get("last_run"), dict) else {}
+    budget = ApiBudget(cfg.api_calls_per_minute, state.get("tokens"), state.get("tokens_at"))
+    now = time.time()
+    params = dict(REFRESH_TIER_PARAMS)
+
+    pg = _pg_connections(cfg)
+    conn = pg.acquire()
+    columns: FrozenSet[str] = frozenset() if cfg.dry_run else _ensure_products_columns(cfg, conn)
+    _prepare_run_history(cfg, conn)
+    category_index: Optional[CategoryIndex] = None
+    refreshed: set = set()
+    tiers: Dict[str, Dict[str, Any]] = {}
+
+    try:
+        for name, interval_min in cfg.tier_intervals:
+            result: Dict[str, Any] = {"due": False, "variations": 0, "api_calls": 0, "skipped": None}
+            tiers[name] = result
+            last = last_run.get(name)
+            if isinstance(last, (int, float)) and now - last < interval_min * 60:
+                continue
+            result["due"] = True
+
+            sql = REFRESH_TIER_SQL_TEMPLATES[name].format(
+                products_table=cfg.products_table,
+                staff_picks_table=cfg.staff_picks_table,
+            )
+            try:
+                with _savepoint(conn, "catalog_sync_tier"), conn.cursor() as cur:
+                    _execute(cur, f"select_tier_{name}", sql, params)
+                    rows = [r for r in (cur.fetchall() or []) if r and r[0] not in refreshed]
+            except Exception as e:
+                # e.g. no staff_picks table in this database
+                result["skipped"] = f"query failed: {_truncate(str(e), 200)}"
+                continue
+            result["variations"] = len(rows)
+            if cfg.dry_run:
+                continue
+
+            calls_before = budget.calls
+            sq_calls_before = sq.stats["calls"]
+            if name == "staff_picks" and rows:
+                item_ids = list(dict.fromkeys(r[1] for r in rows if r[1]))
+                retrieve_calls = -(-len(item_ids) // CATALOG_IDS_PER_CALL)
+                # The stock refresh covers every variation of the retrieved items, not just the
+                # picked ones, so it is charged once the items are back; this is only the estimate.
+                if budget.available() < retrieve_calls + -(-len(rows) // INVENTORY_IDS_PER_CALL):
+                    result["skipped"] = "api budget"
+                    continue
+                budget.take(retrieve_calls)
+                if category_index is None:
+                    category_index = _load_category_index(cfg, conn)
+                records: List[VariationRecord] = []
+                images: List[ImageRecord] = []
+                for i in range(0, len(item_ids), CATALOG_IDS_PER_CALL):
+                    payload = sq.catalog_batch_retrieve(item_ids[i : i + CATALOG_IDS_PER_CALL])
+                    records.extend(_project_catalog_objects(payload.get("objects") or []))
+                    images.extend(_project_image_objects(payload.get("related_objects") or []))
+                # No objects back (all deleted): nothing to apply, and an empty batch would fall
+                # back to refreshing the last 1000 synced rows.
+                counts, inv_rows, img_rows = {}, 0, 0
+                if records:
+                    apply_cfg = cfg
+                    if not budget.take(-(-len(records) // INVENTORY_IDS_PER_CALL)):
+                        apply_cfg = replace(cfg, stages=cfg.stages - {"inventory"})
+                        result["skipped"] = "api budget: stock left for a later tick"
+                    counts, inv_rows, img_rows, _ = _apply_catalog_batch(
+                        apply_cfg,
+                        sq,
+                        records=records,
+                        images=images,
+                        conn=conn,
+                        columns=columns,
+                        categories=category_index,
+                    )
+                result.update(
+                    {
+                        "items_synced": len(item_ids),
+                        "products": counts,
+                        "inventory_rows_updated": inv_rows,
+                        "image_rows_updated": img_rows,
+                    }
+                )
+            elif rows:
+                allowed = min(budget.available() * INVENTORY_IDS_PER_CALL, len(rows))
+                if allowed == 0:
+                    result["skipped"] = "api budget"
+                    continue
+                rows = rows[:allowed]
+                budget.take(-(-len(rows) // INVENTORY_IDS_PER_CALL))
+                result["inventory_rows_updated"] = _refresh_inventory_counts_for_variations(
+                    cfg,
+                    sq,
+                    conn,
+                    [r[0] for r in rows],
+                    known_stock={r[0]: int(r[2] or 0) for r in rows},
+                )
+                if allowed < result["variations"]:
+                    result["skipped"] = f"api budget: {result['variations'] - allowed} variation(s) left for a later tick"
+            conn.commit()
+            refreshed.update(r[0] for r in rows)
+            # What Square was actually asked (cursor pages included); overruns come out of the budget.
+            result["api_calls"] = sq.stats["calls"] - sq_calls_before
+            budget.charge(max(0, result["api_calls"] - (budget.calls - calls_before)))
+            if result["skipped"] is None:
+                last_run[name] = now
+            _emit("tier", tier=name, **result)
+    except Exception:
+        _safe_rollback(conn)
+        err = sys.exc_info()[1] or Exception("Unknown error")
+        _send_make_alert_email(
+            alert_code=_compute_alert_code("sync.tiers", err),
+            title="Catalog tier refresh failed",
+            error=str(err),
+            context={"stage": "sync.tiers", "tiers": tiers, "tierStatePath": cfg.tier_state_path},
+            stack="".join(traceback.format_exception(*sys.exc_info())) if sys.exc_info()[0] else None,
+            severity="critical",
         )
+        raise
+    finally:
+        pg.release(conn)
+        if not cfg.dry_run:
+            _atomic_write_json(cfg.tier_state_path, {"last_run": last_run, **budget.snapshot()})
+
+    _report(
+        {
+            "mode": "refresh_tiers",
+            "tiers": tiers,
+            "api_calls": budget.calls,
+            "api_calls_per_minute": cfg.api_calls_per_minute,
+            "api_tokens_left": round(budget.tokens, 3),
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+            "profile_report": _PROFILER.report_path if _PROFILER is not None else None,
+            "sql_timings_report": _SQL_TIMINGS.report_path if _SQL_TIMINGS is not None else None,
+            "dry_run": cfg.dry_run,
+            "tier_state_path": cfg.tier_state_path,
+            "square_location_id": cfg.square_location_id,
+            "products_table": cfg.products_table,
+        }
+    )
+    return 0
+
+
+def _repair_categories(cfg: Config, sq: SquareClient, conn: Any, columns: FrozenSet[str]) -> Dict[str, int]:
+    """
+    Re-list categories, then rewrite category, category_path and all_categories for every row
+    whose values no longer match (renames are detected against the categories table as it was
+    before the listing).
+    """
+    try:
+        before = _load_category_index(cfg, conn)
+        conn.commit()
+    except Exception:
+        _safe_rollback(conn)
+        before = CategoryIndex()
+    processed, after = _sync_categories(cfg, sq, conn)
+    if after is None:
+        # No listing (dry run): nothing to compare against, so nothing to rewrite.
+        return {"categories": processed, "renamed": 0, "rows_updated": 0}
+    _mark_categories_crawled(cfg)
+    renames = [
+        {"old_name": before.name(cid), "new_name": after.name(cid)}
+        for cid in after.ids()
+        if before.name(cid) and after.name(cid) and before.name(cid) != after.name(cid)
+    ]
+    payload = {
+        "categories": [{"id": cid, "name": after.name(cid), "path": after.path(cid) or None} for cid in after.ids()],
+        "renames": renames,
+    }
+    with_path = "category_path" in columns
+    sql = UPDATE_CATEGORY_REFS_SQL_TEMPLATE.format(
+        products_table=cfg.products_table,
+        path_select="\n    COALESCE(c.path, p.category_path) AS category_path," if with_path else "",
+        path_set="\n  category_path  = t.category_path," if with_path else "",
+        path_where="\n    OR p.category_path IS DISTINCT FROM t.category_path" if with_path else "",
     )
+    with conn.cursor() as cur:
+        _execute(cur, "update_category_refs", sql, (_json_param(payload),))
+        rows = cur.rowcount or 0
+    conn.commit()
+    return {"categories": processed, "renamed": len(renames), "rows_updated": rows}
+
+
+def _repair_images(cfg: Config, sq: SquareClient, conn: Any) -> Dict[str, int]:
+    """Page through every IMAGE object and set image_url wherever it differs (one commit per page)."""
+    sql = UPDATE_IMAGES_SQL_TEMPLATE.format(products_table=cfg.products_table)
+    pages = 0
+    images = 0
+    rows = 0
+    for _, payload, _ in _iter_cursor_pages(lambda c: sq.catalog_search_images(cursor=c)):
+        pages += 1
+        batch = [{"id": im.image_id, "url": im.url} for im in _project_image_objects(payload.get("objects") or [])]
+        if batch:
+            images += len(batch)
+            with conn.cursor() as cur:
+                _execute(cur, "update_images", sql, (_json_param(batch),))
+                rows += cur.rowcount or 0
+            conn.commit()
+    return {"pages": pages, "images": images, "rows_updated": rows}
+
+
+def _run_targeted_stages(
+    cfg: Config,
+    sq: SquareClient,
+    *,
+    unchanged_since: Optional[str] = None,
+    pacer: Optional[BatchPacer] = None,
+    state: Optional[Dict[str, Any]] = None,
+) -> int:
+    """
+    --stages without products: repair runs that skip the catalog crawl and leave the cursor alone.
+    - categories: _repair_categories
+    - images: _repair_images (IMAGE objects only, no ITEM pages)
+    - inventory: one location snapshot applied to the whole table (--inventory-strategy snapshot)
+    run_log is a per-batch step and does nothing here.
+    Also the no-op fast path of a catalog run (unchanged_since = the watermark it checked), which
+    passes its pacer and state file contents so step durations are kept across runs.
+    The inventory snapshot, the albums_cache rebuild (only when a stage updated rows) and the
+    --snapshot-dir write follow --time-budget like the steps after a crawl's last batch.
+    """
+    started = time.monotonic()
+    pacer = pacer if pacer is not None else BatchPacer(cfg.time_budget_s)
+    step_s: Dict[str, Any] = {}
+    if state is not None:
+        step_s = state.get("post_step_s") if isinstance(state.get("post_step_s"), dict) else {}
+        state["post_step_s"] = step_s
+    results: Dict[str, Any] = {}
+    if cfg.dry_run:
+        print(f"[DRY RUN] Would run stages: {', '.join(s for s in SYNC_STAGES if s in cfg.stages)}")
+    elif cfg.stages & {"categories", "images", "inventory"}:
+        if psycopg is None:
+            _ensure_psycopg()
+        pg = _pg_connections(cfg)
+        conn = pg.acquire()
+        columns = _ensure_products_columns(cfg, conn)
+        _prepare_run_history(cfg, conn)
+        try:
+            if "categories" in cfg.stages:
+                with _stage("stage.categories"):
+                    results["categories"] = _repair_categories(cfg, sq, conn, columns)
+                _emit("stage", stage="categories", **results["categories"])
+            if "images" in cfg.stages:
+                with _stage("stage.images"):
+                    results["images"] = _repair_images(cfg, sq, conn)
+                _emit("stage", stage="images", **results["images"])
+            if "inventory" in cfg.stages and pacer.fits("inventory", (state or {}).get("inventory_snapshot_s")):
+                snapshot_started = time.monotonic()
+                with _stage("stage.inventory"):
+                    snapshot, calls = _fetch_inventory_snapshot(cfg, sq)
+                    rows = _apply_inventory_snapshot(cfg, conn, snapshot)
+                    conn.commit()
+                if state is not None:
+                    # Measured for _expected_pages, like a crawl's snapshot.
+                    state["inventory_snapshot_s"] = round(time.monotonic() - snapshot_started, 3)
+                results["inventory"] = {"counts": len(snapshot), "api_calls": calls, "rows_updated": rows}
+                _emit("stage", stage="inventory", **results["inventory"])
+        except Exception:
+            _safe_rollback(conn)
+            err = sys.exc_info()[1] or Exception("Unknown error")
+            stage = "sync.stages"
+            _send_make_alert_email(
+                alert_code=_compute_alert_code(stage, err),
+                title="Catalog stage run failed",
+                error=str(err),
+                context={"stage": stage, "stages": sorted(cfg.stages), "results": results},
+                stack="".join(traceback.format_exception(*sys.exc_info())) if sys.exc_info()[0] else None,
+                severity="critical",
+            )
+            raise
+        finally:
+            pg.release(conn)
+
+    albums_cache_result: Optional[Dict[str, Any]] = None
+    rows_updated = sum(int(r.get("rows_updated") or 0) for r in results.values())
+    if cfg.rebuild_albums_cache and rows_updated and not pacer.fits("albums_cache", step_s.get("albums_cache")):
+        albums_cache_result = {"attempted": False, "ok": True, "reason": "time_budget"}
+    elif cfg.rebuild_albums_cache and rows_updated:
+        step_started = time.monotonic()
+        albums_cache_result = _rebuild_albums_cache(cfg)
+        if albums_cache_result.get("attempted"):
+            step_s["albums_cache"] = round(time.monotonic() - step_started, 3)
+        if albums_cache_result.get("attempted") and not albums_cache_result.get("ok"):
+            _send_make_alert_email(
+                alert_code="SYNC-ALBUMS-CACHE",
+                title="albums_cache rebuild failed (after stage run)",
+                error=str(albums_cache_result),
+                context={"stage": "sync.albums_cache", "stages": sorted(cfg.stages), "rowsUpdated": rows_updated},
+                stack=None,
+                severity="warning",
+            )
+
+    snapshot_result: Optional[Dict[str, Any]] = None
+    if cfg.snapshot_dir and not cfg.dry_run and not pacer.fits("snapshot", step_s.get("snapshot")):
+        snapshot_result = {"ok": True, "written": False, "reason": "time_budget"}
+    elif cfg.snapshot_dir and not cfg.dry_run:
+        step_started = time.monotonic()
+        snapshot_result = _write_catalog_snapshot(cfg)
+        step_s["snapshot"] = round(time.monotonic() - step_started, 3)
+        if not snapshot_result.get("ok"):
+            _send_make_alert_email(
+                alert_code="SYNC-SNAPSHOT",
+                title="Catalog snapshot failed (after stage run)",
+                error=str(snapshot_result.get("error")),
+                context={"stage": "sync.snapshot", "stages": sorted(cfg.stages), "snapshotDir": cfg.snapshot_dir},
+                stack=None,
+                severity="warning",
+            )
 
+    if state is not None and (step_s or "inventory" in results) and not cfg.dry_run:
+        with contextlib.suppress(Exception):
+            _atomic_write_json(cfg.state_path, state)
+
+    _report(
+        {
+            "mode": "fast_path" if unchanged_since else "stages",
+            "stages": [s for s in SYNC_STAGES if s in cfg.stages],
+            "unchanged_since": unchanged_since,
+            **results,
+            "albums_cache_rebuild": albums_cache_result,
+            "catalog_snapshot": snapshot_result,
+            "skipped_by_time_budget": pacer.skipped,
+            "elapsed_s": round(time.monotonic() - started, 3),
+            "json_codec": _JSON_CODEC.name,
+            "alerts": _ALERTS.stats() if _ALERTS is not None else None,
+            "profile_report": _PROFILER.report_path if _PROFILER is not None else None,
+            "sql_timings_report": _SQL_TIMINGS.report_path if _SQL_TIMINGS is not None else None,
+            "dry_run": cfg.dry_run,
+            "square_location_id": cfg.square_location_id,
+            "products_table": cfg.products_table,
+        }
+    )
     return 0
 
 
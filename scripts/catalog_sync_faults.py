@@ -0,0 +1,815 @@
+#!/usr/bin/env python3
+"""
+Deterministic fault-injection harness for scripts/catalog_sync.py (retry and recovery behaviour).
+
+Runs the real sync as a subprocess against:
+- a built-in fake Square API serving a generated catalog (ITEMs, variations, IMAGEs, categories,
+  inventory counts), which injects scripted faults: 429 with Retry-After, 5xx bursts, slow and
+  timed-out responses;
+- a TCP proxy in front of a scratch Postgres database, which can drop the connection in the
+  middle of a transaction (what a TLS "bad record mac" does to the client) or terminate it with
+  FATAL 57P01 (admin shutdown).
+
+Faults are keyed on request / statement counts, not wall-clock time, so every run of a scenario
+injects them at the same point. When a run exits non-zero the sync is started again (like the
+next cron tick) until the catalog pass completes or --max-runs is reached.
+
+Per scenario the JSON report has the wall time (and overhead against the baseline scenario), the
+recovery time after each fault (first fault -> next committed batch), duplicate work (catalog
+pages fetched again, batches re-applied, Square retries that ignored Retry-After) and whether the
+products table and the cursor state are correct at the end.
+
+The scratch tables are copies of the products/categories/catalog_sync_runs tables of the
+database in PG_DSN (CREATE TABLE ... (LIKE ... INCLUDING ALL)), prefixed with --table-prefix and
+dropped before each scenario. Point PG_DSN at a local or disposable database: the proxy speaks
+plain TCP to it and asks the sync for sslmode=disable.
+
+Usage:
+  PG_DSN=postgresql://... python3 scripts/catalog_sync_faults.py
+  PG_DSN=postgresql://... python3 scripts/catalog_sync_faults.py --scenario square-429 --scenario pg-admin-shutdown
+  python3 scripts/catalog_sync_faults.py --list
+"""
+
+from __future__ import annotations
+
+import argparse
+import datetime as dt
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import psycopg  # type: ignore
+    from psycopg import conninfo as pg_conninfo  # type: ignore
+except Exception:  # pragma: no cover
+    psycopg = None  # type: ignore
+    pg_conninfo = None  # type: ignore
+
+
+from catalog_sync import IDENT_RE
+
+SYNC_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog_sync.py")
+
+FAKE_LOCATION_ID = "FAULTS"
+FAKE_PAGE_SIZE = 100
+FAKE_IMAGES = 40
+FAKE_CATEGORIES = (
+    ("C_VINYL", "New Vinyl", None),
+    ("C_ROCK", "Rock", "C_VINYL"),
+    ("C_PUNK", "Punk/Ska", "C_ROCK"),
+)
+
+# Postgres protocol codes the proxy handles before relaying bytes.
+PG_SSL_REQUEST = 80877103
+PG_GSSENC_REQUEST = 80877104
+PG_CANCEL_REQUEST = 80877102
+
+
+@dataclass(frozen=True)
+class SquareFault:
+    """Requests first..first+count-1 (1-based, per fault) whose path starts with path get this fault."""
+
+    path: str
+    first: int
+    count: int = 1
+    status: Optional[int] = None
+    retry_after: Optional[float] = None
+    delay_s: float = 0.0
+
+
+@dataclass(frozen=True)
+class PgFault:
+    """
+    kind "drop": close both sockets; kind "admin_shutdown": send FATAL 57P01, then close.
+    Fires once, in place of the at-th in-transaction ReadyForQuery (counted across connections),
+    i.e. right after a statement succeeded inside an open transaction.
+    """
+
+    kind: str
+    at: int
+
+
+@dataclass(frozen=True)
+class Scenario:
+    description: str
+    square: Tuple[SquareFault, ...] = ()
+    pg: Tuple[PgFault, ...] = ()
+    sync_args: Tuple[str, ...] = ()
+
+
+SEARCH = "/v2/catalog/search"
+
+SCENARIOS: Dict[str, Scenario] = {
+    "baseline": Scenario("No faults; reference wall time for the overhead of the others."),
+    "square-429": Scenario(
+        "Two catalog searches answered 429 with Retry-After: 2.",
+        square=(SquareFault(SEARCH, first=2, count=2, status=429, retry_after=2.0),),
+    ),
+    "square-5xx-burst": Scenario(
+        "Three 503s in a row on catalog search (inside the client's 5 attempts).",
+        square=(SquareFault(SEARCH, first=3, count=3, status=503),),
+    ),
+    "square-5xx-outage": Scenario(
+        "Six 502s in a row on catalog search: the run gives up and the next run resumes from the cursor.",
+        square=(SquareFault(SEARCH, first=3, count=6, status=502),),
+    ),
+    "square-slow": Scenario(
+        "Three catalog searches delayed by 1.5 s.",
+        square=(SquareFault(SEARCH, first=2, count=3, delay_s=1.5),),
+    ),
+    "square-timeout": Scenario(
+        "One catalog search slower than --timeout-s 5.",
+        square=(SquareFault(SEARCH, first=3, count=1, delay_s=7.0),),
+        sync_args=("--timeout-s", "5"),
+    ),
+    "pg-drop-mid-transaction": Scenario(
+        "Postgres connection dropped inside a batch transaction (like SSL 'bad record mac').",
+        pg=(PgFault("drop", at=25),),
+    ),
+    "pg-admin-shutdown": Scenario(
+        "Postgres terminates the session with FATAL 57P01 inside a batch transaction.",
+        pg=(PgFault("admin_shutdown", at=40),),
+    ),
+}
+
+
+def _utc_ts(iso: str) -> float:
+    return dt.datetime.fromisoformat(iso.replace("Z", "+00:00")).timestamp()
+
+
+# ---------------------------------------------------------------------------
+# Fake Square
+
+
+class FakeSquare:
+    """Deterministic catalog of `items` ITEMs (two variations each) plus the fault rules and a request log."""
+
+    def __init__(self, items: int, faults: Tuple[SquareFault, ...]):
+        self.items = items
+        self.faults = faults
+        self._hits = [0] * len(faults)
+        self._lock = threading.Lock()
+        self.log: List[Dict[str, Any]] = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeSquareHandler)
+        self.server.daemon_threads = True
+        self.server.app = self  # type: ignore[attr-defined]
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-square", daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "FakeSquare":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Catalog content ---------------------------------------------------------
+
+    @staticmethod
+    def price(i: int, j: int) -> int:
+        return 1000 + i * 10 + j
+
+    @staticmethod
+    def stock(i: int, j: int) -> int:
+        return (i * 3 + j) % 5
+
+    def expected_rows(self) -> Dict[str, Tuple[int, int]]:
+        """square_variation_id -> (price_cents, stock_count) once the catalog is fully synced."""
+        return {f"V{i}_{j}": (self.price(i, j), self.stock(i, j)) for i in range(self.items) for j in range(2)}
+
+    def _item(self, i: int) -> Dict[str, Any]:
+        category = FAKE_CATEGORIES[i % len(FAKE_CATEGORIES)][0]
+        return {
+            "type": "ITEM",
+            "id": f"I{i}",
+            "version": 1,
+            "updated_at": "2025-02-01T00:00:00Z",
+            "created_at": "2025-01-15T00:00:00Z",
+            "is_deleted": False,
+            "item_data": {
+                "name": f"Album {i}",
+                "description": f"Pressing {i}",
+                "image_ids": [f"IMG{i % FAKE_IMAGES}"],
+                "categories": [{"id": category}, {"id": "C_VINYL"}],
+                "reporting_category": {"id": category},
+                "variations": [
+                    {
+                        "type": "ITEM_VARIATION",
+                        "id": f"V{i}_{j}",
+                        "version": 1,
+                        "item_variation_data": {
+                            "item_id": f"I{i}",
+                            "name": ("LP", "CD")[j],
+                            "price_money": {"amount": self.price(i, j), "currency": "USD"},
+                        },
+                    }
+                    for j in range(2)
+                ],
+            },
+        }
+
+    @staticmethod
+    def _image(k: int) -> Dict[str, Any]:
+        return {"type": "IMAGE", "id": f"IMG{k}", "version": 1, "image_data": {"url": f"https://img.example/{k}.jpg"}}
+
+    @staticmethod
+    def _categories() -> List[Dict[str, Any]]:
+        out = []
+        for cid, name, parent in FAKE_CATEGORIES:
+            data: Dict[str, Any] = {"name": name}
+            if parent:
+                data["parent_id"] = parent
+            out.append({"type": "CATEGORY", "id": cid, "version": 1, "category_data": data})
+        return out
+
+    def _items_with_images(self, indexes: List[int]) -> Dict[str, Any]:
+        objects = [self._item(i) for i in indexes]
+        images = {i % FAKE_IMAGES for i in indexes}
+        return {"objects": objects, "related_objects": [self._image(k) for k in sorted(images)] + self._categories()}
+
+    def _counts(self, variation_ids: List[str]) -> List[Dict[str, Any]]:
+        out = []
+        for vid in variation_ids:
+            i, j = (int(x) for x in vid[1:].split("_"))
+            if i >= self.items or self.stock(i, j) == 0:
+                continue
+            out.append(
+                {
+                    "catalog_object_id": vid,
+                    "catalog_object_type": "ITEM_VARIATION",
+                    "state": "IN_STOCK",
+                    "location_id": FAKE_LOCATION_ID,
+                    "quantity": str(self.stock(i, j)),
+                    "calculated_at": "2025-03-01T00:00:00Z",
+                }
+            )
+        return out
+
+    def respond(self, method: str, path: str, query: Dict[str, List[str]], body: Dict[str, Any]) -> Tuple[int, Any]:
+        if method == "GET" and path == "/v2/catalog/list":
+            return 200, {"objects": self._categories()}
+        if method == "GET" and path.startswith("/v2/catalog/object/"):
+            i = int(path.rsplit("/", 1)[1][1:])
+            payload = self._items_with_images([i])
+            return 200, {"object": payload["objects"][0], "related_objects": payload["related_objects"]}
+        if method == "POST" and path == SEARCH:
+            if "begin_time" in body:
+                return 200, {"objects": []}
+            start = int(body.get("cursor") or 0)
+            if body.get("object_types") == ["IMAGE"]:
+                return 200, {"objects": [self._image(k) for k in range(FAKE_IMAGES)]}
+            end = min(self.items, start + int(body.get("limit") or FAKE_PAGE_SIZE))
+            payload = self._items_with_images(list(range(start, end)))
+            if end < self.items:
+                payload["cursor"] = str(end)
+            return 200, payload
+        if method == "POST" and path == "/v2/catalog/batch-retrieve":
+            ids = [int(x[1:]) for x in body.get("object_ids") or [] if x.startswith("I") and int(x[1:]) < self.items]
+            return 200, self._items_with_images(ids)
+        if method == "POST" and path == "/v2/inventory/counts/batch-retrieve":
+            ids = body.get("catalog_object_ids")
+            if ids is not None:
+                return 200, {"counts": self._counts(ids)}
+            all_ids = [f"V{i}_{j}" for i in range(self.items) for j in range(2)]
+            start = int(body.get("cursor") or 0)
+            payload = {"counts": self._counts(all_ids[start : start + 1000])}
+            if start + 1000 < len(all_ids):
+                payload["cursor"] = str(start + 1000)
+            return 200, payload
+        return 404, {"errors": [{"code": "NOT_FOUND", "detail": f"{method} {path}"}]}
+
+    def fault_for(self, path: str) -> Tuple[Optional[int], Optional[SquareFault]]:
+        with self._lock:
+            for n, fault in enumerate(self.faults):
+                if not path.startswith(fault.path):
+                    continue
+                self._hits[n] += 1
+                if fault.first <= self._hits[n] < fault.first + fault.count:
+                    return n, fault
+        return None, None
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        with self._lock:
+            self.log.append(entry)
+
+
+class _FakeSquareHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _handle(self, method: str) -> None:
+        app: FakeSquare = self.server.app  # type: ignore[attr-defined]
+        started = time.time()
+        url = urlparse(self.path)
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = json.loads(raw) if raw else {}
+        rule, fault = app.fault_for(url.path)
+        # Logged before any injected delay: the client may give up and finish its run first.
+        entry: Dict[str, Any] = {
+            "t": started,
+            "method": method,
+            "path": url.path,
+            "cursor": body.get("cursor") if url.path == SEARCH and "object_types" in body else None,
+            "item_search": url.path == SEARCH and body.get("object_types") == ["ITEM"] and "begin_time" not in body,
+            "status": None,
+            "fault": rule,
+            "retry_after": fault.retry_after if fault is not None else None,
+            "delivered": False,
+        }
+        app.record(entry)
+        status, payload = app.respond(method, url.path, parse_qs(url.query), body)
+        headers: Dict[str, str] = {}
+        if fault is not None:
+            if fault.delay_s:
+                time.sleep(fault.delay_s)
+            if fault.status is not None:
+                status, payload = fault.status, {"errors": [{"code": "INJECTED", "detail": f"fault {rule}"}]}
+                if fault.retry_after is not None:
+                    headers["Retry-After"] = f"{fault.retry_after:g}"
+        data = json.dumps(payload).encode("utf-8")
+        try:
+            self.send_response(status)
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            entry["delivered"] = True
+        except OSError:
+            # The client gave up (timeout) before the delayed response was written.
+            pass
+        entry["status"] = status
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+
+# ---------------------------------------------------------------------------
+# Postgres proxy
+
+
+def _recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return b""
+        buf += chunk
+    return buf
+
+
+def _close(*socks: socket.socket) -> None:
+    for s in socks:
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            s.close()
+        except OSError:
+            pass
+
+
+def _admin_shutdown_message() -> bytes:
+    fields = b"".join(
+        code + text.encode("utf-8") + b"\0"
+        for code, text in (
+            (b"S", "FATAL"),
+            (b"V", "FATAL"),
+            (b"C", "57P01"),
+            (b"M", "terminating connection due to administrator command"),
+        )
+    )
+    body = fields + b"\0"
+    return b"E" + struct.pack("!I", len(body) + 4) + body
+
+
+class PgProxy:
+    """
+    Plain-TCP Postgres proxy. SSL/GSS encryption requests are refused ('N') so the stream can be
+    read; server->client messages are parsed so faults land exactly on a message boundary.
+    """
+
+    def __init__(self, upstream: Tuple[str, int], faults: Tuple[PgFault, ...]):
+        self.upstream = upstream
+        self.faults = list(faults)
+        self.in_txn_ready = 0
+        self.connections = 0
+        self.fired: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(("127.0.0.1", 0))
+        self._listener.listen(16)
+        self._closed = False
+        self._thread = threading.Thread(target=self._accept, name="pg-proxy", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._listener.getsockname()[1]
+
+    def start(self) -> "PgProxy":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._closed = True
+        _close(self._listener)
+
+    def _connect_upstream(self) -> socket.socket:
+        host, port = self.upstream
+        if host.startswith("/"):
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(os.path.join(host, f".s.PGSQL.{port}"))
+        else:
+            s = socket.create_connection((host, port))
+        return s
+
+    def _accept(self) -> None:
+        while not self._closed:
+            try:
+                client, _ = self._listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(client,), name="pg-proxy-conn", daemon=True).start()
+
+    def _serve(self, client: socket.socket) -> None:
+        server: Optional[socket.socket] = None
+        try:
+            while True:
+                head = _recv_exact(client, 8)
+                if not head:
+                    return _close(client)
+                length, code = struct.unpack("!II", head)
+                if code in (PG_SSL_REQUEST, PG_GSSENC_REQUEST):
+                    client.sendall(b"N")
+                    continue
+                startup = head + _recv_exact(client, length - 8)
+                break
+            server = self._connect_upstream()
+            server.sendall(startup)
+            with self._lock:
+                self.connections += 1
+            if code == PG_CANCEL_REQUEST:
+                return _close(client, server)
+            threading.Thread(target=self._pump, args=(client, server), name="pg-proxy-up", daemon=True).start()
+            self._relay_server(server, client)
+        except OSError:
+            _close(*(s for s in (client, server) if s is not None))
+
+    @staticmethod
+    def _pump(src: socket.socket, dst: socket.socket) -> None:
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                dst.sendall(data)
+        except OSError:
+            pass
+        _close(src, dst)
+
+    def _relay_server(self, server: socket.socket, client: socket.socket) -> None:
+        try:
+            while True:
+                head = _recv_exact(server, 5)
+                if not head:
+                    break
+                kind, length = head[:1], struct.unpack("!I", head[1:])[0]
+                body = _recv_exact(server, length - 4)
+                if kind == b"Z" and body == b"T":
+                    fault = self._next_fault()
+                    if fault is not None:
+                        if fault.kind == "admin_shutdown":
+                            client.sendall(_admin_shutdown_message())
+                        break
+                client.sendall(head + body)
+        except OSError:
+            pass
+        _close(server, client)
+
+    def _next_fault(self) -> Optional[PgFault]:
+        with self._lock:
+            self.in_txn_ready += 1
+            for fault in self.faults:
+                if fault.at == self.in_txn_ready:
+                    self.faults.remove(fault)
+                    self.fired.append({"t": time.time(), "kind": fault.kind, "at": fault.at})
+                    return fault
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Scenario runner
+
+
+@dataclass
+class HarnessConfig:
+    pg_dsn: str
+    items: int
+    max_runs: int
+    table_prefix: str
+    run_timeout_s: float
+    keep_tables: bool
+    sync_args: Tuple[str, ...] = field(default_factory=tuple)
+
+
+def _table_prefix(value: str) -> str:
+    """argparse type for --table-prefix: the scratch tables are dropped, so an empty prefix would hit the real ones."""
+    if not IDENT_RE.match(value or ""):
+        raise argparse.ArgumentTypeError(f"must be a non-empty SQL identifier prefix, got {value!r}")
+    return value
+
+
+def _scratch_tables(cfg: HarnessConfig) -> Dict[str, str]:
+    if not IDENT_RE.match(cfg.table_prefix or ""):
+        raise SystemExit(f"Refusing scratch tables with table prefix {cfg.table_prefix!r}")
+    return {base: f"{cfg.table_prefix}{base}" for base in ("products", "categories", "catalog_sync_runs")}
+
+
+def _reset_scratch_tables(cfg: HarnessConfig) -> Tuple[str, int]:
+    """(Re)create the scratch tables; returns the server's (host or socket dir, port) for the proxy."""
+    with psycopg.connect(cfg.pg_dsn, autocommit=True) as conn:  # type: ignore
+        for base, scratch in _scratch_tables(cfg).items():
+            conn.execute(f"DROP TABLE IF EXISTS {scratch}")
+            conn.execute(f"CREATE TABLE {scratch} (LIKE {base} INCLUDING ALL)")
+        return conn.info.host, int(conn.info.port)
+
+
+def _drop_scratch_tables(cfg: HarnessConfig) -> None:
+    with psycopg.connect(cfg.pg_dsn, autocommit=True) as conn:  # type: ignore
+        for scratch in _scratch_tables(cfg).values():
+            conn.execute(f"DROP TABLE IF EXISTS {scratch}")
+
+
+def _load_state(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _load_events(path: str) -> List[Dict[str, Any]]:
+    out = []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return out
+
+
+def _incidents(square: FakeSquare, proxy: PgProxy) -> List[Dict[str, Any]]:
+    """One incident per Square fault rule (its whole burst) and per fired Postgres fault."""
+    by_rule: Dict[int, List[Dict[str, Any]]] = {}
+    for entry in square.log:
+        if entry["fault"] is not None:
+            by_rule.setdefault(entry["fault"], []).append(entry)
+    incidents = [
+        {
+            "source": "square",
+            "fault": square.faults[rule].__dict__,
+            "injected": len(entries),
+            "start": min(e["t"] for e in entries),
+            "end": max(e["t"] for e in entries),
+        }
+        for rule, entries in sorted(by_rule.items())
+    ]
+    incidents += [
+        {"source": "postgres", "fault": dict(kind=f["kind"], at=f["at"]), "injected": 1, "start": f["t"], "end": f["t"]}
+        for f in proxy.fired
+    ]
+    return incidents
+
+
+def _early_retries(square: FakeSquare) -> int:
+    """Requests repeated (same path and cursor) before the Retry-After of the 429 they follow had passed."""
+    early = 0
+    log = sorted(square.log, key=lambda e: e["t"])
+    for n, entry in enumerate(log):
+        if entry["status"] != 429 or entry["retry_after"] is None:
+            continue
+        for later in log[n + 1 :]:
+            if later["path"] == entry["path"] and later["cursor"] == entry["cursor"]:
+                if later["t"] - entry["t"] < entry["retry_after"]:
+                    early += 1
+                break
+    return early
+
+
+def _check_products(cfg: HarnessConfig, square: FakeSquare) -> Dict[str, Any]:
+    expected = square.expected_rows()
+    table = _scratch_tables(cfg)["products"]
+    with psycopg.connect(cfg.pg_dsn) as conn:  # type: ignore
+        rows = conn.execute(f"SELECT square_variation_id, price_cents, stock_count FROM {table}").fetchall()
+    actual = {r[0]: (int(r[1] or 0), int(r[2] or 0)) for r in rows}
+    missing = sorted(set(expected) - set(actual))
+    extra = sorted(set(actual) - set(expected))
+    wrong_price = sorted(v for v in expected if v in actual and actual[v][0] != expected[v][0])
+    wrong_stock = sorted(v for v in expected if v in actual and actual[v][1] != expected[v][1])
+    return {
+        "rows": len(actual),
+        "expected_rows": len(expected),
+        "missing": len(missing),
+        "extra": len(extra),
+        "wrong_price": len(wrong_price),
+        "wrong_stock": len(wrong_stock),
+        "examples": (missing + extra + wrong_price + wrong_stock)[:10],
+    }
+
+
+def run_scenario(cfg: HarnessConfig, name: str, scenario: Scenario) -> Dict[str, Any]:
+    upstream = _reset_scratch_tables(cfg)
+    square = FakeSquare(cfg.items, scenario.square).start()
+    proxy = PgProxy(upstream, scenario.pg).start()
+    tables = _scratch_tables(cfg)
+    workdir = tempfile.mkdtemp(prefix=f"catalog-sync-faults-{name}-")
+    state_path = os.path.join(workdir, "state.json")
+    events_path = os.path.join(workdir, "events.ndjson")
+    pages = -(-cfg.items // FAKE_PAGE_SIZE)
+
+    # Alerts off, and no fallback DSN that could point the sync past the proxy.
+    dropped = ("MAKE_ALERTS_WEBHOOK_URL", "SGR_DATABASE_URL", "SPR_DATABASE_URL", "DATABASE_URL")
+    env = {k: v for k, v in os.environ.items() if k not in dropped}
+    env.update(
+        {
+            "SQUARE_ACCESS_TOKEN": "fault-harness",
+            "SQUARE_BASE_URL": square.base_url,
+            "SQUARE_LOCATION_ID": FAKE_LOCATION_ID,
+            "PG_DSN": pg_conninfo.make_conninfo(cfg.pg_dsn, host="127.0.0.1", port=str(proxy.port), sslmode="disable"),
+            "PRODUCTS_TABLE": tables["products"],
+            "CATEGORIES_TABLE": tables["categories"],
+            "CATALOG_SYNC_RUNS_TABLE": tables["catalog_sync_runs"],
+            "ALERT_ENABLED": "0",
+            "SLACK_ALERT_ENABLED": "0",
+        }
+    )
+    cmd = [
+        sys.executable,
+        SYNC_SCRIPT,
+        "--state-path",
+        state_path,
+        "--events",
+        events_path,
+        "--dead-letter",
+        os.path.join(workdir, "dead_letters.jsonl"),
+        "--alert-state",
+        os.path.join(workdir, "alert_state.json"),
+        "--max-pages",
+        str(pages + 1),
+        "--skip-indexes",
+        "--no-fast-path",
+        *scenario.sync_args,
+        *cfg.sync_args,
+    ]
+
+    runs: List[Dict[str, Any]] = []
+    started = time.time()
+    try:
+        for _ in range(cfg.max_runs):
+            t0 = time.monotonic()
+            try:
+                proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=cfg.run_timeout_s)
+                rc, stderr = proc.returncode, proc.stderr
+            except subprocess.TimeoutExpired as e:
+                rc, stderr = None, str(e)
+            run = {"exit_code": rc, "seconds": round(time.monotonic() - t0, 3)}
+            if rc != 0:
+                run["error"] = (stderr or "").strip().splitlines()[-1:] or None
+            runs.append(run)
+            state = _load_state(state_path)
+            if rc == 0 and not state.get("catalog_items"):
+                break
+        wall_s = time.time() - started
+    finally:
+        square.stop()
+        proxy.stop()
+
+    state = _load_state(state_path)
+    events = _load_events(events_path)
+    checkpoints = sorted(_utc_ts(e["ts"]) for e in events if e.get("event") == "checkpoint")
+
+    incidents = _incidents(square, proxy)
+    for incident in incidents:
+        after = [t for t in checkpoints if t >= incident["end"]]
+        incident["recovery_s"] = round(after[0] - incident["start"], 3) if after else None
+        incident.pop("end")
+        incident["start"] = dt.datetime.fromtimestamp(incident["start"], dt.timezone.utc).isoformat()
+
+    served = [e for e in square.log if e["item_search"] and e["status"] == 200 and e["delivered"]]
+    cursors = [e["cursor"] for e in served]
+    expected_cursors = {None} | {str(n * FAKE_PAGE_SIZE) for n in range(1, pages)}
+    products = _check_products(cfg, square)
+    cursor_ok = not state.get("catalog_items") and bool(state.get("catalog_watermark"))
+    skipped = sorted(str(c) for c in expected_cursors - set(cursors))
+
+    if not cfg.keep_tables:
+        _drop_scratch_tables(cfg)
+
+    return {
+        "description": scenario.description,
+        "runs": runs,
+        "wall_s": round(wall_s, 3),
+        "incidents": incidents,
+        "duplicate_work": {
+            "catalog_pages_fetched": len(cursors),
+            "catalog_pages": pages,
+            "pages_refetched": len(cursors) - len(set(cursors)),
+            "batches_reapplied": sum(1 for e in events if e.get("event") == "retry"),
+            "square_retries": sum(1 for e in events if e.get("event") == "square_retry"),
+            "retry_after_ignored": _early_retries(square),
+            "pg_connections": proxy.connections,
+        },
+        "correctness": {
+            "products": products,
+            "pages_skipped": skipped,
+            "cursor_state_ok": cursor_ok,
+            "state": {k: state.get(k) for k in ("catalog_items", "catalog_watermark")},
+        },
+        "ok": bool(runs)
+        and runs[-1]["exit_code"] == 0
+        and cursor_ok
+        and not skipped
+        and not any(products[k] for k in ("missing", "extra", "wrong_price", "wrong_stock")),
+        "workdir": workdir,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(description="Fault-injection harness for catalog_sync.py retry and recovery paths.")
+    p.add_argument(
+        "--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (repeatable; default: all)"
+    )
+    p.add_argument("--list", action="store_true", help="List the scenarios and exit")
+    p.add_argument("--items", type=int, default=450, help="ITEMs in the fake catalog (100 per page; default: 450)")
+    p.add_argument("--max-runs", type=int, default=4, help="Sync runs per scenario before giving up (default: 4)")
+    p.add_argument("--run-timeout-s", type=float, default=300.0, help="Kill a sync run after this long (default: 300)")
+    p.add_argument(
+        "--table-prefix", type=_table_prefix, default="faults_", help="Prefix of the scratch tables (default: faults_)"
+    )
+    p.add_argument("--keep-tables", action="store_true", help="Leave the scratch tables of the last scenario in place")
+    p.add_argument("--sync-arg", action="append", default=[], help="Extra catalog_sync.py argument (repeatable)")
+    args = p.parse_args(argv)
+
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name}: {scenario.description}")
+        return 0
+    if psycopg is None:
+        raise SystemExit("psycopg is required (pip install -r scripts/catalog_sync_requirements.txt)")
+    pg_dsn = os.environ.get("PG_DSN")
+    if not pg_dsn:
+        # Not DATABASE_URL: that is usually the app's real database, and the scratch tables are dropped.
+        raise SystemExit("Set PG_DSN to a disposable database that has a products table")
+
+    cfg = HarnessConfig(
+        pg_dsn=pg_dsn,
+        items=max(1, args.items),
+        max_runs=max(1, args.max_runs),
+        table_prefix=args.table_prefix,
+        run_timeout_s=args.run_timeout_s,
+        keep_tables=args.keep_tables,
+        sync_args=tuple(args.sync_arg),
+    )
+    names = args.scenario or list(SCENARIOS)
+    if "baseline" not in names:
+        names = ["baseline"] + names
+    results: Dict[str, Dict[str, Any]] = {}
+    for name in names:
+        results[name] = run_scenario(cfg, name, SCENARIOS[name])
+        print(f"{name}: {'ok' if results[name]['ok'] else 'FAILED'} in {results[name]['wall_s']}s", file=sys.stderr)
+    baseline_s = results["baseline"]["wall_s"]
+    for result in results.values():
+        result["overhead_s"] = round(result["wall_s"] - baseline_s, 3)
+
+    print(json.dumps({"items": cfg.items, "scenarios": results}, indent=2, sort_keys=True, default=str))
+    return 0 if all(r["ok"] for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
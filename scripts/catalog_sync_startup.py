@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Start-up benchmark for single-item (--item-id) runs of scripts/catalog_sync.py.
+
+Times each path a webhook can take, as wall time of a fresh `python3` process (what the webhook
+pays), against the fake Square API of catalog_sync_faults.py and scratch copies of the tables in
+PG_DSN:
+
+- interpreter: `python3 -c pass`, the floor every path pays;
+- import: `import catalog_sync` (requests and psycopg must stay out of it: checked separately);
+- item_cold: a plain --item-id run (the first one crawls the categories, later ones read the
+  categories table, see --item-category-max-age-m);
+- item_daemon: --item-id with --daemon-socket, answered by a warm --serve daemon.
+
+Reports the median and max of --runs runs per path. The exit code is 1 when an import of
+catalog_sync pulls in requests or psycopg, or a median is over --max-import-ms / --max-item-ms /
+--max-daemon-ms. Point PG_DSN at a local or disposable database; the Square API is local too, so
+the numbers measure this script's own start-up, not network round trips.
+
+Usage:
+  PG_DSN=postgresql://... python3 scripts/catalog_sync_startup.py
+  PG_DSN=postgresql://... python3 scripts/catalog_sync_startup.py --runs 10 --max-daemon-ms 300
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from catalog_sync_faults import FAKE_LOCATION_ID, SYNC_SCRIPT, FakeSquare, HarnessConfig
+from catalog_sync_faults import _drop_scratch_tables, _reset_scratch_tables, _scratch_tables, _table_prefix, psycopg
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DAEMON_START_TIMEOUT_S = 30.0
+
+
+def _timed(cmd: List[str], env: Dict[str, str]) -> float:
+    """Run cmd to completion; wall time in ms (raises with its stderr when it fails)."""
+    started = time.monotonic()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=120)
+    ms = (time.monotonic() - started) * 1000.0
+    if proc.returncode != 0:
+        raise SystemExit(f"{' '.join(cmd[1:3])} exited {proc.returncode}: {proc.stderr.strip()[-500:]}")
+    return ms
+
+
+def _stats(samples: List[float]) -> Dict[str, Any]:
+    return {
+        "median_ms": round(statistics.median(samples), 1),
+        "max_ms": round(max(samples), 1),
+        "runs": [round(s, 1) for s in samples],
+    }
+
+
+def _start_daemon(env: Dict[str, str], socket_path: str, log_path: str) -> subprocess.Popen:
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.Popen(
+            [sys.executable, SYNC_SCRIPT, "--serve", socket_path], env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT_S
+    while not os.path.exists(socket_path):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            raise SystemExit(f"catalog sync daemon did not start (see {log_path})")
+        time.sleep(0.05)
+    return proc
+
+
+def main(argv: Any = None) -> int:
+    p = argparse.ArgumentParser(description="Start-up benchmark for catalog_sync.py --item-id runs.")
+    p.add_argument("--runs", type=int, default=5, help="Runs per path (default: 5)")
+    p.add_argument("--items", type=int, default=50, help="ITEMs in the fake catalog (default: 50)")
+    p.add_argument(
+        "--table-prefix",
+        type=_table_prefix,
+        default="startup_",
+        help="Prefix of the scratch tables (default: startup_)",
+    )
+    p.add_argument("--max-import-ms", type=float, default=None, help="Fail when `import catalog_sync` is slower")
+    p.add_argument("--max-item-ms", type=float, default=None, help="Fail when a plain --item-id run is slower")
+    p.add_argument("--max-daemon-ms", type=float, default=None, help="Fail when a run through the daemon is slower")
+    args = p.parse_args(argv)
+
+    if psycopg is None:
+        raise SystemExit("psycopg is required (pip install -r scripts/catalog_sync_requirements.txt)")
+    pg_dsn = os.environ.get("PG_DSN")
+    if not pg_dsn:
+        # Not DATABASE_URL: that is usually the app's real database, and the scratch tables are dropped.
+        raise SystemExit("Set PG_DSN to a disposable database that has a products table")
+    runs = max(1, args.runs)
+
+    harness = HarnessConfig(
+        pg_dsn=pg_dsn,
+        items=max(1, args.items),
+        max_runs=1,
+        table_prefix=args.table_prefix,
+        run_timeout_s=120.0,
+        keep_tables=False,
+    )
+    _reset_scratch_tables(harness)
+    tables = _scratch_tables(harness)
+    square = FakeSquare(harness.items, ()).start()
+    workdir = tempfile.mkdtemp(prefix="catalog-sync-startup-")
+    socket_path = os.path.join(workdir, "daemon.sock")
+
+    dropped = ("MAKE_ALERTS_WEBHOOK_URL", "SGR_DATABASE_URL", "SPR_DATABASE_URL", "DATABASE_URL", "PG_POOLER_DSN")
+    env = {k: v for k, v in os.environ.items() if k not in dropped and k != "CATALOG_SYNC_SOCKET"}
+    env.update(
+        {
+            "SQUARE_ACCESS_TOKEN": "startup-benchmark",
+            "SQUARE_BASE_URL": square.base_url,
+            "SQUARE_LOCATION_ID": FAKE_LOCATION_ID,
+            "PG_DSN": pg_dsn,
+            "PRODUCTS_TABLE": tables["products"],
+            "CATEGORIES_TABLE": tables["categories"],
+            "CATALOG_SYNC_RUNS_TABLE": tables["catalog_sync_runs"],
+            "ALERT_ENABLED": "0",
+            "SLACK_ALERT_ENABLED": "0",
+        }
+    )
+    item_args = [
+        "--state-path",
+        os.path.join(workdir, "state.json"),
+        "--alert-state",
+        os.path.join(workdir, "alerts.json"),
+    ]
+
+    def item(n: int) -> List[str]:
+        return [sys.executable, SYNC_SCRIPT, "--item-id", f"I{n % harness.items}", *item_args]
+
+    results: Dict[str, Any] = {}
+    daemon = None
+    try:
+        results["interpreter"] = _stats([_timed([sys.executable, "-c", "pass"], env) for _ in range(runs)])
+        import_cmd = [sys.executable, "-c", f"import sys; sys.path.insert(0, {SCRIPTS_DIR!r}); import catalog_sync"]
+        results["import"] = _stats([_timed(import_cmd, env) for _ in range(runs)])
+        probe = (
+            f"import json, sys; sys.path.insert(0, {SCRIPTS_DIR!r}); import catalog_sync; "
+            "print(json.dumps(sorted(m for m in ('requests', 'psycopg') if m in sys.modules)))"
+        )
+        out = subprocess.run([sys.executable, "-c", probe], env=env, capture_output=True, text=True, check=True)
+        results["eager_imports"] = json.loads(out.stdout)
+
+        first = _timed(item(0), env)
+        results["item_first"] = {"ms": round(first, 1), "note": "crawls the categories"}
+        results["item_cold"] = _stats([_timed(item(n + 1), env) for n in range(runs)])
+
+        daemon = _start_daemon(env, socket_path, os.path.join(workdir, "daemon.log"))
+        _timed(item(0) + ["--daemon-socket", socket_path], env)  # first daemon run opens its connection
+        results["item_daemon"] = _stats(
+            [_timed(item(n + 1) + ["--daemon-socket", socket_path], env) for n in range(runs)]
+        )
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait(timeout=30)
+        square.stop()
+        _drop_scratch_tables(harness)
+
+    budgets = {"import": args.max_import_ms, "item_cold": args.max_item_ms, "item_daemon": args.max_daemon_ms}
+    over = {k: results[k]["median_ms"] for k, v in budgets.items() if v is not None and results[k]["median_ms"] > v}
+    results["budgets_ms"] = {k: v for k, v in budgets.items() if v is not None}
+    results["over_budget"] = over
+    results["ok"] = not over and not results["eager_imports"]
+    results["workdir"] = workdir
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0 if results["ok"] else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())